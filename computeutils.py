@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Caching and multiprocessing helpers shared by the computational modules
+(grid, covar), free of GUI dependencies
+
+Copyright 2017 Bernard Giroux, Jerome Simon
+email: bernard.giroux@ete.inrs.ca
+
+This file is part of BhTomoPy.
+
+BhTomoPy is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+from multiprocessing import Pool, RawArray
+
+import numpy as np
+
+
+class LRUCache(object):
+    """
+    Mapping keeping the maxsize most recently used items
+
+    Items are discarded, least recently used first, when new ones are added.
+    maxsize can be changed at any time, the cache is trimmed at the next
+    insertion.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, key):
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > max(self.maxsize, 0):
+            self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        """
+        Returns the item of key if in cache, default otherwise
+        """
+        if key in self._items:
+            return self[key]
+        return default
+
+    def clear(self):
+        self._items.clear()
+
+
+# State of the worker processes of sharedPool: arrays held in shared memory,
+# plus whatever the initializer of the pool adds
+worker = {}
+
+
+def sharedPool(nprocs, arrays, init=None, initargs=()):
+    """
+    Pool of processes sharing read-only float64 arrays
+
+    The arrays are copied once in shared memory, they are not pickled for each
+    task.  In the worker processes, they are found in dict worker under the
+    same names, with their shape; empty arrays and None are replaced by ().
+
+    Input:
+        nprocs: number of processes
+        arrays: dict of arrays
+        init: function called in each process once arrays are set in worker,
+              to complete its state (may be None)
+        initargs: arguments of init
+
+    Output:
+        pool: multiprocessing.Pool instance
+    """
+    shared = {}
+    for name, a in arrays.items():
+        if a is None or len(a) == 0:
+            shared[name] = None
+            continue
+        a = np.asarray(a, dtype=np.float64)
+        raw = RawArray('d', a.size)
+        np.frombuffer(raw).reshape(a.shape)[...] = a
+        shared[name] = (raw, a.shape)
+    return Pool(nprocs, _initWorker, (shared, init, initargs))
+
+
+def _initWorker(shared, init, initargs):
+    worker.clear()
+    for name, v in shared.items():
+        worker[name] = () if v is None else np.frombuffer(v[0]).reshape(v[1])
+    if init is not None:
+        init(*initargs)
@@ -29,11 +29,22 @@ import sys
 
 import numpy as np
 from scipy.special import erfcinv
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, issparse
+import scipy.sparse as sp
 from scipy import linalg
+from scipy.optimize import minimize
+from scipy.spatial import cKDTree
 
+import pyfftw
 import pyfftw.interfaces.numpy_fft as np_fft
 
+from computeutils import LRUCache, sharedPool, worker
+
+
+# Largest number of elements of the distance blocks of Covariance.compute and
+# Covariance.compute_h (32 MB in double precision)
+block_size = 2**22
+
 
 class Covariance(object):
     """
@@ -85,38 +96,61 @@ class Covariance(object):
         cx = cx / t
         return cx  # ,rot
 
-    def compute(self, x, x0):
-        h = self.compute_h(x, x0)
-        return self._compute(h)
+    def compute(self, x, x0, dtype=np.float64):
+        """
+        Covariance between points x (n1 x d) and x0 (n2 x d)
+
+        Distances are computed by blocks of rows and the covariance of each
+        block is evaluated as it is produced, so temporaries are bounded by
+        block_size.  If x is x0 (and the sill is scalar), only the upper
+        triangle is evaluated.
 
-    def computeK(self, cx, m, n):
-        h = self.compute_hK(cx, m, n)
-        return self._compute(h)
+        dtype: type of the distances and of the output (e.g. np.float32)
+        """
+        t1, t2 = self._transPair(x, x0, dtype)
+        n1 = t1.shape[0]
+        n2 = t2.shape[0]
+        p, q = np.atleast_2d(self.sill).shape
+        symmetric = x is x0 and p == 1 and q == 1
+
+        C = np.empty((n1 * p, n2 * q), dtype=dtype)
+        nb = max(1, block_size // max(1, n2))
+        for i0 in range(0, n1, nb):
+            i1 = min(i0 + nb, n1)
+            j0 = i0 if symmetric else 0
+            C[i0 * p:i1 * p, j0 * q:] = self._compute(_distance(t1[i0:i1], t2[j0:]))
+            if symmetric:
+                C[i1:, i0:i1] = C[i0:i1, i1:].T
+        return C
+
+    def compute_h(self, x, x0, dtype=np.float64):
+        t1, t2 = self._transPair(x, x0, dtype)
+        n1 = t1.shape[0]
+        n2 = t2.shape[0]
+
+        h = np.empty((n1, n2), dtype=dtype)
+        nb = max(1, block_size // max(1, n2))
+        for i0 in range(0, n1, nb):
+            h[i0:i0 + nb, :] = _distance(t1[i0:i0 + nb], t2)
+        return h
 
-    def compute_h(self, x, x0):
-        n1, d = x.shape
-        n2, d2 = x0.shape
-        if d != d2:
+    def _transPair(self, x, x0, dtype):
+        # transformed coordinates of x and x0, computed once if x is x0
+        if x.shape[1] != x0.shape[1]:
             raise ValueError('Dimensionality of input data inconsistent')
 
-        t1 = self.trans(x)
-        t2 = self.trans(x0)
-        h = 0
-        for ii in np.arange(d):
-            # TODO: debug this for n2>1
-            tmp1 = np.tile(t1[:, ii], (n2, 1)).T
-            tmp2 = np.tile(t2[:, ii], (n1, 1))
-            h += (tmp1 - tmp2)**2
-
-        return np.sqrt(h)
-
-    def compute_hK(self, cx, m, n):
-        t = self.trans(cx)
-        t = np.dot(t, t.T)
-        h = np.sqrt(-2. * t + np.dot(t.diagonal().reshape(-1, 1), np.ones((1, n + m))) +
-                    np.dot(np.ones((n + m, 1)), t.diagonal().reshape(1, -1)))
-        h = h[:n, :]
-        return h
+        t1 = self.trans(x).astype(dtype, copy=False)
+        if x0 is x:
+            return t1, t1
+        return t1, self.trans(x0).astype(dtype, copy=False)
+
+
+def _distance(t1, t2):
+    # euclidean distance between rows of t1 and rows of t2, no n1 x n2 x d temporary
+    h = (t1[:, 0, None] - t2[:, 0])**2
+    for ii in range(1, t1.shape[1]):
+        h += (t1[:, ii, None] - t2[:, ii])**2
+    return np.sqrt(h, out=h)
 
 
 class CovarianceCubic(Covariance):
@@ -207,7 +241,7 @@ class CovarianceNugget(Covariance):
         Covariance.__init__(self, np.ones((d, )), a, s)
         self.type = CovarianceFactory.Nugget
 
-    def compute(self, x, x0):
+    def compute(self, x, x0, dtype=np.float64):
         d = x.ndim
         if d == 2:
             d = x.shape[1]
@@ -217,8 +251,7 @@ class CovarianceNugget(Covariance):
         else:
             self.angle = np.array([0.0])
 
-        h = self.compute_h(x, x0)
-        return np.kron((h == 0), self.sill)
+        return Covariance.compute(self, x, x0, dtype)
 
     def _compute(self, h):
         return np.kron((h == 0), self.sill)
@@ -310,27 +343,27 @@ class CovarianceModel(object):
         self.use_xi       = False
         self.use_tilt     = False
 
-    def compute(self, x, x0):
-        Cm = self.covar[0].compute(x, x0)
+    def compute(self, x, x0, dtype=np.float64):
+        Cm = self.covar[0].compute(x, x0, dtype)
 
         for n in range(1, len(self.covar)):
-            Cm += self.covar[n].compute(x, x0)
+            Cm += self.covar[n].compute(x, x0, dtype)
 
         if self.nugget_model != 0:
             Cm += self.nugget_model * np.eye(Cm.shape[0])
 
         if self.use_xi:
-            Cx = self.covar_xi[0].compute(x, x0)
+            Cx = self.covar_xi[0].compute(x, x0, dtype)
             for n in range(1, len(self.covar_xi)):
-                Cx += self.covar_xi[n].compute(x, x0)
+                Cx += self.covar_xi[n].compute(x, x0, dtype)
 
             if self.nugget_xi != 0:
                 Cx += self.nugget_xi * np.eye(Cm.shape[0])
 
             if self.use_tilt:
-                Ct = self.covar_tilt[0].compute(x, x0)
+                Ct = self.covar_tilt[0].compute(x, x0, dtype)
                 for n in range(1, len(self.covar_tilt)):
-                    Ct += self.covar_tilt[n].compute(x, x0)
+                    Ct += self.covar_tilt[n].compute(x, x0, dtype)
 
                 if self.nugget_tilt != 0:
                     Ct += self.nugget_tilt * np.eye(Cm.shape[0])
@@ -345,8 +378,398 @@ class CovarianceModel(object):
 
         return Cm
 
+    def dotBlocks(self, x, M, nb=1000):
+        """
+        Compute compute(x, x).dot(M) by blocks of nb rows, the covariance
+        matrix is never formed in full
+
+        Input:
+            x: coordinates (n x d)
+            M: matrix with as many rows as the covariance matrix (dense or sparse)
+            nb: number of rows of the covariance matrix computed at once
+
+        Yields:
+            rows: slice of the rows of the block
+            CM: block of the product (nb x M.shape[1])
+        """
+        n = x.shape[0]
+        blocks = [(self.covar, self.nugget_model)]
+        if self.use_xi:
+            blocks.append((self.covar_xi, self.nugget_xi))
+            if self.use_tilt:
+                blocks.append((self.covar_tilt, self.nugget_tilt))
+
+        # covariance matrix is block diagonal for anisotropic models
+        for nblk, (covar, nugget) in enumerate(blocks):
+            Mb = M[nblk * n:(nblk + 1) * n]
+            for i in range(0, n, nb):
+                r = slice(i, min(i + nb, n))
+                C = covar[0].compute(x[r], x)
+                for c in covar[1:]:
+                    C += c.compute(x[r], x)
+                CM = Mb.T.dot(C.T).T
+                if nugget != 0:
+                    Mr = Mb[r]
+                    CM += nugget * (Mr.toarray() if issparse(Mr) else Mr)
+                yield slice(nblk * n + r.start, nblk * n + r.stop), CM
+
+    def dot(self, x, M, nb=1000):
+        """
+        Returns compute(x, x).dot(M), computed by blocks of nb rows of the
+        covariance matrix (see dotBlocks).  M may be a vector.
+        """
+        vec = not issparse(M) and np.ndim(M) == 1
+        if vec:
+            M = np.asarray(M).reshape(-1, 1)
+        out = np.empty((M.shape[0], M.shape[1]))
+        for r, CM in self.dotBlocks(x, M, nb):
+            out[r] = CM
+        return out.ravel() if vec else out
+
+
+class CovarianceOperator(object):
+    """
+    Covariance matrix of the cells of a regular grid, applied with FFTs
+
+    Covariance models are stationary and the grid is regular, the covariance
+    matrix is thus block Toeplitz.  It is embedded in a circulant matrix
+    defined on a grid twice as large along each axis (as in Grid2D.preFFTMA),
+    and products with it are computed as zero-padded circular convolutions:
+    O(n log n) operations and O(n) memory for n cells.
+
+    Cells are ordered with the last axis fastest (Z fastest, see Grid2D).
+    For anisotropic models, the operator is block diagonal (slowness, xi and
+    tilt angle), as returned by CovarianceModel.compute.
+    """
+
+    def __init__(self, cm, n, d):
+        """
+        Input:
+            cm: CovarianceModel instance
+            n: number of cells along each axis, (nx, nz) or (nx, ny, nz)
+            d: size of the cells along each axis
+        """
+        self.n = tuple([int(v) for v in n])
+        self.N = tuple([2 * v for v in self.n])
+        self.axes = tuple(range(len(self.n)))
+        self.ncell = int(np.prod(self.n))
+
+        # lags of the circulant embedding, negative lags wrap around
+        lags = [d[k] * np.hstack((np.arange(self.n[k]), np.arange(-self.n[k], 0)))
+                for k in self.axes]
+        h = np.vstack([l.flatten() for l in np.meshgrid(*lags, indexing='ij')]).T
+        h0 = np.zeros((1, len(self.n)))
+
+        blocks = [(cm.covar, cm.nugget_model)]
+        if cm.use_xi:
+            blocks.append((cm.covar_xi, cm.nugget_xi))
+            if cm.use_tilt:
+                blocks.append((cm.covar_tilt, cm.nugget_tilt))
+
+        self.spectra = []
+        for covar, nugget in blocks:
+            K = 0
+            for c in covar:
+                K = K + c.compute(h, h0)
+            K = np.reshape(K, self.N)
+            K[(0,) * len(self.n)] += nugget
+            self.spectra.append(np_fft.rfftn(K))
+
+        self.shape = (len(blocks) * self.ncell, len(blocks) * self.ncell)
+        self.dtype = np.dtype(np.float64)
+
+    def dot(self, M, nb=64):
+        """
+        Returns Cm.dot(M), M is a vector or a matrix (dense or sparse) whose
+        columns are processed by groups of nb
+        """
+        vec = not issparse(M) and np.ndim(M) == 1
+        if vec:
+            M = np.asarray(M).reshape(-1, 1)
+        out = np.empty((M.shape[0], M.shape[1]))
+        inner = tuple([slice(0, v) for v in self.n])
+        for nblk, S in enumerate(self.spectra):
+            rows = slice(nblk * self.ncell, (nblk + 1) * self.ncell)
+            S = S.reshape(S.shape + (1,))
+            for j in range(0, M.shape[1], nb):
+                Mj = M[rows, j:j + nb]
+                Mj = Mj.toarray() if issparse(Mj) else np.asarray(Mj)
+                V = Mj.reshape(self.n + (Mj.shape[1],))
+                W = np_fft.irfftn(np_fft.rfftn(V, s=self.N, axes=self.axes) * S,
+                                  s=self.N, axes=self.axes)
+                out[rows, j:j + Mj.shape[1]] = W[inner].reshape(self.ncell, Mj.shape[1])
+        return out.ravel() if vec else out
+
+    def matvec(self, v):
+        return self.dot(np.ravel(v))
+
+    rmatvec = matvec
+
+    def project(self, L, nb=64):
+        """
+        Returns L.dot(Cm).dot(L.T) (e.g. the data covariance), computed by
+        groups of nb rows of L
+
+        Input:
+            L: matrix with as many columns as Cm (sparse)
+        """
+        Lt = L.T.tocsc() if issparse(L) else np.asarray(L).T
+        C = np.empty((L.shape[0], L.shape[0]))
+        for j in range(0, L.shape[0], nb):
+            C[:, j:j + nb] = L.dot(self.dot(Lt[:, j:j + nb], nb))
+        return C
+
+
+class CovarianceFit(object):
+    """
+    Fit of a covariance model to the experimental covariance of traveltime
+    residuals
+
+    Pairs of rays are sorted by decreasing theoretical covariance and grouped
+    in bins of lclas pairs, the mean experimental and theoretical covariances
+    of the bins are compared.  The ray geometry and the experimental
+    covariance do not depend on the model and are set up once.  Projections
+    on the rays of each covariance structure are computed for a unit sill and
+    kept until its range or angle change: sills and nuggets are updated
+    without projecting again.
+    """
+
+    def __init__(self, G, dt, n, d, lclas, afi=1.0, c0=None, nsub=None, seed=None,
+                 maxpairs=2**24):
+        """
+        Input:
+            G: projection matrix of the rays (L, or J for anisotropic models),
+               nt x (ncell x number of blocks)
+            dt: traveltime residuals (nt,), the experimental covariance is dt*dt.T
+            n: number of cells along each axis, (nx, nz) or (nx, ny, nz)
+            d: size of the cells along each axis
+            lclas: number of pairs of rays in each bin
+            afi: fraction of the bins used, bins of largest covariance first
+            c0: variance of each datum (nt,), used for the data nugget
+                (None: same variance for all data)
+            nsub: number of rays of a random subset used for the fit (None: all)
+            seed: seed of the random generator of the subset
+            maxpairs: above this number of pairs of rays, the data covariance
+                      is not formed and bins are accumulated by blocks of
+                      columns (see streamCurves)
+        """
+        dt = np.asarray(dt, dtype=np.float64).ravel()
+        if nsub is not None and nsub < dt.size:
+            sub = np.sort(np.random.default_rng(seed).choice(dt.size, nsub, replace=False))
+            G = G[sub, :]
+            dt = dt[sub]
+            if c0 is not None:
+                c0 = np.asarray(c0)[sub]
+
+        self.n = n
+        self.d = d
+        self.dt = dt
+        self.nt = dt.size
+        self.lclas = int(lclas)
+        self.ncell = int(np.prod(n))
+        self.stream = self.nt**2 > maxpairs
+        self.seed = seed
+        if self.stream:
+            # only the projection matrix and the data nugget are needed
+            self.Gall = G.tocsr() if issparse(G) else np.asarray(G)
+            self.c0 = np.ones((self.nt,)) if c0 is None else np.asarray(c0, dtype=np.float64)
+            self.nbins = int(np.floor(self.nt**2 / self.lclas))
+            self.nused = min(int(np.round(self.nbins * afi)), self.nbins)
+            return
+
+        # blocks of G for each parameter (slowness, xi, tilt)
+        self.G = [G[:, b * self.ncell:(b + 1) * self.ncell] for b in range(G.shape[1] // self.ncell)]
+
+        # projections of the model and data nuggets
+        self.GGt = []
+        for Gb in self.G:
+            GGt = Gb.dot(Gb.T)
+            self.GGt.append(GGt.toarray() if issparse(GGt) else np.asarray(GGt))
+        self.D = np.diag(np.ones((self.nt,)) if c0 is None else c0)
+
+        # bins used: only the largest covariances have to be sorted
+        self.nbins = int(np.floor(self.nt**2 / self.lclas))
+        self.nused = min(int(np.round(self.nbins * afi)), self.nbins)
+
+        self._proj = {}
+
+    def project(self, cm):
+        """
+        Returns the covariance of the data for model cm (nt x nt)
+        """
+        blocks = [(cm.covar, cm.nugget_model)]
+        if cm.use_xi:
+            blocks.append((cm.covar_xi, cm.nugget_xi))
+            if cm.use_tilt:
+                blocks.append((cm.covar_tilt, cm.nugget_tilt))
+
+        C = cm.nugget_data * self.D
+        for b, (covar, nugget) in enumerate(blocks):
+            for k, c in enumerate(covar):
+                key = (c.type, tuple(np.ravel(c.range)), tuple(np.ravel(c.angle)))
+                if (b, k) not in self._proj or self._proj[(b, k)][0] != key:
+                    unit = CovarianceModel('3D' if len(self.n) == 3 else '2D')
+                    unit.covar = [CovarianceFactory.buildCov(c.type, np.array(c.range, dtype=float),
+                                                             np.array(c.angle, dtype=float), 1.0)]
+                    P = CovarianceOperator(unit, self.n, self.d).project(self.G[b])
+                    self._proj[(b, k)] = (key, P)
+                C = C + c.sill * self._proj[(b, k)][1]
+            if nugget != 0:
+                C = C + nugget * self.GGt[b]
+        return C
+
+    def curves(self, cm):
+        """
+        Returns mean experimental (g) and theoretical (gt) covariances of the
+        bins used
+        """
+        if self.stream:
+            return self.streamCurves(cm)
+
+        C = self.project(cm).ravel()
+        if self.nused < self.nbins:
+            # largest covariances only, in decreasing order
+            nk = self.nused * self.lclas
+            ind = np.argpartition(C, C.size - nk)[C.size - nk:]
+            ind = ind[np.argsort(C[ind])[::-1]]
+            gt = np.mean(C[ind].reshape((self.nused, self.lclas)), axis=1)
+            g = self.dt[ind // self.nt] * self.dt[ind % self.nt]
+            g = np.mean(g.reshape((self.nused, self.lclas)), axis=1)
+        else:
+            ind = np.argsort(C)[::-1]
+            gt = moy_bloc(C[ind], self.lclas)
+            g = moy_bloc(self.dt[ind // self.nt] * self.dt[ind % self.nt], self.lclas)
+        return g, gt
+
+    def streamCurves(self, cm, nb=256, nsample=2**20):
+        """
+        Binned covariances computed with memory linear in the number of rays
+
+        Bin limits are quantiles of the theoretical covariance estimated on
+        the columns of a random subset of rays, the upper triangle of the
+        data covariance is then computed by blocks of nb columns and each pair
+        of rays is accumulated in its bin.  Bins hold lclas pairs on average
+        instead of exactly, otherwise they match those of curves.
+        """
+        Cop = CovarianceOperator(cm, self.n, self.d)
+        G = self.Gall
+        Gt = G.T.tocsc() if issparse(G) else G.T
+
+        def columns(j, nrows):
+            # data covariance between the first nrows rays and rays j
+            C = G[:nrows].dot(Cop.dot(Gt[:, j], nb))
+            C[j, np.arange(j.size)] += cm.nugget_data * self.c0[j]
+            return C
+
+        # limits of the bins, in decreasing order of covariance
+        ns = min(self.nt, max(1, nsample // self.nt))
+        j = np.sort(np.random.default_rng(self.seed).choice(self.nt, ns, replace=False))
+        sample = np.sort(columns(j, self.nt).ravel())[::-1]
+        nlim = self.nused if self.nused < self.nbins else self.nbins - 1
+        ranks = np.arange(1, nlim + 1) * self.lclas / self.nt**2
+        limits = -sample[np.minimum((ranks * sample.size).astype(int), sample.size - 1)]
+
+        n = np.zeros((self.nused + 1,))
+        g = np.zeros((self.nused + 1,))
+        gt = np.zeros((self.nused + 1,))
+        for j0 in range(0, self.nt, nb):
+            j = np.arange(j0, min(j0 + nb, self.nt))
+            C = columns(j, j[-1] + 1)
+            i = np.arange(C.shape[0]).reshape((-1, 1))
+
+            # upper triangle, pairs off the diagonal stand for two pairs
+            w = np.where(i < j, 2.0, np.where(i == j, 1.0, 0.0))
+            b = np.searchsorted(limits, -C, side='left')
+            b = np.minimum(b, self.nused).ravel()
+            w = w.ravel()
+            n += np.bincount(b, weights=w, minlength=self.nused + 1)
+            gt += np.bincount(b, weights=w * C.ravel(), minlength=self.nused + 1)
+            g += np.bincount(b, weights=w * np.outer(self.dt[:C.shape[0]], self.dt[j]).ravel(),
+                             minlength=self.nused + 1)
+
+        keep = n[:self.nused] > 0
+        return g[:self.nused][keep] / n[:self.nused][keep], gt[:self.nused][keep] / n[:self.nused][keep]
+
+    def misfit(self, cm):
+        """
+        Weighted misfit between experimental and theoretical covariances, bins
+        of largest covariance have the largest weights
+        """
+        g, gt = self.curves(cm)
+        q = np.flip(np.arange(1, len(g) + 1) ** 2, axis=0)
+        q = (q / (np.max(q))) + 1
+        return np.sum(((gt - g) * q)**2)
+
+    def fit(self, cm, free, maxiter=5, callback=None):
+        """
+        Adjust the free parameters of cm with the simplex method, cm is
+        modified in place and holds the best parameters found on return
+
+        Sills and nuggets are kept positive or null, and ranges larger than a
+        thousandth of the cell size.
+
+        Input:
+            cm: CovarianceModel instance
+            free: list of parameters to adjust, given as tuples
+                      ('covar', k, 'range', i), ('covar', k, 'angle', i),
+                      ('covar', k, 'sill'), same with 'covar_xi' and
+                      'covar_tilt', or ('nugget_model',), ('nugget_data',),
+                      ('nugget_xi',), ('nugget_tilt',)
+            maxiter: maximum number of iterations and of function evaluations
+            callback: function called after each evaluation of the misfit
+
+        Output:
+            x: values of the free parameters
+        """
+        def func(x):
+            for p, v in zip(free, x):
+                _setParameter(cm, p, v)
+            f = self.misfit(cm)
+            if callback is not None:
+                callback()
+            return f
+
+        bounds = []
+        for p in free:
+            if len(p) == 4 and p[2] == 'angle':
+                bounds.append((None, None))
+            elif len(p) == 4:
+                bounds.append((1.e-3 * np.min(self.d), None))
+            else:
+                bounds.append((0.0, None))
+
+        # start inside the bounds
+        x0 = np.array([_getParameter(cm, p) for p in free], dtype=float)
+        x0 = np.maximum(x0, [-np.inf if b[0] is None else b[0] for b in bounds])
+        res = minimize(func, x0, method='Nelder-Mead', bounds=bounds,
+                       options={'xatol': 1e-12, 'fatol': 1e-12, 'maxiter': maxiter, 'maxfev': maxiter})
+        for p, v in zip(free, res.x):
+            _setParameter(cm, p, v)
+        return res.x
+
+
+def _getParameter(cm, p):
+    if len(p) == 1:
+        return getattr(cm, p[0])
+    c = getattr(cm, p[0])[p[1]]
+    if len(p) == 3:
+        return getattr(c, p[2])
+    return getattr(c, p[2])[p[3]]
+
+
+def _setParameter(cm, p, v):
+    if len(p) == 1:
+        setattr(cm, p[0], v)
+        return
+    c = getattr(cm, p[0])[p[1]]
+    if len(p) == 3:
+        setattr(c, p[2], v)
+    else:
+        getattr(c, p[2])[p[3]] = v
+
 
-def cokri(x, x0, cm, itype, avg, block, nd, ival, nk, rad, ntok, verbose=False):
+def cokri(x, x0, cm, itype, avg, block, nd, ival, nk, rad, ntok, verbose=False, nprocs=1,
+          callback=None):
     """
     Translation of cokri matlab function from D. Marcotte (adapted
     for covariance classes defined in this file)
@@ -395,6 +818,11 @@ def cokri(x, x0, cm, itype, avg, block, nd, ival, nk, rad, ntok, verbose=False):
     ntok:  Points in x0 will be kriged by groups of ntok grid points.
             When ntok>1, the search will find the nk nearest samples within
             distance rad from the current ntok grid points centroid
+    verbose: print progress
+    nprocs: number of processes, groups of ntok points are distributed over
+            a pool of processes sharing x and x0
+    callback: function called with (number of groups done, number of groups)
+              each time a group of ntok points is processed
 
     OUTPUT
 
@@ -441,7 +869,6 @@ def cokri(x, x0, cm, itype, avg, block, nd, ival, nk, rad, ntok, verbose=False):
     n, t = x.shape
     nk = min(nk, n)
     ntok = min(ntok, m)
-    idp = np.arange(p).reshape((p, 1))
     ng = np.prod(nd)
 
     # compute point (ng=1) or block (ng>1) variance
@@ -481,95 +908,158 @@ def cokri(x, x0, cm, itype, avg, block, nd, ival, nk, rad, ntok, verbose=False):
     for i in range(1, p):
         sv = np.hstack((sv, means(means(K0[i:ng * p:p, i:ng * p:p]).T)))
 
+    # groups of ntok points are independent, outputs are allocated once and
+    # each group fills its rows
+    starts = np.arange(0, m, ntok)
+    ngroups = starts.size
+    x0s = np.empty((m, d + p))
+    s = np.empty((m, d + p))
+    x0s[:, :d] = x0
+    s[:, :d] = x0
+
+    nskip = 1
     if verbose:
-        nskip = int(np.log10(m / ntok))
-        nskip = int(10**(nskip - 2))
-        if nskip < 1:
-            nskip = 1
-
-    # start cokriging
-    for i in np.arange(0, m, ntok):
-        nnx = min((m - i, ntok))
-        if verbose and ((i + 1) % nskip == 0):
-            print('Cokriging - loop ' + str(int(i / ntok) + 1) + '/' + str(1 + int(m / ntok)))
-
-        # sort x samples in increasing distance relatively to centroid of 'ntok'
-        # points to krige
-        centx0 = np.dot(np.ones((n, 1)), means(x0[i:i + nnx, :]))
-        tx = np.dot((x[:, :d] - centx0) * (x[:, :d] - centx0), np.ones((d, 1)))
-        j = np.argsort(tx, axis=0).flatten()
-        tx = tx[j, :]
-
-        # keep samples inside search radius; create an identifier of each sample
-        # and variable (id)
-        ii = 0
-        t = x[j[ii], :]
-        idl = np.hstack((np.ones((p, 1)) * j[ii], idp))
-        ii += 1
-        while ii < nk and tx[ii] < rad * rad:
-            t = np.vstack((t, x[j[ii], :]))
-            idl = np.vstack((idl, np.hstack((np.ones((p, 1)) * j[ii], idp))))
-            ii += 1
-
-        if verbose and ((i + 1) % nskip == 0):
-            print('  Processing ' + str(int(nnx)) + ' points with ' + str(t.shape[0]) + ' data points')
-            sys.stdout.flush()
-
-        t2 = x0[i:i + nnx, :]
-
-        # if block cokriging discretize the block
-
-        t2 = np.kron(t2, np.ones((ng, 1))) - np.kron(np.ones((nnx, 1)), grid)
-
-        # check for cross-validation
-
-        if ival >= 1:
-            est = np.zeros((1, p))
-            sest = np.zeros((1, p))
-
-            # each variable is cokriged in its turn
-
-            if ival == 1:
-                npp = 1
-            else:
-                npp = p
-
-            for ip in np.arange(0, npp, p):
-
-                # because of the sort, the closest sample is the sample to
-                # cross-validate and its value is in row 1 of t; a temporary vector
-                # keeps the original values before performing cokriging
-                vtemp = t[0, d + ip:d + ip + npp]
-                t[0, d + ip:d + ip + npp] = np.zeros((1, npp)) + np.nan
-                x0ss, ss, idout, l, K, K0 = _cokri2(t, t2, idl, cm, sv, itype, avg, ng)
-                est[ip:ip + npp] = x0ss[ip:ip + npp]
-                sest[ip:ip + npp] = ss[ip:ip + npp]
-                t[0, d + ip:d + ip + npp] = vtemp
-
-            if x0s.size == 0:
-                x0s = np.hstack((t2, est))
-            else:
-                x0s = np.vstack((x0s, np.hstack((t2, est))))
-            if s.size == 0:
-                s = np.hstack((t2, sest))
-            else:
-                s = np.vstack((s, np.hstack((t2, sest))))
+        nskip = max(1, int(10**(int(np.log10(max(ngroups, 1))) - 2)))
+
+    w = {'x': x, 'x0': x0, 'cm': cm, 'sv': sv, 'itype': itype, 'avg': avg, 'ng': ng,
+         'grid': grid, 'ival': ival, 'nk': nk, 'rad': rad, 'ntok': ntok, 'verbose': verbose,
+         'nskip': nskip}
+
+    if nprocs > 1 and ngroups > 1:
+        nprocs = min(nprocs, ngroups)
+        params = {k: v for k, v in w.items() if k not in ('x', 'x0')}
+        with sharedPool(nprocs, {'x': x, 'x0': x0}, _initCokriWorker, (params,)) as pool:
+            results = pool.imap_unordered(_cokriWorker, starts,
+                                          chunksize=max(1, ngroups // (8 * nprocs)))
+            for k, (i, est, sest, last) in enumerate(results):
+                x0s[i:i + est.shape[0], d:] = est
+                s[i:i + est.shape[0], d:] = sest
+                if last is not None:
+                    idout, l, K, K0 = last
+                if callback is not None:
+                    callback(k + 1, ngroups)
+    else:
+        # spatial index of the samples for the moving neighbourhood
+        w['tree'] = cKDTree(x[:, :d])
+        w['cache'] = LRUCache(lu_cache_size) if lu_cache_size > 0 else None
+        for k, i in enumerate(starts):
+            if verbose and ((k + 1) % nskip == 0):
+                print('Cokriging - loop ' + str(k + 1) + '/' + str(ngroups))
+            est, sest, idout, l, K, K0 = _cokriGroup(w, i)
+            x0s[i:i + est.shape[0], d:] = est
+            s[i:i + est.shape[0], d:] = sest
+            if callback is not None:
+                callback(k + 1, ngroups)
+
+    return x0s, s, sv, idout, l, K, K0
+
+
+def _cokriGroup(w, i):
+    """
+    Cokriging of the group of points of w['x0'] starting at row i
+
+    w holds the data and the parameters of cokri, and the spatial index of
+    the samples (w['tree'])
+
+    Returns estimates and variances (nnx x p), and the weights and
+    covariance matrices of the system (see _cokri2)
+    """
+    x = w['x']
+    x0 = w['x0']
+    cm = w['cm']
+    ng = w['ng']
+    m, d = x0.shape
+    if np.isscalar(cm[0].sill):
+        p = 1
+    else:
+        p = cm[0].sill.shape[0]
+    idp = np.arange(p).reshape((p, 1))
+    nnx = min((m - i, w['ntok']))
+
+    # nk samples nearest to the centroid of 'ntok' points to krige, in
+    # increasing distance
+    tx, j = w['tree'].query(means(x0[i:i + nnx, :]).ravel(), k=w['nk'])
+    tx = np.atleast_1d(tx)
+    j = np.atleast_1d(j)
 
+    # keep samples inside search radius (the nearest one is always kept);
+    # create an identifier of each sample and variable (id)
+    inside = tx < w['rad']
+    inside[0] = True
+    j = j[inside]
+    key = None
+    if w['cache'] is not None and w['ival'] == 0:
+        # samples in index order, groups using the same samples share a key
+        j = np.sort(j)
+        key = (w['itype'], j.tobytes())
+    t = x[j, :]
+    idl = np.hstack((np.repeat(j, p).reshape((-1, 1)).astype(float), np.tile(idp, (j.size, 1))))
+
+    if w['verbose'] and ((int(i / w['ntok']) + 1) % w['nskip'] == 0):
+        print('  Processing ' + str(int(nnx)) + ' points with ' + str(t.shape[0]) + ' data points')
+        sys.stdout.flush()
+
+    t2 = x0[i:i + nnx, :]
+
+    # if block cokriging discretize the block
+
+    t2 = np.kron(t2, np.ones((ng, 1))) - np.kron(np.ones((nnx, 1)), w['grid'])
+
+    # check for cross-validation
+
+    if w['ival'] >= 1:
+        est = np.zeros((1, p))
+        sest = np.zeros((1, p))
+
+        # each variable is cokriged in its turn
+
+        if w['ival'] == 1:
+            npp = 1
         else:
-            x0ss, ss, idout, l, K, K0 = _cokri2(t, t2, idl, cm, sv, itype, avg, ng)
-            if x0s.size == 0:
-                x0s = np.hstack((x0[i:i + nnx, :], x0ss))
-            else:
-                x0s = np.vstack((x0s, np.hstack((x0[i:i + nnx, :], x0ss))))
-            if s.size == 0:
-                s = np.hstack((x0[i:i + nnx, :], ss))
-            else:
-                s = np.vstack((s, np.hstack((x0[i:i + nnx, :], ss))))
+            npp = p
 
-    return x0s, s, sv, idout, l, K, K0
+        for ip in np.arange(0, npp, p):
+
+            # because of the sort, the closest sample is the sample to
+            # cross-validate and its value is in row 1 of t; a temporary vector
+            # keeps the original values before performing cokriging
+            vtemp = t[0, d + ip:d + ip + npp].copy()
+            t[0, d + ip:d + ip + npp] = np.zeros((1, npp)) + np.nan
+            x0ss, ss, idout, l, K, K0 = _cokri2(t, t2, idl, cm, w['sv'], w['itype'], w['avg'], ng)
+            est[ip:ip + npp] = x0ss[ip:ip + npp]
+            sest[ip:ip + npp] = ss[ip:ip + npp]
+            t[0, d + ip:d + ip + npp] = vtemp
+
+        return est, sest, idout, l, K, K0
+
+    x0ss, ss, idout, l, K, K0 = _cokri2(t, t2, idl, cm, w['sv'], w['itype'], w['avg'], ng,
+                                        w['cache'], key)
+    return x0ss, ss, idout, l, K, K0
+
+
+# Number of factorizations of cokriging systems kept by cokri, groups of
+# points selecting the same samples reuse them (0 to disable)
+lu_cache_size = 64
+
+# Worker processes of cokri when nprocs > 1 (see computeutils.sharedPool), the
+# data and the points to estimate are held in shared memory
+
+def _initCokriWorker(params):
+    worker.update(params)
+    m, d = worker['x0'].shape
+    worker['tree'] = cKDTree(worker['x'][:, :d])
+    worker['cache'] = LRUCache(lu_cache_size) if lu_cache_size > 0 else None
+    worker['last'] = m - 1 - (m - 1) % params['ntok']
+
+
+def _cokriWorker(i):
+    est, sest, idout, l, K, K0 = _cokriGroup(worker, i)
+    # the system of the last group is returned, as in the serial version
+    last = (idout, l, K, K0) if i == worker['last'] else None
+    return i, est, sest, last
 
 
-def _cokri2(x, x0, idl, cm, sv, itype, avg, ng):
+def _cokri2(x, x0, idl, cm, sv, itype, avg, ng, cache=None, key=None):
 
     x0s = np.array([])
     s = np.array([])
@@ -593,13 +1083,24 @@ def _cokri2(x, x0, idl, cm, sv, itype, avg, ng):
 
     cx = np.vstack((x[:, :d], x0))
 
+    # the left matrix only depends on the samples, its factorization is taken
+    # from the cache if the same samples were used for a previous group
+    factor = None
+    if cache is not None and key in cache:
+        K, factor = cache[key]
+
     # calculation of left covariance matrix K and right covariance matrix K0
 
-    K = np.zeros((n * p, (n + m) * p))
-    for c in cm:
-        K = K + c.computeK(cx, m, n)
-    K0 = K[:, n * p:(n + m) * p]
-    K = K[:, :n * p]
+    if factor is None:
+        K = 0
+        for c in cm:
+            K = K + c.compute(x[:, :d], cx)
+        K0 = K[:, n * p:(n + m) * p]
+        K = K[:, :n * p]
+    else:
+        K0 = 0
+        for c in cm:
+            K0 = K0 + c.compute(x[:, :d], x0)
 
     # constraints are added according to cokriging type
 
@@ -609,32 +1110,36 @@ def _cokri2(x, x0, idl, cm, sv, itype, avg, ng):
 
     if itype == 2:
         # cokriging with one non-bias condition (Isaaks and Srivastava, 1990, p.410)
-        K = np.vstack((np.hstack((K, np.ones((n * p, 1)))), np.ones((1, 1 + n * p))))
-        K[-1:-1] = 0.0
+        if factor is None:
+            K = np.vstack((np.hstack((K, np.ones((n * p, 1)))), np.ones((1, 1 + n * p))))
+            K[-1:-1] = 0.0
         K0 = np.vstack((K0, np.ones((1, m * p))))
         nc = 1
     elif itype >= 3:
         # ordinary cokriging (Myers, Math. Geol, 1982)
 
-        t = np.kron(np.ones((1, n)), np.eye(p))
-        K = np.vstack((np.hstack((K, t.T)), np.hstack((t, np.zeros((p, p))))))
+        if factor is None:
+            t = np.kron(np.ones((1, n)), np.eye(p))
+            K = np.vstack((np.hstack((K, t.T)), np.hstack((t, np.zeros((p, p))))))
         K0 = np.vstack((K0, np.kron(np.ones((1, m)), np.eye(p))))
         nc = p
 
         # cokriging with one non-bias condition in the z direction
         if itype == 3.5:
-            t = np.kron(cx[:n, d - 1], np.eye(p))
-            K = np.vstack((np.hstack((K, np.vstack((t, np.zeros((p, p)))))),
-                           np.hstack((t.T, np.zeros((p, p + p))))))
+            if factor is None:
+                t = np.kron(cx[:n, d - 1], np.eye(p))
+                K = np.vstack((np.hstack((K, np.vstack((t, np.zeros((p, p)))))),
+                               np.hstack((t.T, np.zeros((p, p + p))))))
             t = np.kron(cx[n:n + m, d - 1].T, np.eye(p))
             K0 = np.vstack((K0, t))
             nc += p
         if itype >= 4:
             # universal cokriging ; linear drift constraints
             nca = p * d
-            t = np.kron(cx[:n, :], np.eye(p))
-            K = np.vstack((np.hstack((K, np.vstack((t, np.zeros((p, nca)))))),
-                           np.hstack((t.T, np.zeros((nca, nc + nca))))))
+            if factor is None:
+                t = np.kron(cx[:n, :], np.eye(p))
+                K = np.vstack((np.hstack((K, np.vstack((t, np.zeros((p, nca)))))),
+                               np.hstack((t.T, np.zeros((nca, nc + nca))))))
             t = np.kron(cx[n:n + m, :].T, np.eye(p))
             K0 = np.vstack((K0, t))
             nc = nc + nca
@@ -649,9 +1154,10 @@ def _cokri2(x, x0, idl, cm, sv, itype, avg, ng):
                 for j in range(i, d):
                     cx2[:, ic] = cx[:, i] * cx[:, j]
                     ic += 1
-            t = np.kron(cx2[:n, :], np.eye(p))
-            K = np.vstack((np.hstack((K, np.vstack((t, np.zeros((nc, nca)))))),
-                           np.hstack((t.T, np.zeros((nca, nc + nca))))))
+            if factor is None:
+                t = np.kron(cx2[:n, :], np.eye(p))
+                K = np.vstack((np.hstack((K, np.vstack((t, np.zeros((nc, nca)))))),
+                               np.hstack((t.T, np.zeros((nca, nc + nca))))))
             t = np.kron(cx2[n:n + m, :].T, np.eye(p))
             K0 = np.vstack((K0, t))
             nc = nc + nca
@@ -687,14 +1193,19 @@ def _cokri2(x, x0, idl, cm, sv, itype, avg, ng):
         s = np.nan
         return x0s, s, idl, l, K, K0
     else:
-        K = K[iz2, :]
-        K = K[:, iz2]
+        if factor is None:
+            K = K[iz2, :]
+            K = K[:, iz2]
+            factor = _factorK(K, itype)
+            if cache is not None:
+                cache[key] = (K, factor)
         K0 = K0[iz2, :]
         idl = idl[iz, :]
 
         # solution of the cokriging system
 
-        l = linalg.solve(K, K0)
+        solve, f = factor
+        l = solve(f, K0)
 
         # calculation of cokriging estimates
 
@@ -719,6 +1230,16 @@ def _cokri2(x, x0, idl, cm, sv, itype, avg, ng):
     return x0s, s, idl, l, K, K0
 
 
+def _factorK(K, itype):
+    # without constraints (simple cokriging) K is positive definite
+    if itype == 1:
+        try:
+            return linalg.cho_solve, linalg.cho_factor(K)
+        except linalg.LinAlgError:
+            pass
+    return linalg.lu_solve, linalg.lu_factor(K)
+
+
 def means(x):
     if x.ndim == 1:
         return x
@@ -869,8 +1390,14 @@ def inscore(data, o_nscore, doPlot=False):
     return d_out
 
 
-def variof1(x, icode=1, nt=None):
+class VarioF1(object):
     """
+    Variograms of gridded data computed with FFTs (Marcotte, 1996)
+
+    Real-to-complex transforms are planned once for a grid shape, the plans
+    and padded buffers are reused by all calls.  Several variables can be
+    processed at once, cross-variograms are then returned as well.
+
     @Article{marcotte96,
       Title                    = {Fast variogram computation with FFT},
       Author                   = {Marcotte, Denis},
@@ -883,72 +1410,147 @@ def variof1(x, icode=1, nt=None):
       DOI                      = {10.1016/S0098-3004(96)00026-X}
     }
     """
+    def __init__(self, shape, nt=1):
+        """
+        Input:
+            shape: shape (n, p) of the grids
+            nt: number of threads used by FFTW
+        """
+        self.shape = shape
+        n, p = shape
+
+        # find the closest multiple of 8 to obtain a good compromise between
+        # speed (a power of 2) and memory required
+        self.nr2 = int(np.ceil((2 * n - 1) / 8) * 8)
+        self.nc2 = int(np.ceil((2 * p - 1) / 8) * 8)
+
+        r = pyfftw.empty_aligned((self.nr2, self.nc2), dtype='float64')
+        c = pyfftw.empty_aligned((self.nr2, self.nc2 // 2 + 1), dtype='complex128')
+        self._fft = pyfftw.FFTW(r, c, axes=(0, 1), threads=nt)
+        r = pyfftw.empty_aligned((self.nr2, self.nc2), dtype='float64')
+        c = pyfftw.empty_aligned((self.nr2, self.nc2 // 2 + 1), dtype='complex128')
+        self._ifft = pyfftw.FFTW(c, r, axes=(0, 1), direction='FFTW_BACKWARD', threads=nt)
+
+    def __call__(self, x, icode=1):
+        """
+        Input:
+            x: n x p grid, or n x p x nv array of nv variables.  Missing
+               values are coded nan
+            icode: 1 for variograms, otherwise covariograms
+
+        Output:
+            gh: (2n-1) x (2p-1) map of the structural function, lag 0 at the
+                center, or (2n-1) x (2p-1) x nv x nv array of direct and cross
+                structural functions
+            nh: number of pairs, same shape as gh
+        """
+        single = x.ndim == 2
+        if single:
+            x = x[:, :, None]
+        if x.shape[:2] != self.shape:
+            raise ValueError('Grid shape inconsistent with VarioF1 instance')
+        nv = x.shape[2]
+
+        # indicator: True for data values, missing values are replaced by 0
+        xid = np.logical_not(np.isnan(x))
+        x = np.where(xid, x, 0.0)
+        fx = [self._forward(x[:, :, i]) for i in range(nv)]
+        fxid = [self._forward(xid[:, :, i]) for i in range(nv)]
+
+        gh = np.empty((2 * self.shape[0] - 1, 2 * self.shape[1] - 1, nv, nv))
+        nh = np.empty(gh.shape)
+        for i in range(nv):
+            for j in range(nv):
+                if icode == 1 and j < i:
+                    # cross-variograms are symmetric
+                    gh[:, :, i, j] = gh[:, :, j, i]
+                    nh[:, :, i, j] = nh[:, :, j, i]
+                    continue
+
+                if i == j or np.array_equal(xid[:, :, i], xid[:, :, j]):
+                    fid, fxi, fxj = fxid[i], fx[i], fx[j]
+                    xij = x[:, :, i] * x[:, :, j]
+                else:
+                    # pairs where both variables are known
+                    idij = np.logical_and(xid[:, :, i], xid[:, :, j])
+                    fid = self._forward(idij)
+                    fxi = self._forward(x[:, :, i] * idij)
+                    fxj = self._forward(x[:, :, j] * idij)
+                    xij = x[:, :, i] * x[:, :, j] * idij
+
+                # compute number of pairs at all lags
+                nhij = np.round(self._inverse(np.conj(fid) * fid))
+
+                # compute the different structural functions according to icode
+                if icode == 1:                                  # variogram is computed
+                    fxij = self._forward(xij)
+                    g = self._inverse(np.conj(fid) * fxij + np.conj(fxij) * fid -
+                                      np.conj(fxi) * fxj - np.conj(fxj) * fxi)
+                    g = g / np.maximum(nhij, 1) / 2
+                else:                                           # covariogram is computed
+                    m1 = self._inverse(np.conj(fxi) * fid) / np.maximum(nhij, 1)   # compute tail mean
+                    m2 = self._inverse(np.conj(fid) * fxj) / np.maximum(nhij, 1)   # compute head mean
+                    g = self._inverse(np.conj(fxi) * fxj) / np.maximum(nhij, 1) - m1 * m2
+
+                gh[:, :, i, j] = self._center(g)
+                nh[:, :, i, j] = self._center(nhij)
+
+        if single:
+            return gh[:, :, 0, 0], nh[:, :, 0, 0]
+        return gh, nh
+
+    def _forward(self, a):
+        self._fft.input_array[:] = 0.0
+        self._fft.input_array[:a.shape[0], :a.shape[1]] = a
+        return self._fft().copy()
+
+    def _inverse(self, f):
+        self._ifft.input_array[:] = f
+        return self._ifft().copy()
+
+    def _center(self, a):
+        # reduce matrix to required size and shift so that the 0 lag appears
+        # at the center of the matrix
+        n, p = self.shape
+        nr2, nc2 = self.nr2, self.nc2
+        a = np.vstack((np.hstack((a[:n, :p], a[:n, nc2 - p + 1:nc2])),
+                       np.hstack((a[nr2 - n + 1:nr2, :p], a[nr2 - n + 1:nr2, nc2 - p + 1:nc2]))))
+        return np_fft.fftshift(a)
+
+
+# VarioF1 instances (FFT plans) of the last grid shapes used by variof1
+variof1_cache = LRUCache(4)
+
+
+def variof1(x, icode=1, nt=None):
+    """
+    Variogram (icode=1) or covariogram map of gridded data x, see VarioF1
+
+    FFT plans are kept for the last grid shapes, repeated calls on grids of
+    the same shape do not plan again.
+    """
     if nt is None:
         import multiprocessing
         try:
-            nt = int(multiprocessing.cpu_count() / 2)
+            nt = max(1, int(multiprocessing.cpu_count() / 2))
         except NotImplementedError:
             nt = 1
 
-    x1 = x.copy()
-    n, p = x1.shape
-    nrows = 2 * n - 1
-    ncols = 2 * p - 1
-
-    # find the closest multiple of 8 to obtain a good compromise between
-    # speed (a power of 2) and memory required
+    key = (x.shape[:2], nt)
+    vf = variof1_cache.get(key)
+    if vf is None:
+        vf = VarioF1(x.shape[:2], nt)
+        variof1_cache[key] = vf
+    return vf(x, icode)
 
-    nr2 = int(np.ceil(nrows / 8) * 8)
-    nc2 = int(np.ceil(ncols / 8) * 8)
 
-    # form an indicator  matrix:                         1's for all data values
-    #                                                     0's for missing values
-    # in data matrix, replace missing values by 0
-
-    x1id = np.logical_not(np.isnan(x1))         # 1 for a data value; 0 for missing
-    x1[np.logical_not(x1id)] = 0.0              # missing replaced by 0
-
-    fx1 = np_fft.fft2(x1, [nr2, nc2], threads=nt)              # fourier transform of x1
-
-    if icode == 1:
-        fx1_x1 = np_fft.fft2(x1 * x1, [nr2, nc2], threads=nt)  # fourier transform of x1*x1
-
-    fx1id = np_fft.fft2(x1id, [nr2, nc2], threads=nt)          # fourier transform of the indicator matrix
-
-    # compute number of pairs at all lags
-
-    nh11 = np.round(np.real(np_fft.ifft2(np.conj(fx1id) * fx1id, threads=nt)))
-
-    # compute the different structural functions according to icode
-
-    if icode == 1:                                       # variogram is computed
-        gh11 = np.real(np_fft.ifft2(np.conj(fx1id) * fx1_x1 + np.conj(fx1_x1) * fx1id - 2 * np.conj(fx1) * fx1, threads=nt))
-        gh11 = gh11 / np.maximum(nh11, 1) / 2
-
-    else:                                                # covariogram is computed
-
-        m1 = np.real(np_fft.ifft2(np.conj(fx1) * fx1id), threads=nt) / np.maximum(nh11, 1)   # compute tail mean
-        m2 = np.real(np_fft.ifft2(np.conj(fx1id) * fx1), threads=nt) / np.maximum(nh11, 1)   # compute head mean
-
-        gh11 = np.real(np_fft.ifft2(np.conj(fx1) * fx1, threads=nt))
-        gh11 = gh11 / np.maximum(nh11, 1) - m1 * m2
-
-    # reduce matrix to required size and shift so that the 0 lag appears at the center of each matrix
-    nh11 = np.vstack((np.hstack((nh11[:n, :p], nh11[:n, nc2 - p + 1:nc2])),
-                      np.hstack((nh11[nr2 - n + 1:nr2, :p], nh11[nr2 - n + 1:nr2, nc2 - p + 1:nc2]))))
-    gh11 = np.vstack((np.hstack((gh11[:n, :p], gh11[:n, nc2 - p + 1:nc2])),
-                      np.hstack((gh11[nr2 - n + 1:nr2, :p], gh11[nr2 - n + 1:nr2, nc2 - p + 1:nc2]))))
-
-    gh11 = np_fft.fftshift(gh11)
-    nh11 = np_fft.fftshift(nh11)
-
-    return gh11, nh11
-
-
-def varioexp2d(x, y, v, nbclas, lclas, vdir, vtol, bandwidth):
+def varioexp2d(x, y, v, nbclas, lclas, vdir, vtol, bandwidth, tree=False):
     """
     Experimental variogram in 2D
 
+    Pairs are formed by blocks of rows (at most block_size pairs x directions
+    at once), all directions and lag classes are processed together.
+
     INPUT
         x : X coordinates   (nv,)
         y : Y coordinates   (nv,)
@@ -959,6 +1561,9 @@ def varioexp2d(x, y, v, nbclas, lclas, vdir, vtol, bandwidth):
         vdir   : directions (azimuth)  (deg)
         vtol   : tolerance angle (90° for omni-directional variogram) (deg)
         bandwidth : ignored if vtol >= 90°
+        tree   : if True, only pairs closer than the largest lag are formed,
+                    they are found with a KD-tree (faster when the largest lag
+                    is small compared to the extent of the data)
 
     OUTPUT
         gexp : 3d array of size nclas x 3 x ndir
@@ -979,40 +1584,69 @@ def varioexp2d(x, y, v, nbclas, lclas, vdir, vtol, bandwidth):
     gexp = np.zeros((ncl, 3, ndir))
     u = _poletocart(np.vstack((vdir, np.zeros((ndir,)))).T)
     tol = np.cos(vtol * np.pi / 180)
+    directional = vtol < 90.0
+    bandwidth = np.where(directional, bandwidth, np.inf)
+    unorm = np.sqrt(u[:, 0] * u[:, 0] + u[:, 1] * u[:, 1])
+
+    # contiguous classes are found by bisection, otherwise each class is
+    # tested in turn (classes may overlap)
+    contiguous = np.all(lclas[1:, 0] == lclas[:-1, 1]) and np.all(lclas[:, 1] > lclas[:, 0])
+    edges = np.hstack((lclas[0, 0], lclas[:, 1]))
+    hmax = np.max(lclas[:, 1])
+
+    if tree:
+        xy = np.vstack((x, y)).T
+        kdt = cKDTree(xy)
+    nb = max(1, block_size // max(1, n * ndir))
+    for i0 in range(0, n - 1, nb):
+        i1 = min(i0 + nb, n - 1)
+
+        # pairs (i, j) with i in block and j > i
+        if tree:
+            sdm = cKDTree(xy[i0:i1]).sparse_distance_matrix(kdt, hmax * (1 + 1.e-12),
+                                                            output_type='ndarray')
+            i = sdm['i'] + i0
+            j = sdm['j']
+            keep = j > i
+            i = i[keep]
+            j = j[keep]
+        else:
+            i, j = np.nonzero(np.arange(i0, i1)[:, None] < np.arange(n))
+            i += i0
 
-    for i in range(n - 1):
-        yt = np.vstack((i + np.zeros((n - i - 1, ), dtype=int), np.arange(i + 1, n, dtype=int))).T
-
-        dx = x[yt[:, 1]] - x[yt[:, 0]]
-        dy = y[yt[:, 1]] - y[yt[:, 0]]
+        dx = x[j] - x[i]
+        dy = y[j] - y[i]
         ht = np.sqrt(dx * dx + dy * dy)
 
-        uobs = np.zeros((dx.shape[0], 3))
-        uobs[:, 0] = dx / ht
-        uobs[:, 1] = dy / ht
-
-        for idir in range(ndir):
-
-            da = np.dot(uobs, u[idir, :].T)
-            if vtol[idir] < 90.0:
-                # compute distance between pts and azimuth line
-                c = -(u[idir, 0] * x[i] + u[idir, 1] * y[i])
-                dist = (np.abs(u[idir, 0] * x[yt[:, 1]] + u[idir, 1] * y[yt[:, 1]] + c) /
-                        np.sqrt(u[idir, 0] * u[idir, 0] + u[idir, 1] * u[idir, 1]))
-                ind = np.logical_and(np.abs(da) >= tol[idir], dist < bandwidth[idir])
-            else:
-                ind = np.abs(da) >= tol[idir]
-
-            h = ht[ind]
-            yy = yt[ind, :]
-
-            var = 0.5 * (v[yy[:, 0]] - v[yy[:, 1]])**2
-
+        # pairs beyond the largest lag fall in no class
+        near = ht <= hmax
+        dx = dx[near]
+        dy = dy[near]
+        ht = ht[near]
+        var = 0.5 * (v[i[near]] - v[j[near]])**2
+
+        # projections on all directions, pairs at zero distance are rejected
+        proj = np.outer(dx, u[:, 0]) + np.outer(dy, u[:, 1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            da = proj / ht[:, None]
+        ind = np.logical_and(np.abs(da) >= tol, np.abs(proj) / unorm < bandwidth)
+
+        if contiguous:
+            ic = np.digitize(ht, edges, right=True) - 1
+            valid = np.logical_and(ic >= 0, ic < ncl)
+            ind = np.logical_and(ind, valid[:, None])
+            k = (ic[:, None] + ncl * np.arange(ndir))[ind]
+            w = np.broadcast_to(ht[:, None], ind.shape)[ind]
+            gexp[:, 1, :] += np.bincount(k, minlength=ncl * ndir).reshape(ndir, ncl).T
+            gexp[:, 0, :] += np.bincount(k, weights=w, minlength=ncl * ndir).reshape(ndir, ncl).T
+            w = np.broadcast_to(var[:, None], ind.shape)[ind]
+            gexp[:, 2, :] += np.bincount(k, weights=w, minlength=ncl * ndir).reshape(ndir, ncl).T
+        else:
             for ic in range(ncl):
-                ind = np.logical_and(h > lclas[ic, 0], h <= lclas[ic, 1])
-                gexp[ic, 1, idir] += np.sum(ind)
-                gexp[ic, 0, idir] += np.sum(h[ind])
-                gexp[ic, 2, idir] += np.sum(var[ind])
+                inc = np.logical_and(ind, np.logical_and(ht > lclas[ic, 0], ht <= lclas[ic, 1])[:, None])
+                gexp[ic, 1, :] += np.sum(inc, axis=0)
+                gexp[ic, 0, :] += np.dot(ht, inc)
+                gexp[ic, 2, :] += np.dot(var, inc)
 
     for idir in range(ndir):
         ind = gexp[:, 1, idir] > 0
@@ -1031,62 +1665,91 @@ def _poletocart(pole):
     return x
 
 
-def computeJ(L, e): 
+def computeJ(L, e):
+    """
+    Jacobian of traveltimes with respect to slowness and anisotropy ratio
+    (elliptical anisotropy)
 
-    nt = L.shape[0]
-    np_ = L.shape[1] / 2
+    Input:
+        L: ray segment lengths along x and z (nt x 2np, sparse or dense)
+        e: model vector [s, xi] (2np elements)
 
-    J = L.power(2)
-    Js = J[:, 0:np_] + J[:, (np_):].multiply(np.kron(np.ones([nt, 1]), (e[int(np_):]**2).T))  # l_x**2 + l_z**2 * xi**2
-    Js = np.sqrt(Js)  # equals to t / s_x
+    Output:
+        J: Jacobian [dt/ds, dt/dxi] (nt x 2np, CSR)
+    """
+    L = csr_matrix(L)
+    np_ = L.shape[1] // 2
+    e = np.asarray(e, dtype=np.float64).ravel()
+    s = e[0:np_]
+    xi = e[np_:2 * np_]
 
-    Jxi = J[:, int(np_):].multiply(np.kron(np.ones([nt, 1]), (e[0:int(np_)]).T) * np.kron(np.ones([nt, 1]), (e[int(np_):]).T))
+    Lx2 = L[:, 0:np_].power(2)
+    Lz2 = L[:, np_:].power(2)
 
-    ind = Js != 0
-    Jxi = Jxi.tocsr()
-    Jxi[ind] = Jxi[ind] / Js[ind]
+    Js = (Lx2 + Lz2.dot(_diag(xi**2))).sqrt()  # l_x**2 + l_z**2 * xi**2, equals to t / s_x
+    Jxi = Lz2.dot(_diag(s * xi)).multiply(_inverse(Js))
 
-    J = np.concatenate([Js.toarray(), Jxi.toarray()],axis=1)
-    return J
+    return _hstack([Js, Jxi])
 
 
-def computeJ2(L, e):  # TODO Products may need to be replaced by *.dot's
+def computeJ2(L, e):
+    """
+    Jacobian of traveltimes with respect to slowness, anisotropy ratio and
+    tilt angle (tilted elliptical anisotropy)
 
-    nt = L.shape[0]
-    np_ = L.shape[1] / 2
+    Input:
+        L: ray segment lengths along x and z (nt x 2np, sparse or dense)
+        e: model vector [s, xi, theta] (3np elements)
 
-    n = len(e) / 3
+    Output:
+        J: Jacobian [dt/ds, dt/dxi, dt/dtheta] (nt x 3np, CSR)
+    """
+    L = csr_matrix(L)
+    np_ = L.shape[1] // 2
+    e = np.asarray(e, dtype=np.float64).ravel()
 
-    if np_ != n:
+    if 3 * np_ != e.size:
         raise ValueError("Error (computeJ2) - L et e sizes not compatible")
 
-    s = (e[0:int(n)]).T
-    xi = (e[int(n):(2 * int(n))]).T
-    theta = (e[(2 * int(n)):(3 * int(n))]).T
+    s = e[0:np_]
+    xi = e[np_:2 * np_]
+    theta = e[2 * np_:3 * np_]
+
+    co = _diag(np.cos(theta))
+    si = _diag(np.sin(theta))
+
+    Lx = L[:, 0:np_]
+    Lz = L[:, np_:]
+
+    Lb2 = (Lx.dot(si) - Lz.dot(co)).power(2)
+    Js = ((Lx.dot(co) + Lz.dot(si)).power(2) + Lb2.dot(_diag(xi**2))).sqrt()
+    iJs = _inverse(Js)
 
-    co = np.cos(theta)
-    si = np.sin(theta)
+    Jxi = Lb2.dot(_diag(s * xi)).multiply(iJs)
 
-    tmp = (L[:, 0:np_].multiply(np.kron(np.ones([nt, 1]), co)) + L[:, np_:].multiply(np.kron(np.ones([nt, 1]), si))).power(2)
-    tmp = tmp + (L[:, 0:np_].multiply(np.kron(np.ones([nt, 1]), si)) - L[:, np_:].multiply(np.kron(np.ones([nt, 1]), co))).power(2).multiply(np.kron(np.ones([nt, 1]), xi**2))
-    Js = np.sqrt(tmp)
+    tmp = (Lx.power(2) - Lz.power(2)).dot(_diag(np.sin(2 * theta))) - 2 * Lx.multiply(Lz).dot(_diag(np.cos(2 * theta)))
+    Jtheta = tmp.dot(_diag(s * (xi**2 - 1))).multiply(iJs)
 
-    tmp = (L[:, 0:np_].multiply(np.kron(np.ones([nt, 1]), si)) - L[:, np_:].multiply(np.kron(np.ones([nt, 1]), co))).power(2)
-    Jxi = np.kron(np.ones([nt, 1]), s) * (np.kron(np.ones([nt, 1]), xi)) * tmp.toarray()
+    return _hstack([Js, Jxi, Jtheta])
 
-    Js = Js.toarray()
-    ind = (Js != 0)
-    Jxi[ind] = Jxi[ind] / Js[ind]
 
-    tmp = L[:, 0:np_].power(2) - L[:, np_:].power(2)
-    tmp = tmp.multiply(np.kron(np.ones([nt, 1]), np.sin(2 * theta)))
-    tmp = tmp - 2 * L[:, 0:np_].multiply(L[:, np_:].multiply(np.kron(np.ones([nt, 1]), np.cos(2 * theta))))
-    Jtheta = tmp.multiply(np.kron(np.ones([nt, 1]), s)).multiply(np.kron(np.ones([nt, 1]), (xi**2 - 1)))
+def _diag(v):
+    return sp.diags(v, format='csr')
+
+
+def _inverse(A):
+    """
+    Elementwise inverse of the nonzero entries of sparse matrix A
+    """
+    A = csr_matrix(A, copy=True)
+    A.eliminate_zeros()
+    A.data = 1.0 / A.data
+    return A
 
-    Jtheta = Jtheta.toarray()
-    Jtheta[ind] = Jtheta[ind] / Js[ind]
 
-    J = np.concatenate([Js, Jxi, Jtheta],axis = 1)
+def _hstack(blocks):
+    J = sp.hstack(blocks, format='csr')
+    J.eliminate_zeros()
     return J
 
 
@@ -1297,7 +1960,8 @@ if __name__ == '__main__':
                       [0.0, 20.0],
                       [0.0, 25.0]])
 
-        k2 = cm.computeK(x, 2, 3)
+        # first 3 points against all points (last 2 columns equal k1)
+        k2 = cm.compute(x[:3], x)
 
         print(k1)
         print(k2)
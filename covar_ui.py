@@ -31,7 +31,6 @@ from utils import ComputeThread
 from sqlalchemy.orm.attributes import flag_modified
 from copy import deepcopy
 from math import ceil
-from scipy.optimize import fmin
 
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 # from mpl_toolkits.mplot3d import axes3d
@@ -56,7 +55,9 @@ class CovarUI(QtWidgets.QFrame):
                            # more than once
     idata = None           # idem.
     L = None               # ray matrix
-    Cd = None              # experimental covariance
+    dt = None              # traveltime residuals, the experimental covariance is dt*dt.T
+    covar_fit = None       # covar.CovarianceFit instance of the current data, rays and grid,
+    covar_fit_key = None   # and the settings it was built with
     xc = None              # grid's centers
 
     triggerFctAdjustCov = QtCore.pyqtSignal() # Signal to update Popup while computing adjustCov
@@ -589,129 +590,58 @@ class CovarUI(QtWidgets.QFrame):
 
     def adjust(self):
         cm = self.current_covar()
-        global ix
-        global x0
-        ix = 0
-        x0 = np.zeros(100)
-        ns = len(cm.covar)
-        def ifNotChekedAddToXi(checkbox,valueToAdd):
-            """
-            Function to simplify the code below.
-            If the checkbox 'Fix' for the specify value isn't checked, add the value to the array.
-            """
-            global ix
-            global x0
-            if not checkbox.isChecked():
-                    x0[ix] = valueToAdd
-                    ix += 1
-        for n in range(0,ns):
-            _covar = cm.covar[n]
-            if len(_covar.range) == 2: 
-                ifNotChekedAddToXi(self.slowness_range_X_checkbox,_covar.range[0]) # Add Range X
-                ifNotChekedAddToXi(self.slowness_range_Z_checkbox,_covar.range[1]) # Add Range Z
-                ifNotChekedAddToXi(self.slowness_theta_X_checkbox,_covar.angle[0]) # Add Angle Theta X
-                ifNotChekedAddToXi(self.slowness_sill_checkbox,_covar.sill) # Add Sill
-            elif len(_covar.range) == 3: 
-                ifNotChekedAddToXi(self.slowness_3D_range_X_checkbox,_covar.range[0]) # Add 3D Range X
-                ifNotChekedAddToXi(self.slowness_3D_range_Y_checkbox,_covar.range[1]) # Add 3D Range Y
-                ifNotChekedAddToXi(self.slowness_3D_range_Z_checkbox,_covar.range[2]) # Add 3D Range Z
-                ifNotChekedAddToXi(self.slowness_3D_theta_X_checkbox,_covar.angle[0]) # Add Angle Theta X
-                ifNotChekedAddToXi(self.slowness_3D_theta_Y_checkbox,_covar.angle[1]) # Add Angle Theta Y
-                ifNotChekedAddToXi(self.slowness_3D_theta_Z_checkbox,_covar.angle[2]) # Add Angle Theta Z
-                ifNotChekedAddToXi(self.slowness_3D_sill_checkbox,_covar.sill) # Add Sill
+        free = []
 
-            if self.ellip_veloc_checkbox.isChecked():
-                # TODO : add 3D support
-                _covar_xi = cm.covar_xi[n]
-                if len(_covar.range) == 2: 
-                    ifNotChekedAddToXi(self.xi_range_X_checkbox,_covar_xi.range[0]) # Add xi Range X
-                    ifNotChekedAddToXi(self.xi_range_Z_checkbox,_covar_xi.range[1]) # Add xi Range Z
-                    ifNotChekedAddToXi(self.xi_theta_X_checkbox,_covar_xi.angle[0]) # Add xi Angle Theta X
-                    ifNotChekedAddToXi(self.xi_sill_checkbox,_covar_xi.sill) # Add xi Sill
-                if self.tilted_ellip_veloc_checkbox.isChecked():
-                    _covar_tilt = cm.covar_tilt[n]
-                    if len(_covar.range) == 2: 
-                        ifNotChekedAddToXi(self.tilt_range_X_checkbox,_covar_tilt.range[0]) # Add tilt Range X
-                        ifNotChekedAddToXi(self.tilt_range_Z_checkbox,_covar_tilt.range[1]) # Add tilt Range Z
-                        ifNotChekedAddToXi(self.tilt_theta_X_checkbox,_covar_tilt.angle[0]) # Add tilt Angle Theta X
-                        ifNotChekedAddToXi(self.tilt_sill_checkbox,_covar_tilt.sill) # Add tilt Sill
-        # Adding nugget effect
-        ifNotChekedAddToXi(self.slowness_checkbox,cm.nugget_model) # Add slowness for the slowness covariance / amplitude for the amplitude covariance
-        ifNotChekedAddToXi(self.tt_checkbox,cm.nugget_data) # Add traveltime for the slowness covariance / tau for the amplitude covariance
-        if self.ellip_veloc_checkbox.isChecked():
-            ifNotChekedAddToXi(self.xi_checkbox,cm.nugget_xi) # Add nugget xi
-        if self.tilted_ellip_veloc_checkbox.isChecked():
-            ifNotChekedAddToXi(self.tilt_checkbox,cm.nugget_tilt) # Add nugget tilt
-
-        x0 = x0[:ix]
-        fmin(func=self.adjustCov,x0 = x0,xtol = 1e-12,ftol = 1e-12,maxiter=int(self.Iter_edit.text()), maxfun = int(self.Iter_edit.text()),disp = 0)
- 
-    def adjustCov(self, x0):
-        cm = self.current_covar()
-        global ix
-        ix = -1
-        ns = len(cm.covar)
-        def ifNotChekedChangeVariable(checkbox,VariableToChange):
+        def ifNotCheckedAddToFree(checkbox, parameter):
             """
             Function to simplify the code below.
-            If the checkbox 'Fix' for the specify value isn't checked, return the modified value.
+            If the checkbox 'Fix' for the specify value isn't checked, the parameter is adjusted.
             """
-            global ix
             if not checkbox.isChecked():
-                    ix += 1
-                    return x0[ix]
-            else:
-                    return VariableToChange
-        for n in range(0,ns):
+                free.append(parameter)
+
+        for n in range(0, len(cm.covar)):
             _covar = cm.covar[n]
-            if len(_covar.range) == 2: 
-                _covar.range[0] = ifNotChekedChangeVariable(self.slowness_range_X_checkbox,_covar.range[0]) # Add Range X
-                _covar.range[1] = ifNotChekedChangeVariable(self.slowness_range_X_checkbox,_covar.range[1]) # Add Range Z
-                _covar.angle[0] = ifNotChekedChangeVariable(self.slowness_theta_X_checkbox,_covar.angle[0]) # Add Angle Theta X
-                _covar.sill = ifNotChekedChangeVariable(self.slowness_sill_checkbox,_covar.sill) # Add Sill
-            elif len(_covar.range) == 3: 
-                _covar.range[0] = ifNotChekedChangeVariable(self.slowness_3D_range_X_checkbox,_covar.range[0]) # Add 3D Range X
-                _covar.range[1] = ifNotChekedChangeVariable(self.slowness_3D_range_Y_checkbox,_covar.range[1]) # Add 3D Range Y
-                _covar.range[2] = ifNotChekedChangeVariable(self.slowness_3D_range_Z_checkbox,_covar.range[2]) # Add 3D Range Z
-                _covar.angle[0] = ifNotChekedChangeVariable(self.slowness_3D_theta_X_checkbox,_covar.angle[0]) # Add Angle Theta X
-                _covar.angle[1] = ifNotChekedChangeVariable(self.slowness_3D_theta_Y_checkbox,_covar.angle[1]) # Add Angle Theta Y
-                _covar.angle[2] = ifNotChekedChangeVariable(self.slowness_3D_theta_Z_checkbox,_covar.angle[2]) # Add Angle Theta Z
-                _covar.sill = ifNotChekedChangeVariable(self.slowness_3D_sill_checkbox,_covar.sill) # Add Sill
+            if len(_covar.range) == 2:
+                ifNotCheckedAddToFree(self.slowness_range_X_checkbox, ('covar', n, 'range', 0))  # Range X
+                ifNotCheckedAddToFree(self.slowness_range_Z_checkbox, ('covar', n, 'range', 1))  # Range Z
+                ifNotCheckedAddToFree(self.slowness_theta_X_checkbox, ('covar', n, 'angle', 0))  # Angle Theta X
+                ifNotCheckedAddToFree(self.slowness_sill_checkbox, ('covar', n, 'sill'))  # Sill
+            elif len(_covar.range) == 3:
+                ifNotCheckedAddToFree(self.slowness_3D_range_X_checkbox, ('covar', n, 'range', 0))  # 3D Range X
+                ifNotCheckedAddToFree(self.slowness_3D_range_Y_checkbox, ('covar', n, 'range', 1))  # 3D Range Y
+                ifNotCheckedAddToFree(self.slowness_3D_range_Z_checkbox, ('covar', n, 'range', 2))  # 3D Range Z
+                ifNotCheckedAddToFree(self.slowness_3D_theta_X_checkbox, ('covar', n, 'angle', 0))  # Angle Theta X
+                ifNotCheckedAddToFree(self.slowness_3D_theta_Y_checkbox, ('covar', n, 'angle', 1))  # Angle Theta Y
+                ifNotCheckedAddToFree(self.slowness_3D_theta_Z_checkbox, ('covar', n, 'angle', 2))  # Angle Theta Z
+                ifNotCheckedAddToFree(self.slowness_3D_sill_checkbox, ('covar', n, 'sill'))  # Sill
 
             if self.ellip_veloc_checkbox.isChecked():
                 # TODO : add 3D support
-                _covar_xi = cm.covar_xi[n]
-                if len(_covar.range) == 2: 
-                    _covar_xi.range[0] = ifNotChekedChangeVariable(self.xi_range_X_checkbox,_covar_xi.range[0]) # Add xi Range X
-                    _covar_xi.range[1] = ifNotChekedChangeVariable(self.xi_range_Z_checkbox,_covar_xi.range[1]) # Add xi Range Z
-                    _covar_xi.angle[0] = ifNotChekedChangeVariable(self.xi_theta_X_checkbox,_covar_xi.angle[0]) # Add xi Angle Theta X
-                    _covar_xi.sill = ifNotChekedChangeVariable(self.xi_sill_checkbox,_covar_xi.sill) # Add xi Sill
+                if len(_covar.range) == 2:
+                    ifNotCheckedAddToFree(self.xi_range_X_checkbox, ('covar_xi', n, 'range', 0))  # xi Range X
+                    ifNotCheckedAddToFree(self.xi_range_Z_checkbox, ('covar_xi', n, 'range', 1))  # xi Range Z
+                    ifNotCheckedAddToFree(self.xi_theta_X_checkbox, ('covar_xi', n, 'angle', 0))  # xi Angle Theta X
+                    ifNotCheckedAddToFree(self.xi_sill_checkbox, ('covar_xi', n, 'sill'))  # xi Sill
                 if self.tilted_ellip_veloc_checkbox.isChecked():
-                    _covar_tilt = cm.covar_tilt[n]
-                    if len(_covar.range) == 2: 
-                        _covar_tilt.range[0] = ifNotChekedChangeVariable(self.tilt_range_X_checkbox,_covar_tilt.range[0]) # Add tilt Range X
-                        _covar_tilt.range[1] = ifNotChekedChangeVariable(self.tilt_range_Z_checkbox,_covar_tilt.range[1]) # Add tilt Range Z
-                        _covar_tilt.angle[0] = ifNotChekedChangeVariable(self.tilt_theta_X_checkbox,_covar_tilt.angle[0]) # Add tilt Angle Theta X
-                        _covar_tilt.sill = ifNotChekedChangeVariable(self.tilt_sill_checkbox,_covar_tilt.sill) # Add tilt Sill
+                    if len(_covar.range) == 2:
+                        ifNotCheckedAddToFree(self.tilt_range_X_checkbox, ('covar_tilt', n, 'range', 0))  # tilt Range X
+                        ifNotCheckedAddToFree(self.tilt_range_Z_checkbox, ('covar_tilt', n, 'range', 1))  # tilt Range Z
+                        ifNotCheckedAddToFree(self.tilt_theta_X_checkbox, ('covar_tilt', n, 'angle', 0))  # tilt Angle Theta X
+                        ifNotCheckedAddToFree(self.tilt_sill_checkbox, ('covar_tilt', n, 'sill'))  # tilt Sill
 
         # Adding nugget effect
-        cm.nugget_model = ifNotChekedChangeVariable(self.slowness_checkbox,cm.nugget_model) # Add slowness for the slowness covariance / amplitude for the amplitude covariance
-        cm.nugget_data = ifNotChekedChangeVariable(self.tt_checkbox,cm.nugget_data) # Add traveltime for the slowness covariance / tau for the amplitude covariance
+        ifNotCheckedAddToFree(self.slowness_checkbox, ('nugget_model',))  # slowness for the slowness covariance / amplitude for the amplitude covariance
+        ifNotCheckedAddToFree(self.tt_checkbox, ('nugget_data',))  # traveltime for the slowness covariance / tau for the amplitude covariance
         if self.ellip_veloc_checkbox.isChecked():
-            cm.nugget_xi = ifNotChekedChangeVariable(self.xi_checkbox,cm.nugget_xi) # Add nugget xi
+            ifNotCheckedAddToFree(self.xi_checkbox, ('nugget_xi',))  # nugget xi
         if self.tilted_ellip_veloc_checkbox.isChecked():
-            cm.nugget_tilt = ifNotChekedChangeVariable(self.tilt_checkbox,cm.nugget_tilt) # Add nugget tilt
+            ifNotCheckedAddToFree(self.tilt_checkbox, ('nugget_tilt',))  # nugget tilt
 
-        g, gt = self.calculate()
-
-        _q = np.flip(np.arange(1,len(g) + 1) ** 2,axis = 0)
-        _q = (_q / (np.max(_q))) + 1
-        g = g[:len(_q)]
-        gt = gt[:len(_q)]
-        
-        self.triggerFctAdjustCov.emit()
-
-        return sum(((gt-g)*_q)**2)
+        # everything that does not depend on the covariance parameters is set up once
+        self.apply_booleans()
+        self.covarianceFit(cm).fit(cm, free, maxiter=int(self.Iter_edit.text()),
+                                   callback=self.triggerFctAdjustCov.emit)
 
     def fix_verif(self):
         if self.model.grid.type == '2D' or self.model.grid.type == '2D+':
@@ -790,21 +720,22 @@ class CovarUI(QtWidgets.QFrame):
 
     def computeCd(self):
         # Computes experimental covariance
-        nt = self.L.shape[0]
-
         if not self.ellip_veloc_checkbox.isChecked():
-            s0 = np.mean(self.data[:, 0] / np.sum(self.L.toarray(), 1))
-            mta = s0 * np.sum(self.L, 1).getA()  # mean traveltime
+            lsum = np.asarray(self.L.sum(axis=1)).ravel()  # L is not densified
+            s0 = np.mean(self.data[:, 0] / lsum)
+            mta = s0 * lsum.reshape((-1, 1))  # mean traveltime
         else:
-            np_ = self.L.shape[1] / 2
+            np_ = self.L.shape[1] // 2
             l = np.sqrt(self.L[:, 0:np_].power(2) + self.L[:, np_:].power(2))
-            s0 = np.mean(self.data[:, 0] / np.sum(l, 1))
-            mta = s0 * np.sum(l, 1).getA()
+            lsum = np.asarray(l.sum(axis=1)).ravel()
+            s0 = np.mean(self.data[:, 0] / lsum)
+            mta = s0 * lsum.reshape((-1, 1))
 
         dt = self.data[:, 0].reshape((-1, 1)) - mta
 
-        self.Cd = dt.dot(dt.T)
-        self.Cd = self.Cd.reshape((nt ** 2, ), order='F')
+        # the experimental covariance is dt.dot(dt.T), it is not formed
+        self.dt = dt.ravel()
+        self.covar_fit = None
 
     def compute(self):
         self.progress_lbl.setText("Computing.\nPlease wait...")
@@ -818,59 +749,39 @@ class CovarUI(QtWidgets.QFrame):
     def calculate(self):
         self.apply_booleans()
         if self.model.grid.type == '2D' or self.model.grid.type == '2D+':
-            xc = self.temp_grid.getCellCenter()
-            cm = self.current_covar()
-            Cm = cm.compute(xc, xc)
-
-            s = (self.data[:, 0].reshape(-1) / np.sum(self.L, 1).reshape(-1)).T
-            s0 = np.mean(s)
-
-            if cm.use_xi:
-                if cm.use_tilt:
-                    np_ = self.L.shape[1] / 2
-                    l = np.sqrt(self.L[:, 0:np_].power(2) + self.L[:, (np_):].power(2))
-                    s0 = np.mean(self.data[:, 0] / np.sum(l, 1)) + np.zeros([int(np_), 1])
-                    xi0 = np.ones([int(np_), 1]) + 0.001       # add 1/1000 so that J_th != 0
-                    theta0 = np.zeros([int(np_), 1]) + 0.0044  # add a quarter of a degree so that J_th != 0
-                    J = covar.computeJ2(self.L, np.concatenate([s0, xi0, theta0]))
-                    Cm = J.dot(np.dot(Cm.toarray(), J.T))
-                else:
-                    np_ = self.L.shape[1] / 2
-                    l = np.sqrt(self.L[:, 0:np_].power(2) + self.L[:, (np_):].power(2))
-                    s0 = np.mean(self.data[:, 0] / np.sum(l, 1)) + np.zeros([int(np_), 1])
-                    xi0 = np.ones([int(np_), 1])
-                    J = covar.computeJ(self.L, np.concatenate([s0, xi0]))
-                    Cm = J.dot(np.dot(Cm.toarray(), J.T))
-            else:
-                Cm = self.L.dot(Cm.dot(self.L.T.toarray()))
+            return self.covarianceFit(self.current_covar()).curves(self.current_covar())
 
-            if cm.use_c0:
-                # use exp variance
-                c0 = self.data[:, 1] ** 2
-                Cm += cm.nugget_data * np.diag(c0)
+    def covarianceFit(self, cm):
+        """
+        Returns the covar.CovarianceFit instance for the current data and rays,
+        built once and reused until data, rays, grid or bin settings change
+        """
+        key = (tuple(self.temp_grid.getNcell()), tuple(self.temp_grid.getCellSize()),
+               cm.use_xi, cm.use_tilt, cm.use_c0,
+               int(self.bin_edit.text()), float(self.bin_frac_edit.text()))
+        if self.covar_fit is not None and key == self.covar_fit_key:
+            return self.covar_fit
+
+        if cm.use_xi:
+            np_ = self.L.shape[1] // 2
+            l = np.sqrt(self.L[:, 0:np_].power(2) + self.L[:, np_:].power(2))
+            s0 = np.mean(self.data[:, 0] / np.asarray(l.sum(1)).ravel()) + np.zeros([np_, 1])
+            if cm.use_tilt:
+                xi0 = np.ones([np_, 1]) + 0.001       # add 1/1000 so that J_th != 0
+                theta0 = np.zeros([np_, 1]) + 0.0044  # add a quarter of a degree so that J_th != 0
+                G = covar.computeJ2(self.L, np.concatenate([s0, xi0, theta0]))
             else:
-                Cm += cm.nugget_data * np.eye(self.L.shape[0])
-
-            Cm = Cm.flatten()
-            ind = np.argsort(Cm)
-            ind = ind[::-1]
-            Cm = Cm[ind]
-            lclas = int(self.bin_edit.text())
-            afi = float(self.bin_frac_edit.text())
-
-            gt = covar.moy_bloc(Cm, lclas)
-            ind0 = np.where(gt < np.inf)
-            gt = gt[ind0].T
-
-            g = self.Cd[ind]
-            g = covar.moy_bloc(g, lclas)
-            g = g[ind0].T
+                xi0 = np.ones([np_, 1])
+                G = covar.computeJ(self.L, np.concatenate([s0, xi0]))
+        else:
+            G = self.L
 
-            N = int(np.round(len(g) * afi))
-            g = g[0:N]
-            gt = gt[0:N]
+        c0 = self.data[:, 1] ** 2 if cm.use_c0 else None  # use exp variance
 
-            return g,gt
+        self.covar_fit = covar.CovarianceFit(G, self.dt, self.temp_grid.getNcell(), self.temp_grid.getCellSize(),
+                                             int(self.bin_edit.text()), float(self.bin_frac_edit.text()), c0)
+        self.covar_fit_key = key
+        return self.covar_fit
 
     def show_stats(self):
         if self.model is not None:
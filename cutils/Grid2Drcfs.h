@@ -0,0 +1,496 @@
+//
+//  Grid2Drcfs.h
+//  ttcr
+//
+//  Copyright © 2017 Bernard Giroux. All rights reserved.
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+/*
+ * Fast sweeping method on a rectilinear grid, slowness defined for cells
+ *
+ * Traveltimes are computed at the nodes of a grid obtained by dividing each
+ * cell in (nsnx+1) x (nsnz+1) subcells, nsnx and nsnz playing the same role as
+ * the number of secondary nodes of the shortest path method.  Raypaths are
+ * obtained by gradient descent of the traveltime field, from Rx to Tx, and
+ * traveltimes at Rx are computed along the raypaths.
+ *
+ * Reference paper
+ *
+ * @article{zhao2005,
+ *  author = {Hongkai Zhao},
+ *  title = {A fast sweeping method for eikonal equations},
+ *  journal = {Mathematics of Computation},
+ *  year = {2005},
+ *  volume = {74},
+ *  number = {250},
+ *  pages = {603-627},
+ *  doi = {10.1090/S0025-5718-04-01678-3}
+ * }
+ *
+ */
+
+#ifndef __GRID2DRCFS_H__
+#define __GRID2DRCFS_H__
+
+#include <algorithm>
+#include <cmath>
+#include <iostream>
+#include <limits>
+#include <map>
+#include <vector>
+
+#include "Grid2D.h"
+
+namespace ttcr {
+
+    template<typename T1, typename T2>
+    class Grid2Drcfs : public Grid2D<T1,T2,sxz<T1>> {
+    public:
+        Grid2Drcfs(const T2 nx, const T2 nz, const T1 ddx, const T1 ddz,
+                   const T1 minx, const T1 minz, const T2 nnx, const T2 nnz,
+                   const size_t nt=1, const T1 eps=1.e-12, const int maxit=20,
+                   const T2 ninit=2);
+
+        virtual ~Grid2Drcfs() {
+        }
+
+        int setSlowness(const std::vector<T1>& s) {
+            if ( s.size() != slowness.size() ) return 1;
+            slowness = s;
+            return 0;
+        }
+
+        int raytrace(const std::vector<sxz<T1>>& Tx,
+                     const std::vector<T1>& t0,
+                     const std::vector<sxz<T1>>& Rx,
+                     std::vector<T1>& traveltimes,
+                     const size_t threadNo=0) const;
+
+        int raytrace(const std::vector<sxz<T1>>& Tx,
+                     const std::vector<T1>& t0,
+                     const std::vector<sxz<T1>>& Rx,
+                     std::vector<T1>& traveltimes,
+                     std::vector<std::vector<sxz<double>>>& r_data,
+                     std::vector<std::vector<siv2<double>>>& l_data,
+                     const size_t threadNo=0) const;
+
+        int raytrace(const std::vector<sxz<T1>>& Tx,
+                     const std::vector<T1>& t0,
+                     const std::vector<sxz<T1>>& Rx,
+                     std::vector<T1>& traveltimes,
+                     std::vector<std::vector<siv2<double>>>& l_data,
+                     const size_t threadNo=0) const;
+
+        size_t getNumberOfNodes() const { return (nnx+1)*(nnz+1); }
+        size_t getNumberOfCells() const { return ncx*ncz; }
+
+        const size_t getNthreads() const { return nThreads; }
+        const T1 getXmin() const { return xmin; }
+        const T1 getXmax() const { return xmax; }
+        const T1 getZmin() const { return zmin; }
+        const T1 getZmax() const { return zmax; }
+        const T1 getDx() const { return dx; }
+        const T1 getDz() const { return dz; }
+        const T2 getNcx() const { return ncx; }
+        const T2 getNcz() const { return ncz; }
+
+    private:
+        size_t nThreads;
+        T1 dx;           // cell size in x
+        T1 dz;           // cell size in z
+        T1 xmin;         // x origin of the grid
+        T1 zmin;         // z origin of the grid
+        T1 xmax;         // x end of the grid
+        T1 zmax;         // z end of the grid
+        T2 ncx;          // number of cells in x
+        T2 ncz;          // number of cells in z
+        T2 nsx;          // number of subcells per cell in x
+        T2 nsz;          // number of subcells per cell in z
+        T2 nnx;          // number of subcells in x
+        T2 nnz;          // number of subcells in z
+        T1 dxs;          // subcell size in x
+        T1 dzs;          // subcell size in z
+        T1 epsilon;      // convergence criterion of the sweeps
+        int maxit;       // max number of iterations (4 sweeps each)
+        T2 nInit;        // number of cells around Tx initialized with straight rays
+
+        std::vector<T1> slowness;   // column-wise (z axis) slowness vector of the cells
+
+        T1 getSlowness(const T2 i, const T2 k) const {
+            return slowness[ (i/nsx)*ncz + k/nsz ];
+        }
+
+        T2 getCellNo(const sxz<T1>& pt) const {
+            T2 i = static_cast<T2>( std::max(T1(0), std::min(T1(ncx-1), std::floor((pt.x-xmin)/dx))) );
+            T2 k = static_cast<T2>( std::max(T1(0), std::min(T1(ncz-1), std::floor((pt.z-zmin)/dz))) );
+            return i*ncz + k;
+        }
+
+        void getSubcell(const sxz<T1>& pt, T2& i, T2& k) const {
+            i = static_cast<T2>( std::max(T1(0), std::min(T1(nnx-1), std::floor((pt.x-xmin)/dxs))) );
+            k = static_cast<T2>( std::max(T1(0), std::min(T1(nnz-1), std::floor((pt.z-zmin)/dzs))) );
+        }
+
+        int checkPts(const std::vector<sxz<T1>>&) const;
+
+        void solve(const std::vector<sxz<T1>>& Tx,
+                   const std::vector<T1>& t0,
+                   std::vector<T1>& tt) const;
+
+        T1 update(const T2 i, const T2 k, const std::vector<T1>& tt) const;
+
+        int getRaypath(const std::vector<sxz<T1>>& Tx,
+                       const std::vector<T1>& t0,
+                       const sxz<T1>& Rx,
+                       const std::vector<T1>& tt,
+                       T1& traveltime,
+                       std::vector<sxz<double>>& r_data,
+                       std::vector<siv2<double>>& l_data) const;
+
+        void addSegment(const sxz<T1>& p0, const sxz<T1>& p1,
+                        std::map<T2,T1>& lengths) const;
+
+        T1 getStraightTime(const sxz<T1>& p0, const sxz<T1>& p1) const {
+            std::map<T2,T1> lengths;
+            addSegment(p0, p1, lengths);
+            T1 t = 0.;
+            for ( auto it=lengths.begin(); it!=lengths.end(); ++it ) {
+                t += it->second * slowness[it->first];
+            }
+            return t;
+        }
+    };
+
+
+    template<typename T1, typename T2>
+    Grid2Drcfs<T1,T2>::Grid2Drcfs(const T2 nx, const T2 nz, const T1 ddx, const T1 ddz,
+                                  const T1 minx, const T1 minz, const T2 nnx_, const T2 nnz_,
+                                  const size_t nt, const T1 eps, const int maxit_,
+                                  const T2 ninit) : nThreads(nt),
+    dx(ddx), dz(ddz), xmin(minx), zmin(minz), xmax(minx+nx*ddx), zmax(minz+nz*ddz),
+    ncx(nx), ncz(nz), nsx(nnx_+1), nsz(nnz_+1), nnx(nx*(nnx_+1)), nnz(nz*(nnz_+1)),
+    dxs(ddx/(nnx_+1)), dzs(ddz/(nnz_+1)), epsilon(eps), maxit(maxit_), nInit(ninit),
+    slowness(std::vector<T1>(nx*nz))
+    { }
+
+
+    template<typename T1, typename T2>
+    int Grid2Drcfs<T1,T2>::checkPts(const std::vector<sxz<T1>>& pts) const {
+        for (size_t n=0; n<pts.size(); ++n) {
+            if ( pts[n].x < xmin || pts[n].x > xmax ||
+                pts[n].z < zmin || pts[n].z > zmax ) {
+                std::cerr << "Error: point no " << (n+1)
+                << " outside the grid.\n";
+                return 1;
+            }
+        }
+        return 0;
+    }
+
+
+    template<typename T1, typename T2>
+    T1 Grid2Drcfs<T1,T2>::update(const T2 i, const T2 k, const std::vector<T1>& tt) const {
+
+        // first order upwind update using the 4 subcells sharing node (i,k)
+        const T1 inf = std::numeric_limits<T1>::max();
+        T1 tmin = inf;
+        const T1 dx2 = 1./(dxs*dxs);
+        const T1 dz2 = 1./(dzs*dzs);
+
+        for ( int di=-1; di<=1; di+=2 ) {
+            if ( (di<0 && i==0) || (di>0 && i==nnx) ) continue;
+            T1 a = tt[ (i+di)*(nnz+1) + k ];
+            T2 ci = di<0 ? i-1 : i;
+
+            for ( int dk=-1; dk<=1; dk+=2 ) {
+                if ( (dk<0 && k==0) || (dk>0 && k==nnz) ) continue;
+                T1 b = tt[ i*(nnz+1) + k+dk ];
+                T2 ck = dk<0 ? k-1 : k;
+
+                T1 s = getSlowness(ci, ck);
+
+                if ( a < inf ) tmin = std::min(tmin, a + s*dxs);
+                if ( b < inf ) tmin = std::min(tmin, b + s*dzs);
+
+                if ( a < inf && b < inf ) {
+                    // ((t-a)/dxs)^2 + ((t-b)/dzs)^2 = s^2
+                    T1 A = dx2 + dz2;
+                    T1 B = a*dx2 + b*dz2;
+                    T1 C = a*a*dx2 + b*b*dz2 - s*s;
+                    T1 disc = B*B - A*C;
+                    if ( disc >= 0. ) {
+                        T1 t = (B + std::sqrt(disc))/A;
+                        if ( t >= a && t >= b ) {
+                            tmin = std::min(tmin, t);
+                        }
+                    }
+                }
+            }
+        }
+        return tmin;
+    }
+
+
+    template<typename T1, typename T2>
+    void Grid2Drcfs<T1,T2>::solve(const std::vector<sxz<T1>>& Tx,
+                                  const std::vector<T1>& t0,
+                                  std::vector<T1>& tt) const {
+
+        tt.assign( (nnx+1)*(nnz+1), std::numeric_limits<T1>::max() );
+        std::vector<bool> frozen( tt.size(), false );
+
+        // rays are close to straight lines near the sources, traveltimes at
+        // nodes of the cells around the sources are computed along straight
+        // lines and kept fixed during the sweeps
+        for ( size_t n=0; n<Tx.size(); ++n ) {
+            T2 i, k;
+            getSubcell(Tx[n], i, k);
+            T2 i1 = i/nsx > nInit ? (i/nsx-nInit)*nsx : 0;
+            T2 i2 = std::min(nnx, (i/nsx+nInit+1)*nsx);
+            T2 k1 = k/nsz > nInit ? (k/nsz-nInit)*nsz : 0;
+            T2 k2 = std::min(nnz, (k/nsz+nInit+1)*nsz);
+            for ( T2 ii=i1; ii<=i2; ++ii ) {
+                for ( T2 kk=k1; kk<=k2; ++kk ) {
+                    sxz<T1> node(xmin + ii*dxs, zmin + kk*dzs);
+                    T1 t = t0[n] + getStraightTime(Tx[n], node);
+                    T2 nn = ii*(nnz+1) + kk;
+                    if ( t < tt[nn] ) tt[nn] = t;
+                    frozen[nn] = true;
+                }
+            }
+        }
+
+        // Gauss-Seidel iterations with alternating sweep directions
+        for ( int it=0; it<maxit; ++it ) {
+            T1 change = 0.;
+            for ( int sweep=0; sweep<4; ++sweep ) {
+                bool xfwd = sweep==0 || sweep==1;
+                bool zfwd = sweep==0 || sweep==2;
+                for ( T2 ni=0; ni<=nnx; ++ni ) {
+                    T2 i = xfwd ? ni : nnx-ni;
+                    for ( T2 nk=0; nk<=nnz; ++nk ) {
+                        T2 k = zfwd ? nk : nnz-nk;
+                        T2 nn = i*(nnz+1) + k;
+                        if ( frozen[nn] ) continue;
+                        T1 t = update(i, k, tt);
+                        if ( t < tt[nn] ) {
+                            if ( tt[nn] < std::numeric_limits<T1>::max() ) {
+                                change = std::max(change, tt[nn]-t);
+                            } else {
+                                change = std::numeric_limits<T1>::max();
+                            }
+                            tt[nn] = t;
+                        }
+                    }
+                }
+            }
+            if ( change <= epsilon ) break;
+        }
+    }
+
+
+    template<typename T1, typename T2>
+    void Grid2Drcfs<T1,T2>::addSegment(const sxz<T1>& p0, const sxz<T1>& p1,
+                                       std::map<T2,T1>& lengths) const {
+
+        // segment is split at the intersections with the cell edges
+        T1 len = p0.getDistance(p1);
+        if ( len == 0. ) return;
+        std::vector<T1> t = {0., 1.};
+        if ( p1.x != p0.x ) {
+            T1 x0 = std::min(p0.x, p1.x);
+            T1 x1 = std::max(p0.x, p1.x);
+            for ( T2 n=static_cast<T2>(std::ceil((x0-xmin)/dx)); xmin+n*dx<x1; ++n ) {
+                t.push_back( (xmin+n*dx-p0.x)/(p1.x-p0.x) );
+            }
+        }
+        if ( p1.z != p0.z ) {
+            T1 z0 = std::min(p0.z, p1.z);
+            T1 z1 = std::max(p0.z, p1.z);
+            for ( T2 n=static_cast<T2>(std::ceil((z0-zmin)/dz)); zmin+n*dz<z1; ++n ) {
+                t.push_back( (zmin+n*dz-p0.z)/(p1.z-p0.z) );
+            }
+        }
+        std::sort(t.begin(), t.end());
+        for ( size_t n=1; n<t.size(); ++n ) {
+            if ( t[n] <= t[n-1] ) continue;
+            T1 tm = 0.5*(t[n-1]+t[n]);
+            sxz<T1> mid(p0.x + tm*(p1.x-p0.x), p0.z + tm*(p1.z-p0.z));
+            lengths[ getCellNo(mid) ] += (t[n]-t[n-1])*len;
+        }
+    }
+
+
+    template<typename T1, typename T2>
+    int Grid2Drcfs<T1,T2>::getRaypath(const std::vector<sxz<T1>>& Tx,
+                                      const std::vector<T1>& t0,
+                                      const sxz<T1>& Rx,
+                                      const std::vector<T1>& tt,
+                                      T1& traveltime,
+                                      std::vector<sxz<double>>& r_data,
+                                      std::vector<siv2<double>>& l_data) const {
+
+        const T1 step = 0.5*std::min(dxs, dzs);
+        const size_t maxSteps = 20*(nnx+nnz);
+
+        std::map<T2,T1> lengths;
+        std::vector<sxz<T1>> r_tmp;
+        sxz<T1> pt = Rx;
+        r_tmp.push_back( pt );
+
+        bool reachedTx = false;
+        for ( size_t ns=0; ns<maxSteps; ++ns ) {
+
+            T2 i, k;
+            getSubcell(pt, i, k);
+
+            // go straight to Tx once in its cell or close enough
+            for ( size_t n=0; n<Tx.size(); ++n ) {
+                if ( getCellNo(Tx[n]) == getCellNo(pt) || pt.getDistance(Tx[n]) <= step ) {
+                    addSegment(pt, Tx[n], lengths);
+                    r_tmp.push_back( Tx[n] );
+                    traveltime = t0[n];
+                    reachedTx = true;
+                    break;
+                }
+            }
+            if ( reachedTx ) break;
+
+            // gradient of the bilinear interpolant in the subcell
+            T1 u = (pt.x - xmin)/dxs - i;
+            T1 w = (pt.z - zmin)/dzs - k;
+            T2 nn = i*(nnz+1) + k;
+            T1 gx = ((tt[nn+nnz+1]-tt[nn])*(1.-w) + (tt[nn+nnz+2]-tt[nn+1])*w)/dxs;
+            T1 gz = ((tt[nn+1]-tt[nn])*(1.-u) + (tt[nn+nnz+2]-tt[nn+nnz+1])*u)/dzs;
+            T1 g = std::sqrt(gx*gx + gz*gz);
+            if ( g == 0. ) {
+                break;
+            }
+
+            sxz<T1> next(pt.x - step*gx/g, pt.z - step*gz/g);
+            next.x = std::max(xmin, std::min(xmax, next.x));
+            next.z = std::max(zmin, std::min(zmax, next.z));
+
+            addSegment(pt, next, lengths);
+            r_tmp.push_back( next );
+            pt = next;
+        }
+
+        if ( !reachedTx ) {
+            std::cerr << "Error: gradient descent did not reach Tx from Rx ("
+            << Rx.x << ", " << Rx.z << ").\n";
+            return 1;
+        }
+
+        // traveltime is the integral of slowness along the raypath, which is
+        // more accurate than interpolating the first order traveltime field
+        // std::map keys are sorted, as required to build matrix L
+        l_data.resize( 0 );
+        for ( auto it=lengths.begin(); it!=lengths.end(); ++it ) {
+            traveltime += it->second * slowness[it->first];
+            siv2<double> cell;
+            cell.i = it->first;
+            cell.v = it->second;
+            cell.v2 = 0.;
+            l_data.push_back( cell );
+        }
+
+        // the order should be from Tx to Rx
+        r_data.resize( r_tmp.size() );
+        for ( size_t nn=0; nn<r_tmp.size(); ++nn ) {
+            r_data[nn].x = r_tmp[ r_tmp.size()-1-nn ].x;
+            r_data[nn].z = r_tmp[ r_tmp.size()-1-nn ].z;
+        }
+        return 0;
+    }
+
+
+    template<typename T1, typename T2>
+    int Grid2Drcfs<T1,T2>::raytrace(const std::vector<sxz<T1>>& Tx,
+                                    const std::vector<T1>& t0,
+                                    const std::vector<sxz<T1>>& Rx,
+                                    std::vector<T1>& traveltimes,
+                                    const size_t threadNo) const {
+
+        if ( checkPts(Tx) == 1 ) return 1;
+        if ( checkPts(Rx) == 1 ) return 1;
+
+        // traveltimes at nodes are local to the call, threads do not share them
+        std::vector<T1> tt;
+        solve(Tx, t0, tt);
+
+        if ( traveltimes.size() != Rx.size() ) {
+            traveltimes.resize( Rx.size() );
+        }
+        // raypaths are needed to compute traveltimes at Rx
+        std::vector<sxz<double>> r_data;
+        std::vector<siv2<double>> l_data;
+        for (size_t n=0; n<Rx.size(); ++n) {
+            if ( getRaypath(Tx, t0, Rx[n], tt, traveltimes[n], r_data, l_data) == 1 ) return 1;
+        }
+        return 0;
+    }
+
+
+    template<typename T1, typename T2>
+    int Grid2Drcfs<T1,T2>::raytrace(const std::vector<sxz<T1>>& Tx,
+                                    const std::vector<T1>& t0,
+                                    const std::vector<sxz<T1>>& Rx,
+                                    std::vector<T1>& traveltimes,
+                                    std::vector<std::vector<sxz<double>>>& r_data,
+                                    std::vector<std::vector<siv2<double>>>& l_data,
+                                    const size_t threadNo) const {
+
+        if ( checkPts(Tx) == 1 ) return 1;
+        if ( checkPts(Rx) == 1 ) return 1;
+
+        std::vector<T1> tt;
+        solve(Tx, t0, tt);
+
+        if ( traveltimes.size() != Rx.size() ) {
+            traveltimes.resize( Rx.size() );
+        }
+        if ( l_data.size() != Rx.size() ) {
+            l_data.resize( Rx.size() );
+        }
+        if ( r_data.size() != Rx.size() ) {
+            r_data.resize( Rx.size() );
+        }
+        for (size_t n=0; n<Rx.size(); ++n) {
+            if ( getRaypath(Tx, t0, Rx[n], tt, traveltimes[n], r_data[n], l_data[n]) == 1 ) return 1;
+        }
+        return 0;
+    }
+
+
+    template<typename T1, typename T2>
+    int Grid2Drcfs<T1,T2>::raytrace(const std::vector<sxz<T1>>& Tx,
+                                    const std::vector<T1>& t0,
+                                    const std::vector<sxz<T1>>& Rx,
+                                    std::vector<T1>& traveltimes,
+                                    std::vector<std::vector<siv2<double>>>& l_data,
+                                    const size_t threadNo) const {
+
+        std::vector<std::vector<sxz<double>>> r_data;
+        return raytrace(Tx, t0, Rx, traveltimes, r_data, l_data, threadNo);
+    }
+
+}
+
+#endif
@@ -22,6 +22,10 @@
  *
  */
 
+#include <algorithm>
+#include <cstring>
+#include <functional>
+#include <stdexcept>
 #include <thread>
 
 #include "Grid2Dttcr.h"
@@ -36,9 +40,22 @@ namespace ttcr {
                            double dx, double dz,
                            double xmin, double zmin,
                            uint32_t nsnx, uint32_t nsnz,
-                           size_t nthreads) : type(_type){
+                           size_t nthreads,
+                           const std::string& method) : type(_type){
 
-        if ( type.compare("iso")==0 ) {
+        if ( method.compare("fsm")==0 ) {
+            // fast sweeping is implemented for isotropic media only
+            if ( type.compare("iso")!=0 ) {
+                throw invalid_argument("Fast sweeping method available for isotropic media only");
+            }
+            grid_instance = new gridfsm(nx, nz,
+                                        dx, dz,
+                                        xmin, zmin,
+                                        nsnx, nsnz,
+                                        nthreads);
+        } else if ( method.compare("spm")!=0 ) {
+            throw invalid_argument("Unknown raytracing method: "+method);
+        } else if ( type.compare("iso")==0 ) {
             grid_instance = new gridiso(nx, nz,
                                         dx, dz,
                                         xmin, zmin,
@@ -87,7 +104,8 @@ namespace ttcr {
                              PyObject* rays,
                              PyObject* L) const {
 
-        // rays must be a pointer to a tuple object of size nRx
+        // rays must be a pointer to a tuple object of size 2 (see below)
+        // rays and L may be null, in which case they are not built
 
         /*
          Looking for redundants Tx pts
@@ -122,65 +140,57 @@ namespace ttcr {
          Looping over all non redundant Tx
          */
 
-        vector<sxz<double>> vRx;
         vector<vector<double>> tt( vTx.size() );
         vector<vector<vector<sxz<double>>>> r_data( vTx.size() );
-        vector<vector<siv2<double>>> L_data(nTx);
         vector<vector<vector<siv2<double>>>> l_data( vTx.size() );
 
-        if ( grid_instance->getNthreads() == 1 || grid_instance->getNthreads()<= vTx.size() ) {
-            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-
-                vRx.resize( 0 );
-                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
-                }
-
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_data[nv], l_data[nv]) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
-                }
+        // raypaths are computed along with L
+        auto traceTx = [this,rays,L,&vTx,&t0,&Rx,&iTx,&tt,&r_data,&l_data](size_t nv, size_t threadNo) {
+            vector<sxz<double>> vRx;
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                vRx.push_back( Rx[ iTx[nv][ni] ] );
             }
-        } else {
-            size_t num_threads = grid_instance->getNthreads();
-            size_t blk_size = vTx.size()/num_threads;
-            if ( blk_size == 0 ) blk_size++;
-
-            vector<thread> threads(num_threads-1);
-            size_t blk_start = 0;
-            for ( size_t i=0; i<num_threads-1; ++i ) {
-
-                size_t blk_end = blk_start + blk_size;
-                grid *grid_ref = grid_instance;
-                threads[i]=thread( [&grid_ref,&vTx,&tt,&t0,&Rx,&iTx,&nRx,
-                                    &r_data,&l_data,blk_start,blk_end,i]{
-
-                    for ( size_t nv=blk_start; nv<blk_end; ++nv ) {
-
-                        vector<sxz<double>> vRx;
-                        for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                            vRx.push_back( Rx[ iTx[nv][ni] ] );
-                        }
-                        if ( grid_ref->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_data[nv], l_data[nv], i+1) == 1 ) {
-                            throw runtime_error("Problem while raytracing.");
-                        }
-                    }
-                });
-
-                blk_start = blk_end;
+            if ( rays != nullptr ) {
+                return grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_data[nv], l_data[nv], threadNo);
+            } else if ( L != nullptr ) {
+                return grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv], threadNo);
             }
-
-            for ( size_t nv=blk_start; nv<vTx.size(); ++nv ) {
-                vector<sxz<double>> vRx;
-                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
-                }
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_data[nv], l_data[nv], 0) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
+            return grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], threadNo);
+        };
+
+        // use as many threads as possible, without exceeding the number of Tx
+        size_t num_threads = grid_instance->getNthreads() < vTx.size() ? grid_instance->getNthreads() : vTx.size();
+        if ( num_threads < 1 ) num_threads = 1;
+        size_t blk_size = vTx.size()/num_threads;
+        if ( blk_size == 0 ) blk_size++;
+
+        // errors are reported through status, exceptions must not leave the threads
+        vector<int> status(num_threads, 0);
+        auto work = [&](size_t i, size_t blk_start, size_t blk_end) {
+            for ( size_t nv=blk_start; nv<blk_end; ++nv ) {
+                if ( traceTx(nv, i) == 1 ) {
+                    status[i] = 1;
+                    return;
                 }
             }
+        };
+
+        vector<thread> threads(num_threads-1);
+        size_t blk_start = 0;
+        for ( size_t i=0; i<num_threads-1; ++i ) {
+            size_t blk_end = blk_start + blk_size;
+            threads[i] = thread(work, i+1, blk_start, blk_end);
+            blk_start = blk_end;
+        }
+        work(0, blk_start, vTx.size());
+
+        std::for_each(threads.begin(),threads.end(),
+                      std::mem_fn(&std::thread::join));
 
-            std::for_each(threads.begin(),threads.end(),
-                          std::mem_fn(&std::thread::join));
+        for ( size_t i=0; i<num_threads; ++i ) {
+            if ( status[i] == 1 ) {
+                return 1;
+            }
         }
 
         for ( size_t nv=0; nv<vTx.size(); ++nv ) {
@@ -189,116 +199,57 @@ namespace ttcr {
             }
         }
 
-        // rays
-        import_array();  // to use PyArray_SimpleNewFromData
+        if ( rays != nullptr ) {
+            // rays must be a pointer to a tuple object of size 2
+            // first element contains the coordinates of all ray points, size is npts x 2 (float32)
+            // second element contains offsets of the rays, size is nRx+1 (int64)
+            import_array();  // to use PyArray_SimpleNewFromData
 
-        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                size_t npts = r_data[nv][ni].size();
-                npy_intp dims[] = {static_cast<npy_intp>(npts), 2};
-                double* ray_p = new double[2*npts];
-                PyObject* ray = PyArray_SimpleNewFromData(2, dims, NPY_DOUBLE, ray_p);
-                PyArray_ENABLEFLAGS((PyArrayObject*)ray, NPY_ARRAY_OWNDATA);
-
-                for ( size_t np=0; np<npts; ++np ) {
-                    ray_p[2*np] = r_data[nv][ni][np].x;
-                    ray_p[2*np+1] = r_data[nv][ni][np].z;
-                }
+            npy_intp dims[] = {static_cast<npy_intp>(nRx+1), 2};
+            int64_t* offsets_p = (int64_t*)malloc( (nRx+1)*sizeof(int64_t) );
+            PyObject* offsets = PyArray_SimpleNewFromData(1, dims, NPY_INT64, offsets_p);
+            PyArray_ENABLEFLAGS((PyArrayObject*)offsets, NPY_ARRAY_OWNDATA);
 
-                PyTuple_SetItem(rays, iTx[nv][ni], ray);
+            offsets_p[0] = 0;
+            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                    offsets_p[ iTx[nv][ni]+1 ] = r_data[nv][ni].size();
+                }
             }
-        }
-
-        // L
-        // first element of tuple contains data, size is nnz
-        // second element contains column indices for rows of the matrix, size is nnz
-        // third element contains pointers for indices, size is nrow+1 (nTx+1)
-
-        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                L_data[ iTx[nv][ni] ] = l_data[nv][ni];
+            for ( size_t n=0; n<nRx; ++n ) {
+                offsets_p[n+1] += offsets_p[n];
             }
-        }
 
-        size_t nnz = 0;
-        for ( size_t n=0; n<L_data.size(); ++n ) {
-            nnz += L_data[n].size();
-        }
-        size_t ncell = grid_instance->getNumberOfCells();
+            dims[0] = static_cast<npy_intp>(offsets_p[nRx]);
+            float* coords_p = (float*)malloc( (offsets_p[nRx]>0 ? 2*offsets_p[nRx] : 1)*sizeof(float) );
+            PyObject* coords = PyArray_SimpleNewFromData(2, dims, NPY_FLOAT32, coords_p);
+            PyArray_ENABLEFLAGS((PyArrayObject*)coords, NPY_ARRAY_OWNDATA);
 
-        if ( type.compare("iso")==0 ) {
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }
+            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                    float* ray_p = coords_p + 2*offsets_p[ iTx[nv][ni] ];
+                    for ( size_t np=0; np<r_data[nv][ni].size(); ++np ) {
+                        ray_p[2*np] = static_cast<float>(r_data[nv][ni][np].x);
+                        ray_p[2*np+1] = static_cast<float>(r_data[nv][ni][np].z);
                     }
                 }
             }
-            indptr_p[nTx] = k;
 
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
+            PyTuple_SetItem(rays, 0, coords);
+            PyTuple_SetItem(rays, 1, offsets);
+        }
 
-        } else {
-            nnz *= 2;
-
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<2*ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }	else if ( L_data[i][n].i+ncell == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v2;
-                            k++;
-                        }
-                    }
+        if ( L != nullptr ) {
+            import_array();  // to use PyArray_SimpleNewFromData
+
+            vector<vector<siv2<double>>> L_data(nTx);
+            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                    L_data[ iTx[nv][ni] ] = std::move( l_data[nv][ni] );
                 }
             }
-            indptr_p[nTx] = k;
 
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
+            buildL(L_data, L);
         }
 
         return 0;
@@ -309,417 +260,282 @@ namespace ttcr {
                              const std::vector<sxz<double>>& Rx,
                              double* traveltimes,
                              PyObject* L) const {
+        return raytrace(Tx, tTx, Rx, traveltimes, nullptr, L);
+    }
 
-        /*
-         Looking for redundants Tx pts
-         */
-
-        size_t nTx = Tx.size();
-        size_t nRx = Rx.size();
-        vector<vector<sxz<double>>> vTx;
-        vector<vector<double>> t0;
-        vector<vector<size_t>> iTx;
-        vTx.push_back( vector<sxz<double> >(1, Tx[0]) );
-        t0.push_back( vector<double>(1, tTx[0]) );
-        iTx.push_back( vector<size_t>(1, 0) );  // indices of Rx corresponding to current Tx
-        for ( size_t ntx=1; ntx<nTx; ++ntx ) {
-            bool found = false;
-
-            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-                if ( vTx[nv][0]==Tx[ntx] ) {
-                    found = true;
-                    iTx[nv].push_back( ntx ) ;
-                    break;
-                }
-            }
-            if ( !found ) {
-                vTx.push_back( vector<sxz<double>>(1, Tx[ntx]) );
-                t0.push_back( vector<double>(1, tTx[ntx]) );
-                iTx.push_back( vector<size_t>(1, ntx) );
-            }
-        }
-
-        /*
-         Looping over all non redundant Tx
-         */
-
-        vector<sxz<double>> vRx;
-        vector<vector<double>> tt( vTx.size() );
-        vector<vector<siv2<double>>> L_data(nTx);
-        vector<vector<vector<siv2<double>>>> l_data( vTx.size() );
-
-        if ( grid_instance->getNthreads() == 1 || vTx.size()<=grid_instance->getNthreads() ) {
-            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-
-                vRx.resize( 0 );
-                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
-                }
-
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv]) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
-                }
-            }
-        } else {
-            size_t num_threads = grid_instance->getNthreads() < vTx.size() ? grid_instance->getNthreads() : vTx.size();
-            size_t blk_size = vTx.size()/num_threads;
-            if ( blk_size == 0 ) blk_size++;
-
-            vector<thread> threads(num_threads-1);
-            size_t blk_start = 0;
-            for ( size_t i=0; i<num_threads-1; ++i ) {
-
-                size_t blk_end = blk_start + blk_size;
-                grid *grid_ref = grid_instance;
-                threads[i]=thread( [&grid_ref,&vTx,&tt,&t0,&Rx,&iTx,&nRx,
-                                    &l_data,blk_start,blk_end,i]{
-
-                    for ( size_t nv=blk_start; nv<blk_end; ++nv ) {
-
-                        vector<sxz<double>> vRx;
-                        for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                            vRx.push_back( Rx[ iTx[nv][ni] ] );
-                        }
-                        if ( grid_ref->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv], i+1) == 1 ) {
-                            throw runtime_error("Problem while raytracing.");
-                        }
-                    }
-                });
-
-                blk_start = blk_end;
-            }
-
-            for ( size_t nv=blk_start; nv<vTx.size(); ++nv ) {
-                vector<sxz<double>> vRx;
-                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
-                }
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv], 0) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
-                }
-            }
-
-            std::for_each(threads.begin(),threads.end(),
-                          std::mem_fn(&std::thread::join));
-        }
-
-        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                traveltimes[ iTx[nv][ni] ] = tt[nv][ni];
-            }
-        }
+    int Grid2Dttcr::raytrace(const std::vector<sxz<double>>& Tx,
+                             const std::vector<double>& tTx,
+                             const std::vector<sxz<double>>& Rx,
+                             double* traveltimes) const {
+        // traveltimes only: neither L nor the raypaths are built
+        return raytrace(Tx, tTx, Rx, traveltimes, nullptr, nullptr);
+    }
 
-        import_array();  // to use PyArray_SimpleNewFromData
+    void Grid2Dttcr::buildL(const std::vector<std::vector<siv2<double>>>& L_data,
+                            PyObject* L) const {
 
-        // L
         // first element of tuple contains data, size is nnz
         // second element contains column indices for rows of the matrix, size is nnz
         // third element contains pointers for indices, size is nrow+1 (nTx+1)
+        //
+        // rows of L_data are already sorted by cell index (see Grid2Drcsp::raytrace),
+        // arrays are thus filled in a single pass
 
-        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                L_data[ iTx[nv][ni] ] = l_data[nv][ni];
-            }
-        }
-
+        size_t nTx = L_data.size();
         size_t nnz = 0;
-        for ( size_t n=0; n<L_data.size(); ++n ) {
+        for ( size_t n=0; n<nTx; ++n ) {
             nnz += L_data[n].size();
         }
         size_t ncell = grid_instance->getNumberOfCells();
+        bool iso = type.compare("iso")==0;
+        if ( !iso ) nnz *= 2;
 
-        if ( type.compare("iso")==0 ) {
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }
-                    }
-                }
-            }
-            indptr_p[nTx] = k;
+        npy_intp dims[] = {static_cast<npy_intp>(nnz)};
+        double* data_p = (double*)malloc( (nnz>0 ? nnz : 1)*sizeof(double) );
+        PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
+        PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
 
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
+        int64_t* indices_p = (int64_t*)malloc( (nnz>0 ? nnz : 1)*sizeof(int64_t) );
+        PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
+        PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
 
-        } else {
-            nnz *= 2;
-
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<2*ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }	else if ( L_data[i][n].i+ncell == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v2;
-                            k++;
-                        }
-                    }
+        dims[0] = nTx+1;
+        int64_t* indptr_p = (int64_t*)malloc( (nTx+1)*sizeof(int64_t) );
+        PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
+        PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
+
+        size_t k = 0;
+        for ( size_t i=0; i<nTx; ++i ) {
+            indptr_p[i] = k;
+            for ( size_t n=0; n<L_data[i].size(); ++n ) {
+                indices_p[k] = L_data[i][n].i;
+                data_p[k] = L_data[i][n].v;
+                k++;
+            }
+            if ( !iso ) {
+                for ( size_t n=0; n<L_data[i].size(); ++n ) {
+                    indices_p[k] = L_data[i][n].i+ncell;
+                    data_p[k] = L_data[i][n].v2;
+                    k++;
                 }
             }
-            indptr_p[nTx] = k;
-
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
         }
+        indptr_p[nTx] = k;
 
-        return 0;
+        PyTuple_SetItem(L, 0, data);
+        PyTuple_SetItem(L, 1, indices);
+        PyTuple_SetItem(L, 2, indptr);
     }
 
-    int Grid2Dttcr::Lsr2d(const double* Tx,
-                          const double* Rx,
-                          const size_t nTx,
-                          const double* grx,
-                          const size_t n_grx,
-                          const double* grz,
-                          const size_t n_grz,
-                          PyObject* L) {
-
-        const double  small=1.e-10;
+    void Grid2Dttcr::Lsr2dRay(double xs, double zs, double xr, double zr,
+                              const double* grx, const size_t n_grx,
+                              const double* grz, const size_t n_grz,
+                              const bool aniso,
+                              std::vector<int64_t>& indices,
+                              std::vector<double>& data) {
 
-        size_t nCells = (n_grx-1)*(n_grz-1);
-        size_t nLmax = nTx * n_grx * n_grz/2;
-        double percent_sp = (nLmax*1.0)/(nTx*nCells*1.0);
-
-        double* data_p = (double*)malloc( nLmax*sizeof(double) );
-        int64_t* indices_p = (int64_t*)malloc( nLmax*sizeof(int64_t) );
-        int64_t* indptr_p = (int64_t*)malloc( (nTx+1)*sizeof(int64_t) );
+        // for anisotropic media, the X and Z components of the segments are
+        // stored in columns iCell and iCell+nCells respectively
 
-        size_t k = 0;
+        const double  small=1.e-10;
+        const int64_t nCells = (n_grx-1)*(n_grz-1);
         size_t ix, iz;
-        for ( size_t n=0; n<nTx; ++n ) {
-            indptr_p[n] = k;
-
-            double xs = Tx[2*n];
-            double zs = Tx[2*n+1];
-            double xr = Rx[2*n];
-            double zr = Rx[2*n+1];
-
-            if ( xs>xr ) {  /* on va de s à r, on veut x croissant */
-                double dtmp = xs;
-                xs = xr;
-                xr = dtmp;
-                dtmp = zs;
-                zs = zr;
-                zr = dtmp;
-            }
 
-            /* points de depart */
-            double x = xs;
-            double z = zs;
+        if ( xs>xr ) {  /* on va de s à r, on veut x croissant */
+            double dtmp = xs;
+            xs = xr;
+            xr = dtmp;
+            dtmp = zs;
+            zs = zr;
+            zr = dtmp;
+        }
 
-            if ( fabs(zs-zr)<small ) {  /* rai horizontal */
+        /* points de depart */
+        double x = xs;
+        double z = zs;
 
-                for ( ix=0; ix<n_grx-1; ++ix ) if ( x < grx[ix+1] ) break;
-                for ( iz=0; iz<n_grz-1; ++iz ) if ( z < grz[iz+1] ) break;
+        if ( fabs(zs-zr)<small ) {  /* rai horizontal */
 
-                while ( x < xr ) {
-                    int64_t iCell = ix*(n_grz-1) + iz;
+            for ( ix=0; ix<n_grx-1; ++ix ) if ( x < grx[ix+1] ) break;
+            for ( iz=0; iz<n_grz-1; ++iz ) if ( z < grz[iz+1] ) break;
 
-                    double dlx = ( grx[ix+1]<xr ? grx[ix+1] : xr ) - x;
+            while ( x < xr ) {
+                int64_t iCell = ix*(n_grz-1) + iz;
 
-                    indices_p[k] = iCell;
-                    data_p[k] = dlx;
-                    k++;
+                double dlx = ( grx[ix+1]<xr ? grx[ix+1] : xr ) - x;
 
-                    if (k>=nLmax){
-                        size_t oldnzmax = nLmax;
-                        percent_sp += 0.1;
-                        nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
+                indices.push_back(iCell);
+                data.push_back(dlx);
 
-                        /* make sure nzmax increases at least by 1 */
-                        if (oldnzmax == nLmax) nLmax++;
-
-                        data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                        indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                    }
-
-                    ix++;
-                    x = grx[ix];
-                }
+                ix++;
+                x = grx[ix];
             }
-            else if ( fabs(xs-xr)<small ) { /* rai vertical */
-                if ( zs > zr ) {  /* on va de s à r, on veut z croissant */
-                    double dtmp = zs;
-                    zs = zr;
-                    zr = dtmp;
-                }
-                z = zs;
-
-                for ( ix=0; ix<n_grx-1; ++ix ) if ( x < grx[ix+1] ) break;
-                for ( iz=0; iz<n_grz-1; ++iz ) if ( z < grz[iz+1] ) break;
-
-                while ( z < zr ) {
-                    int64_t iCell = ix*(n_grz-1) + iz;
+        }
+        else if ( fabs(xs-xr)<small ) { /* rai vertical */
+            if ( zs > zr ) {  /* on va de s à r, on veut z croissant */
+                double dtmp = zs;
+                zs = zr;
+                zr = dtmp;
+            }
+            z = zs;
 
-                    double dlz = ( grz[iz+1]<zr ? grz[iz+1] : zr ) - z;
+            for ( ix=0; ix<n_grx-1; ++ix ) if ( x < grx[ix+1] ) break;
+            for ( iz=0; iz<n_grz-1; ++iz ) if ( z < grz[iz+1] ) break;
 
-                    indices_p[k] = iCell;
-                    data_p[k] = dlz;
-                    k++;
+            while ( z < zr ) {
+                int64_t iCell = ix*(n_grz-1) + iz;
 
-                    if (k>=nLmax){
-                        size_t oldnzmax = nLmax;
-                        percent_sp += 0.1;
-                        nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
+                double dlz = ( grz[iz+1]<zr ? grz[iz+1] : zr ) - z;
 
-                        /* make sure nzmax increases at least by 1 */
-                        if (oldnzmax == nLmax) nLmax++;
+                indices.push_back(aniso ? iCell+nCells : iCell);
+                data.push_back(dlz);
 
-                        data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                        indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                    }
-
-                    iz++;
-                    z = grz[iz];
-                }
+                iz++;
+                z = grz[iz];
             }
-            else { /* rai oblique */
-                /* pente du rai */
-                double m = (zr-zs)/(xr-xs);
-                double b = zr - m*xr;
-                bool up = m>0;
+        }
+        else { /* rai oblique */
+            /* pente du rai */
+            double m = (zr-zs)/(xr-xs);
+            double b = zr - m*xr;
+            bool up = m>0;
 
-                for ( ix=0; ix<n_grx-1; ++ix ) if ( x < grx[ix+1] ) break;
-                for ( iz=0; iz<n_grz-1; ++iz ) if ( z < grz[iz+1] ) break;
+            for ( ix=0; ix<n_grx-1; ++ix ) if ( x < grx[ix+1] ) break;
+            for ( iz=0; iz<n_grz-1; ++iz ) if ( z < grz[iz+1] ) break;
 
-                while ( x < xr ) {
+            while ( x < xr ) {
 
-                    double zi = m*grx[ix+1] + b;
+                double zi = m*grx[ix+1] + b;
 
+                while ( up ? (z < zi && z < zr) : (z > zi && z > zr) ) {
+                    int64_t iCell = ix*(n_grz-1) + iz;
+
+                    double ze;
                     if ( up ) {
-                        while ( z < zi && z < zr ) {
-                            int64_t iCell = ix*(n_grz-1) + iz;
-
-                            double ze = grz[iz+1]<zi ? grz[iz+1] : zi;
-                            ze = ze<zr ? ze : zr;
-                            double xe = (ze-b)/m;
-                            double dlx = xe - x;
-                            double dlz = ze - z;
-                            double dl = sqrt( dlx*dlx + dlz*dlz );
-
-                            indices_p[k] = iCell;
-                            data_p[k] = dl;
-                            k++;
-
-                            if (k>=nLmax){
-                                size_t oldnzmax = nLmax;
-                                percent_sp += 0.1;
-                                nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                                /* make sure nzmax increases at least by 1 */
-                                if (oldnzmax == nLmax) nLmax++;
-
-                                data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                                indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                            }
-
-                            x = xe;
-                            z = ze;
-                            if ( fabs(z-grz[iz+1])<small ) iz++;
-                        }
+                        ze = grz[iz+1]<zi ? grz[iz+1] : zi;
+                        ze = ze<zr ? ze : zr;
+                    } else {
+                        ze = grz[iz]>zi ? grz[iz] : zi;
+                        ze = ze>zr ? ze : zr;
+                    }
+                    double xe = (ze-b)/m;
+                    double dlx = xe - x;
+                    double dlz = ze - z;
+
+                    if ( aniso ) {
+                        indices.push_back(iCell);
+                        data.push_back(dlx);
+                        indices.push_back(iCell+nCells);
+                        data.push_back(dlz);
                     } else {
-                        while ( z > zi && z > zr ) {
-                            int64_t iCell = ix*(n_grz-1) + iz;
-
-                            double ze = grz[iz]>zi ? grz[iz] : zi;
-                            ze = ze>zr ? ze : zr;
-                            double xe = (ze-b)/m;
-                            double dlx = xe - x;
-                            double dlz = ze - z;
-                            double dl = sqrt( dlx*dlx + dlz*dlz );
-
-                            indices_p[k] = iCell;
-                            data_p[k] = dl;
-                            k++;
-
-                            if (k>=nLmax){
-                                size_t oldnzmax = nLmax;
-                                percent_sp += 0.1;
-                                nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                                /* make sure nzmax increases at least by 1 */
-                                if (oldnzmax == nLmax) nLmax++;
-
-                                data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                                indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                            }
-
-                            x = xe;
-                            z = ze;
-                            if ( fabs(z-grz[iz])<small ) iz--;
-                        }
+                        indices.push_back(iCell);
+                        data.push_back(sqrt( dlx*dlx + dlz*dlz ));
                     }
 
-                    ix++;
-                    x = grx[ix];
+                    x = xe;
+                    z = ze;
+                    if ( up ) {
+                        if ( fabs(z-grz[iz+1])<small ) iz++;
+                    } else {
+                        if ( fabs(z-grz[iz])<small ) iz--;
+                    }
                 }
+
+                ix++;
+                x = grx[ix];
             }
         }
+    }
 
-        indptr_p[nTx] = k;
-        size_t nnz = k;
+    int Grid2Dttcr::Lsr(const double* Tx,
+                        const double* Rx,
+                        const size_t nTx,
+                        const double* grx,
+                        const size_t n_grx,
+                        const double* grz,
+                        const size_t n_grz,
+                        const bool aniso,
+                        size_t nthreads,
+                        PyObject* L) {
+
+        // rays are distributed over threads by blocks, each thread fills its
+        // own buffers which are then copied in the CSR arrays
+
+        if ( nthreads > nTx ) nthreads = nTx;
+        if ( nthreads < 1 ) nthreads = 1;
+        size_t blk_size = nTx/nthreads;
+        if ( blk_size*nthreads < nTx ) blk_size++;
+
+        vector<vector<int64_t>> indices(nthreads);
+        vector<vector<double>> data(nthreads);
+        int64_t* indptr_p = (int64_t*)malloc( (nTx+1)*sizeof(int64_t) );
+
+        auto work = [&](const size_t nt) {
+            size_t n1 = nt*blk_size;
+            if ( n1 >= nTx ) return;
+            size_t n2 = n1+blk_size < nTx ? n1+blk_size : nTx;
+            indices[nt].reserve( (n2-n1)*(n_grx+n_grz) );
+            data[nt].reserve( (n2-n1)*(n_grx+n_grz) );
+            for ( size_t n=n1; n<n2; ++n ) {
+                // row sizes are stored for now, converted to pointers below
+                size_t k = indices[nt].size();
+                Lsr2dRay(Tx[2*n], Tx[2*n+1], Rx[2*n], Rx[2*n+1],
+                         grx, n_grx, grz, n_grz, aniso, indices[nt], data[nt]);
+                indptr_p[n+1] = indices[nt].size() - k;
+            }
+        };
 
-        data_p = (double*)realloc( data_p, nnz*sizeof(double) );
-        indices_p = (int64_t*)realloc( indices_p, nnz*sizeof(int64_t) );
+        vector<thread> threads(nthreads-1);
+        for ( size_t nt=0; nt<threads.size(); ++nt ) {
+            threads[nt] = thread(work, nt+1);
+        }
+        work(0);
+        std::for_each(threads.begin(),threads.end(),
+                      std::mem_fn(&std::thread::join));
+
+        indptr_p[0] = 0;
+        for ( size_t n=0; n<nTx; ++n ) {
+            indptr_p[n+1] += indptr_p[n];
+        }
+        size_t nnz = indptr_p[nTx];
+
+        double* data_p = (double*)malloc( (nnz>0 ? nnz : 1)*sizeof(double) );
+        int64_t* indices_p = (int64_t*)malloc( (nnz>0 ? nnz : 1)*sizeof(int64_t) );
+        for ( size_t nt=0; nt<nthreads; ++nt ) {
+            if ( indices[nt].empty() ) continue;
+            size_t k = indptr_p[nt*blk_size];
+            memcpy(indices_p+k, indices[nt].data(), indices[nt].size()*sizeof(int64_t));
+            memcpy(data_p+k, data[nt].data(), data[nt].size()*sizeof(double));
+        }
 
         import_array();  // to use PyArray_SimpleNewFromData
 
         npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-        PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-        PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-        PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-        PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
+        PyObject* data_a = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
+        PyArray_ENABLEFLAGS((PyArrayObject*)data_a, NPY_ARRAY_OWNDATA);
+        PyObject* indices_a = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
+        PyArray_ENABLEFLAGS((PyArrayObject*)indices_a, NPY_ARRAY_OWNDATA);
         dims[0] = nTx+1;
         PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
         PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-        PyTuple_SetItem(L, 0, data);
-        PyTuple_SetItem(L, 1, indices);
+        PyTuple_SetItem(L, 0, data_a);
+        PyTuple_SetItem(L, 1, indices_a);
         PyTuple_SetItem(L, 2, indptr);
 
         return 0;
     }
 
+    int Grid2Dttcr::Lsr2d(const double* Tx,
+                          const double* Rx,
+                          const size_t nTx,
+                          const double* grx,
+                          const size_t n_grx,
+                          const double* grz,
+                          const size_t n_grz,
+                          PyObject* L,
+                          const size_t nthreads) {
+        return Lsr(Tx, Rx, nTx, grx, n_grx, grz, n_grz, false, nthreads, L);
+    }
 
     int Grid2Dttcr::Lsr2da(const double* Tx,
                            const double* Rx,
@@ -728,213 +544,8 @@ namespace ttcr {
                            const size_t n_grx,
                            const double* grz,
                            const size_t n_grz,
-                           PyObject* L) {
-
-        const double  small=1.e-10;
-
-        size_t nCells = (n_grx-1)*(n_grz-1);
-        size_t nLmax = nTx * n_grx * n_grz/2;
-        double percent_sp = (nLmax*1.0)/(nTx*nCells*1.0);
-
-        double* data_p = (double*)malloc( nLmax*sizeof(double) );
-        int64_t* indices_p = (int64_t*)malloc( nLmax*sizeof(int64_t) );
-        int64_t* indptr_p = (int64_t*)malloc( (nTx+1)*sizeof(int64_t) );
-
-        size_t k = 0;
-        size_t ix, iz;
-        for ( size_t n=0; n<nTx; ++n ) {
-            indptr_p[n] = k;
-
-            double xs = Tx[2*n];
-            double zs = Tx[2*n+1];
-            double xr = Rx[2*n];
-            double zr = Rx[2*n+1];
-
-            if ( xs>xr ) {  /* on va de s à r, on veut x croissant */
-                double dtmp = xs;
-                xs = xr;
-                xr = dtmp;
-                dtmp = zs;
-                zs = zr;
-                zr = dtmp;
-            }
-
-            /* points de depart */
-            double x = xs;
-            double z = zs;
-
-            if ( fabs(zs-zr)<small ) {  /* rai horizontal */
-
-                for ( ix=0; ix<n_grx-1; ++ix ) if ( x < grx[ix+1] ) break;
-                for ( iz=0; iz<n_grz-1; ++iz ) if ( z < grz[iz+1] ) break;
-
-                while ( x < xr ) {
-                    int64_t iCell = ix*(n_grz-1) + iz;
-
-                    double dlx = ( grx[ix+1]<xr ? grx[ix+1] : xr ) - x;
-
-                    indices_p[k] = iCell;
-                    data_p[k] = dlx;
-                    k++;
-
-                    if (k>=nLmax){
-                        size_t oldnzmax = nLmax;
-                        percent_sp += 0.1;
-                        nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                        /* make sure nzmax increases at least by 1 */
-                        if (oldnzmax == nLmax) nLmax++;
-
-                        data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                        indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                    }
-
-                    ix++;
-                    x = grx[ix];
-                }
-            }
-            else if ( fabs(xs-xr)<small ) { /* rai vertical */
-                if ( zs > zr ) {  /* on va de s à r, on veut z croissant */
-                    double dtmp = zs;
-                    zs = zr;
-                    zr = dtmp;
-                }
-                z = zs;
-
-                for ( ix=0; ix<n_grx-1; ++ix ) if ( x < grx[ix+1] ) break;
-                for ( iz=0; iz<n_grz-1; ++iz ) if ( z < grz[iz+1] ) break;
-
-                while ( z < zr ) {
-                    int64_t iCell = ix*(n_grz-1) + iz;
-
-                    double dlz = ( grz[iz+1]<zr ? grz[iz+1] : zr ) - z;
-
-                    indices_p[k] = iCell+nCells;
-                    data_p[k] = dlz;
-                    k++;
-
-                    if (k>=nLmax){
-                        size_t oldnzmax = nLmax;
-                        percent_sp += 0.1;
-                        nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                        /* make sure nzmax increases at least by 1 */
-                        if (oldnzmax == nLmax) nLmax++;
-
-                        data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                        indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                    }
-
-                    iz++;
-                    z = grz[iz];
-                }
-            }
-            else { /* rai oblique */
-                /* pente du rai */
-                double m = (zr-zs)/(xr-xs);
-                double b = zr - m*xr;
-                bool up = m>0;
-
-                for ( ix=0; ix<n_grx-1; ++ix ) if ( x < grx[ix+1] ) break;
-                for ( iz=0; iz<n_grz-1; ++iz ) if ( z < grz[iz+1] ) break;
-
-                while ( x < xr ) {
-
-                    double zi = m*grx[ix+1] + b;
-
-                    if ( up ) {
-                        while ( z < zi && z < zr ) {
-                            int64_t iCell = ix*(n_grz-1) + iz;
-
-                            double ze = grz[iz+1]<zi ? grz[iz+1] : zi;
-                            ze = ze<zr ? ze : zr;
-                            double xe = (ze-b)/m;
-                            double dlx = xe - x;
-                            double dlz = ze - z;
-
-                            indices_p[k] = iCell;
-                            data_p[k] = dlx;
-                            k++;
-                            indices_p[k] = iCell+nCells;
-                            data_p[k] = dlz;
-                            k++;
-
-                            if (k>=nLmax){
-                                size_t oldnzmax = nLmax;
-                                percent_sp += 0.1;
-                                nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                                /* make sure nzmax increases at least by 2 */
-                                if (oldnzmax == nLmax) nLmax+=2;
-
-                                data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                                indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                            }
-
-                            x = xe;
-                            z = ze;
-                            if ( fabs(z-grz[iz+1])<small ) iz++;
-                        }
-                    } else {
-                        while ( z > zi && z > zr ) {
-                            int64_t iCell = ix*(n_grz-1) + iz;
-
-                            double ze = grz[iz]>zi ? grz[iz] : zi;
-                            ze = ze>zr ? ze : zr;
-                            double xe = (ze-b)/m;
-                            double dlx = xe - x;
-                            double dlz = ze - z;
-
-                            indices_p[k] = iCell;
-                            data_p[k] = dlx;
-                            k++;
-                            indices_p[k] = iCell+nCells;
-                            data_p[k] = dlz;
-                            k++;
-
-                            if (k>=nLmax){
-                                size_t oldnzmax = nLmax;
-                                percent_sp += 0.1;
-                                nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                                /* make sure nzmax increases at least by 2 */
-                                if (oldnzmax == nLmax) nLmax+=2;
-
-                                data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                                indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                            }
-
-                            x = xe;
-                            z = ze;
-                            if ( fabs(z-grz[iz])<small ) iz--;
-                        }
-                    }
-
-                    ix++;
-                    x = grx[ix];
-                }
-            }
-        }
-        indptr_p[nTx] = k;
-        size_t nnz = k;
-
-        data_p = (double*)realloc( data_p, nnz*sizeof(double) );
-        indices_p = (int64_t*)realloc( indices_p, nnz*sizeof(int64_t) );
-
-        import_array();  // to use PyArray_SimpleNewFromData
-
-        npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-        PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-        PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-        PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-        PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-        dims[0] = nTx+1;
-        PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-        PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-        PyTuple_SetItem(L, 0, data);
-        PyTuple_SetItem(L, 1, indices);
-        PyTuple_SetItem(L, 2, indptr);
-
-        return 0;
+                           PyObject* L,
+                           const size_t nthreads) {
+        return Lsr(Tx, Rx, nTx, grx, n_grx, grz, n_grz, true, nthreads, L);
     }
 }
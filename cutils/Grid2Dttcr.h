@@ -36,6 +36,7 @@
 
 #include "Cell.h"
 #include "Grid2Drcsp.h"
+#include "Grid2Drcfs.h"
 
 
 namespace ttcr {
@@ -44,10 +45,12 @@ namespace ttcr {
     typedef Grid2Drcsp<double,uint32_t,Cell<double,Node2Dcsp<double,uint32_t>,sxz<double>>> gridiso;
     typedef Grid2Drcsp<double,uint32_t,CellElliptical<double,Node2Dcsp<double,uint32_t>,sxz<double>>> gridaniso;
     typedef Grid2Drcsp<double,uint32_t,CellTiltedElliptical<double,Node2Dcsp<double,uint32_t>,sxz<double>>> gridtilted;
+    typedef Grid2Drcfs<double,uint32_t> gridfsm;
     
     class Grid2Dttcr {
     public:
-        Grid2Dttcr(std::string&, uint32_t, uint32_t, double, double, double, double, uint32_t, uint32_t, size_t);
+        Grid2Dttcr(std::string&, uint32_t, uint32_t, double, double, double, double, uint32_t, uint32_t, size_t,
+                   const std::string& method="spm");
         ~Grid2Dttcr() {
             delete grid_instance;
         }
@@ -70,6 +73,11 @@ namespace ttcr {
                      double* traveltimes,
                      PyObject* L) const;
         
+        int raytrace(const std::vector<sxz<double>>& Tx,
+                     const std::vector<double>& tTx,
+                     const std::vector<sxz<double>>& Rx,
+                     double* traveltimes) const;
+        
         static int Lsr2d(const double* Tx,
                           const double* Rx,
                           const size_t nTx,
@@ -77,7 +85,8 @@ namespace ttcr {
                           const size_t n_grx,
                           const double* grz,
                           const size_t n_grz,
-                          PyObject* L);
+                          PyObject* L,
+                          const size_t nthreads=1);
 
 		static int Lsr2da(const double* Tx,
 						   const double* Rx,
@@ -86,7 +95,8 @@ namespace ttcr {
 						   const size_t n_grx,
 						   const double* grz,
 						   const size_t n_grz,
-						   PyObject* L);
+						   PyObject* L,
+						   const size_t nthreads=1);
 
 		
     private:
@@ -94,6 +104,27 @@ namespace ttcr {
         grid *grid_instance;
 		
         Grid2Dttcr() {}
+
+        void buildL(const std::vector<std::vector<siv2<double>>>& L_data,
+                    PyObject* L) const;
+
+        static void Lsr2dRay(double xs, double zs, double xr, double zr,
+                             const double* grx, const size_t n_grx,
+                             const double* grz, const size_t n_grz,
+                             const bool aniso,
+                             std::vector<int64_t>& indices,
+                             std::vector<double>& data);
+
+        static int Lsr(const double* Tx,
+                       const double* Rx,
+                       const size_t nTx,
+                       const double* grx,
+                       const size_t n_grx,
+                       const double* grz,
+                       const size_t n_grz,
+                       const bool aniso,
+                       size_t nthreads,
+                       PyObject* L);
     };
 	
 }
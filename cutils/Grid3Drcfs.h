@@ -0,0 +1,502 @@
+//
+//  Grid3Drcfs.h
+//  ttcr
+//
+//  Copyright © 2017 Bernard Giroux. All rights reserved.
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+/*
+ * Fast sweeping method on a 3D rectilinear grid, slowness defined for cells
+ *
+ * 3D counterpart of Grid2Drcfs: traveltimes are computed at the nodes of a
+ * grid obtained by dividing each cell in (nsnx+1) x (nsny+1) x (nsnz+1)
+ * subcells, raypaths are obtained by gradient descent of the traveltime field
+ * and traveltimes at Rx are computed along the raypaths.
+ *
+ * Cells are numbered with z varying fastest, then y, then x.
+ *
+ * Reference paper
+ *
+ * @article{zhao2005,
+ *  author = {Hongkai Zhao},
+ *  title = {A fast sweeping method for eikonal equations},
+ *  journal = {Mathematics of Computation},
+ *  year = {2005},
+ *  volume = {74},
+ *  number = {250},
+ *  pages = {603-627},
+ *  doi = {10.1090/S0025-5718-04-01678-3}
+ * }
+ *
+ */
+
+#ifndef __GRID3DRCFS_H__
+#define __GRID3DRCFS_H__
+
+#include <algorithm>
+#include <cmath>
+#include <iostream>
+#include <limits>
+#include <map>
+#include <vector>
+
+#include "ttcr_t.h"
+
+namespace ttcr {
+
+    template<typename T1, typename T2>
+    class Grid3Drcfs {
+    public:
+        Grid3Drcfs(const T2 nx, const T2 ny, const T2 nz,
+                   const T1 ddx, const T1 ddy, const T1 ddz,
+                   const T1 minx, const T1 miny, const T1 minz,
+                   const T2 nnx, const T2 nny, const T2 nnz,
+                   const size_t nt=1, const T1 eps=1.e-12, const int maxit=20,
+                   const T2 ninit=2);
+
+        int setSlowness(const std::vector<T1>& s) {
+            if ( s.size() != slowness.size() ) return 1;
+            slowness = s;
+            return 0;
+        }
+
+        // r_data and l_data are not computed if null
+        int raytrace(const std::vector<sxyz<T1>>& Tx,
+                     const std::vector<T1>& t0,
+                     const std::vector<sxyz<T1>>& Rx,
+                     std::vector<T1>& traveltimes,
+                     std::vector<std::vector<sxyz<double>>>* r_data,
+                     std::vector<std::vector<siv<double>>>* l_data) const;
+
+        size_t getNumberOfNodes() const { return (nnx+1)*(nny+1)*(nnz+1); }
+        size_t getNumberOfCells() const { return ncx*ncy*ncz; }
+        const size_t getNthreads() const { return nThreads; }
+
+    private:
+        size_t nThreads;
+        T1 dx;           // cell size in x
+        T1 dy;           // cell size in y
+        T1 dz;           // cell size in z
+        T1 xmin;         // x origin of the grid
+        T1 ymin;         // y origin of the grid
+        T1 zmin;         // z origin of the grid
+        T1 xmax;         // x end of the grid
+        T1 ymax;         // y end of the grid
+        T1 zmax;         // z end of the grid
+        T2 ncx;          // number of cells in x
+        T2 ncy;          // number of cells in y
+        T2 ncz;          // number of cells in z
+        T2 nsx;          // number of subcells per cell in x
+        T2 nsy;          // number of subcells per cell in y
+        T2 nsz;          // number of subcells per cell in z
+        T2 nnx;          // number of subcells in x
+        T2 nny;          // number of subcells in y
+        T2 nnz;          // number of subcells in z
+        T1 dxs;          // subcell size in x
+        T1 dys;          // subcell size in y
+        T1 dzs;          // subcell size in z
+        T1 epsilon;      // convergence criterion of the sweeps
+        int maxit;       // max number of iterations (8 sweeps each)
+        T2 nInit;        // number of cells around Tx initialized with straight rays
+
+        std::vector<T1> slowness;
+
+        size_t nodeNo(const T2 i, const T2 j, const T2 k) const {
+            return (static_cast<size_t>(i)*(nny+1) + j)*(nnz+1) + k;
+        }
+
+        T1 getSlowness(const T2 i, const T2 j, const T2 k) const {
+            return slowness[ (static_cast<size_t>(i/nsx)*ncy + j/nsy)*ncz + k/nsz ];
+        }
+
+        size_t getCellNo(const sxyz<T1>& pt) const {
+            T2 i = static_cast<T2>( std::max(T1(0), std::min(T1(ncx-1), std::floor((pt.x-xmin)/dx))) );
+            T2 j = static_cast<T2>( std::max(T1(0), std::min(T1(ncy-1), std::floor((pt.y-ymin)/dy))) );
+            T2 k = static_cast<T2>( std::max(T1(0), std::min(T1(ncz-1), std::floor((pt.z-zmin)/dz))) );
+            return (static_cast<size_t>(i)*ncy + j)*ncz + k;
+        }
+
+        void getSubcell(const sxyz<T1>& pt, T2& i, T2& j, T2& k) const {
+            i = static_cast<T2>( std::max(T1(0), std::min(T1(nnx-1), std::floor((pt.x-xmin)/dxs))) );
+            j = static_cast<T2>( std::max(T1(0), std::min(T1(nny-1), std::floor((pt.y-ymin)/dys))) );
+            k = static_cast<T2>( std::max(T1(0), std::min(T1(nnz-1), std::floor((pt.z-zmin)/dzs))) );
+        }
+
+        int checkPts(const std::vector<sxyz<T1>>&) const;
+
+        void solve(const std::vector<sxyz<T1>>& Tx,
+                   const std::vector<T1>& t0,
+                   std::vector<T1>& tt) const;
+
+        T1 update(const T2 i, const T2 j, const T2 k, const std::vector<T1>& tt) const;
+
+        int getRaypath(const std::vector<sxyz<T1>>& Tx,
+                       const std::vector<T1>& t0,
+                       const sxyz<T1>& Rx,
+                       const std::vector<T1>& tt,
+                       T1& traveltime,
+                       std::vector<sxyz<double>>* r_data,
+                       std::vector<siv<double>>* l_data) const;
+
+        void addSegment(const sxyz<T1>& p0, const sxyz<T1>& p1,
+                        std::map<size_t,T1>& lengths) const;
+
+        T1 getStraightTime(const sxyz<T1>& p0, const sxyz<T1>& p1) const {
+            std::map<size_t,T1> lengths;
+            addSegment(p0, p1, lengths);
+            T1 t = 0.;
+            for ( auto it=lengths.begin(); it!=lengths.end(); ++it ) {
+                t += it->second * slowness[it->first];
+            }
+            return t;
+        }
+    };
+
+
+    template<typename T1, typename T2>
+    Grid3Drcfs<T1,T2>::Grid3Drcfs(const T2 nx, const T2 ny, const T2 nz,
+                                  const T1 ddx, const T1 ddy, const T1 ddz,
+                                  const T1 minx, const T1 miny, const T1 minz,
+                                  const T2 nnx_, const T2 nny_, const T2 nnz_,
+                                  const size_t nt, const T1 eps, const int maxit_,
+                                  const T2 ninit) : nThreads(nt),
+    dx(ddx), dy(ddy), dz(ddz), xmin(minx), ymin(miny), zmin(minz),
+    xmax(minx+nx*ddx), ymax(miny+ny*ddy), zmax(minz+nz*ddz),
+    ncx(nx), ncy(ny), ncz(nz), nsx(nnx_+1), nsy(nny_+1), nsz(nnz_+1),
+    nnx(nx*(nnx_+1)), nny(ny*(nny_+1)), nnz(nz*(nnz_+1)),
+    dxs(ddx/(nnx_+1)), dys(ddy/(nny_+1)), dzs(ddz/(nnz_+1)),
+    epsilon(eps), maxit(maxit_), nInit(ninit),
+    slowness(std::vector<T1>(static_cast<size_t>(nx)*ny*nz))
+    { }
+
+
+    template<typename T1, typename T2>
+    int Grid3Drcfs<T1,T2>::checkPts(const std::vector<sxyz<T1>>& pts) const {
+        for (size_t n=0; n<pts.size(); ++n) {
+            if ( pts[n].x < xmin || pts[n].x > xmax ||
+                pts[n].y < ymin || pts[n].y > ymax ||
+                pts[n].z < zmin || pts[n].z > zmax ) {
+                std::cerr << "Error: point no " << (n+1)
+                << " outside the grid.\n";
+                return 1;
+            }
+        }
+        return 0;
+    }
+
+
+    template<typename T1, typename T2>
+    T1 Grid3Drcfs<T1,T2>::update(const T2 i, const T2 j, const T2 k,
+                                 const std::vector<T1>& tt) const {
+
+        // first order upwind update using the 8 subcells sharing node (i,j,k)
+        const T1 inf = std::numeric_limits<T1>::max();
+        const T1 h[] = {dxs, dys, dzs};
+        T1 tmin = inf;
+
+        for ( int di=-1; di<=1; di+=2 ) {
+            if ( (di<0 && i==0) || (di>0 && i==nnx) ) continue;
+            T1 a = tt[ nodeNo(i+di, j, k) ];
+            T2 ci = di<0 ? i-1 : i;
+
+            for ( int dj=-1; dj<=1; dj+=2 ) {
+                if ( (dj<0 && j==0) || (dj>0 && j==nny) ) continue;
+                T1 b = tt[ nodeNo(i, j+dj, k) ];
+                T2 cj = dj<0 ? j-1 : j;
+
+                for ( int dk=-1; dk<=1; dk+=2 ) {
+                    if ( (dk<0 && k==0) || (dk>0 && k==nnz) ) continue;
+                    T1 c = tt[ nodeNo(i, j, k+dk) ];
+                    T2 ck = dk<0 ? k-1 : k;
+
+                    T1 s = getSlowness(ci, cj, ck);
+
+                    // neighbours sorted by increasing time, the solution of
+                    // sum_m ((t-v_m)/h_m)^2 = s^2 is built with the m first
+                    // neighbours until it is not larger than the next one
+                    T1 v[] = {a, b, c};
+                    T1 ih2[] = {1./(h[0]*h[0]), 1./(h[1]*h[1]), 1./(h[2]*h[2])};
+                    for ( int m=1; m<3; ++m ) {
+                        for ( int l=m; l>0 && v[l]<v[l-1]; --l ) {
+                            std::swap(v[l], v[l-1]);
+                            std::swap(ih2[l], ih2[l-1]);
+                        }
+                    }
+                    if ( v[0] == inf ) continue;
+
+                    T1 A = 0., B = 0., C = -s*s;
+                    T1 t = inf;
+                    for ( int m=0; m<3; ++m ) {
+                        if ( v[m] == inf || (m>0 && t <= v[m]) ) break;
+                        A += ih2[m];
+                        B += v[m]*ih2[m];
+                        C += v[m]*v[m]*ih2[m];
+                        T1 disc = B*B - A*C;
+                        if ( disc < 0. ) break;
+                        t = (B + std::sqrt(disc))/A;
+                    }
+                    tmin = std::min(tmin, t);
+                }
+            }
+        }
+        return tmin;
+    }
+
+
+    template<typename T1, typename T2>
+    void Grid3Drcfs<T1,T2>::solve(const std::vector<sxyz<T1>>& Tx,
+                                  const std::vector<T1>& t0,
+                                  std::vector<T1>& tt) const {
+
+        tt.assign( getNumberOfNodes(), std::numeric_limits<T1>::max() );
+        std::vector<bool> frozen( tt.size(), false );
+
+        // rays are close to straight lines near the sources, traveltimes at
+        // nodes of the cells around the sources are computed along straight
+        // lines and kept fixed during the sweeps
+        for ( size_t n=0; n<Tx.size(); ++n ) {
+            T2 i, j, k;
+            getSubcell(Tx[n], i, j, k);
+            T2 i1 = i/nsx > nInit ? (i/nsx-nInit)*nsx : 0;
+            T2 i2 = std::min(nnx, (i/nsx+nInit+1)*nsx);
+            T2 j1 = j/nsy > nInit ? (j/nsy-nInit)*nsy : 0;
+            T2 j2 = std::min(nny, (j/nsy+nInit+1)*nsy);
+            T2 k1 = k/nsz > nInit ? (k/nsz-nInit)*nsz : 0;
+            T2 k2 = std::min(nnz, (k/nsz+nInit+1)*nsz);
+            for ( T2 ii=i1; ii<=i2; ++ii ) {
+                for ( T2 jj=j1; jj<=j2; ++jj ) {
+                    for ( T2 kk=k1; kk<=k2; ++kk ) {
+                        sxyz<T1> node(xmin + ii*dxs, ymin + jj*dys, zmin + kk*dzs);
+                        T1 t = t0[n] + getStraightTime(Tx[n], node);
+                        size_t nn = nodeNo(ii, jj, kk);
+                        if ( t < tt[nn] ) tt[nn] = t;
+                        frozen[nn] = true;
+                    }
+                }
+            }
+        }
+
+        // Gauss-Seidel iterations with alternating sweep directions
+        for ( int it=0; it<maxit; ++it ) {
+            T1 change = 0.;
+            for ( int sweep=0; sweep<8; ++sweep ) {
+                bool xfwd = (sweep & 1) == 0;
+                bool yfwd = (sweep & 2) == 0;
+                bool zfwd = (sweep & 4) == 0;
+                for ( T2 ni=0; ni<=nnx; ++ni ) {
+                    T2 i = xfwd ? ni : nnx-ni;
+                    for ( T2 nj=0; nj<=nny; ++nj ) {
+                        T2 j = yfwd ? nj : nny-nj;
+                        for ( T2 nk=0; nk<=nnz; ++nk ) {
+                            T2 k = zfwd ? nk : nnz-nk;
+                            size_t nn = nodeNo(i, j, k);
+                            if ( frozen[nn] ) continue;
+                            T1 t = update(i, j, k, tt);
+                            if ( t < tt[nn] ) {
+                                if ( tt[nn] < std::numeric_limits<T1>::max() ) {
+                                    change = std::max(change, tt[nn]-t);
+                                } else {
+                                    change = std::numeric_limits<T1>::max();
+                                }
+                                tt[nn] = t;
+                            }
+                        }
+                    }
+                }
+            }
+            if ( change <= epsilon ) break;
+        }
+    }
+
+
+    template<typename T1, typename T2>
+    void Grid3Drcfs<T1,T2>::addSegment(const sxyz<T1>& p0, const sxyz<T1>& p1,
+                                       std::map<size_t,T1>& lengths) const {
+
+        // segment is split at the intersections with the cell faces
+        T1 len = p0.getDistance(p1);
+        if ( len == 0. ) return;
+        std::vector<T1> t = {0., 1.};
+        const T1 a0[] = {p0.x, p0.y, p0.z};
+        const T1 a1[] = {p1.x, p1.y, p1.z};
+        const T1 amin[] = {xmin, ymin, zmin};
+        const T1 d[] = {dx, dy, dz};
+        for ( int m=0; m<3; ++m ) {
+            if ( a1[m] == a0[m] ) continue;
+            T1 lo = std::min(a0[m], a1[m]);
+            T1 hi = std::max(a0[m], a1[m]);
+            for ( T2 n=static_cast<T2>(std::ceil((lo-amin[m])/d[m])); amin[m]+n*d[m]<hi; ++n ) {
+                t.push_back( (amin[m]+n*d[m]-a0[m])/(a1[m]-a0[m]) );
+            }
+        }
+        std::sort(t.begin(), t.end());
+        for ( size_t n=1; n<t.size(); ++n ) {
+            if ( t[n] <= t[n-1] ) continue;
+            T1 tm = 0.5*(t[n-1]+t[n]);
+            sxyz<T1> mid(p0.x + tm*(p1.x-p0.x), p0.y + tm*(p1.y-p0.y), p0.z + tm*(p1.z-p0.z));
+            lengths[ getCellNo(mid) ] += (t[n]-t[n-1])*len;
+        }
+    }
+
+
+    template<typename T1, typename T2>
+    int Grid3Drcfs<T1,T2>::getRaypath(const std::vector<sxyz<T1>>& Tx,
+                                      const std::vector<T1>& t0,
+                                      const sxyz<T1>& Rx,
+                                      const std::vector<T1>& tt,
+                                      T1& traveltime,
+                                      std::vector<sxyz<double>>* r_data,
+                                      std::vector<siv<double>>* l_data) const {
+
+        const T1 step = 0.5*std::min(dxs, std::min(dys, dzs));
+        const size_t maxSteps = 20*(nnx+nny+nnz);
+
+        std::map<size_t,T1> lengths;
+        std::vector<sxyz<T1>> r_tmp;
+        sxyz<T1> pt = Rx;
+        r_tmp.push_back( pt );
+
+        bool reachedTx = false;
+        for ( size_t ns=0; ns<maxSteps; ++ns ) {
+
+            // go straight to Tx once in its cell or close enough
+            for ( size_t n=0; n<Tx.size(); ++n ) {
+                if ( getCellNo(Tx[n]) == getCellNo(pt) || pt.getDistance(Tx[n]) <= step ) {
+                    addSegment(pt, Tx[n], lengths);
+                    r_tmp.push_back( Tx[n] );
+                    traveltime = t0[n];
+                    reachedTx = true;
+                    break;
+                }
+            }
+            if ( reachedTx ) break;
+
+            // gradient of the trilinear interpolant in the subcell
+            T2 i, j, k;
+            getSubcell(pt, i, j, k);
+            T1 u = (pt.x - xmin)/dxs - i;
+            T1 v = (pt.y - ymin)/dys - j;
+            T1 w = (pt.z - zmin)/dzs - k;
+            T1 c[2][2][2];
+            for ( T2 a=0; a<2; ++a )
+                for ( T2 b=0; b<2; ++b )
+                    for ( T2 e=0; e<2; ++e )
+                        c[a][b][e] = tt[ nodeNo(i+a, j+b, k+e) ];
+
+            T1 gx = 0., gy = 0., gz = 0.;
+            for ( T2 b=0; b<2; ++b ) {
+                for ( T2 e=0; e<2; ++e ) {
+                    T1 wb = b ? v : 1.-v;
+                    T1 we = e ? w : 1.-w;
+                    gx += (c[1][b][e]-c[0][b][e])*wb*we;
+                }
+            }
+            for ( T2 a=0; a<2; ++a ) {
+                for ( T2 e=0; e<2; ++e ) {
+                    T1 wa = a ? u : 1.-u;
+                    T1 we = e ? w : 1.-w;
+                    gy += (c[a][1][e]-c[a][0][e])*wa*we;
+                }
+            }
+            for ( T2 a=0; a<2; ++a ) {
+                for ( T2 b=0; b<2; ++b ) {
+                    T1 wa = a ? u : 1.-u;
+                    T1 wb = b ? v : 1.-v;
+                    gz += (c[a][b][1]-c[a][b][0])*wa*wb;
+                }
+            }
+            gx /= dxs;
+            gy /= dys;
+            gz /= dzs;
+            T1 g = std::sqrt(gx*gx + gy*gy + gz*gz);
+            if ( g == 0. ) {
+                break;
+            }
+
+            sxyz<T1> next(pt.x - step*gx/g, pt.y - step*gy/g, pt.z - step*gz/g);
+            next.x = std::max(xmin, std::min(xmax, next.x));
+            next.y = std::max(ymin, std::min(ymax, next.y));
+            next.z = std::max(zmin, std::min(zmax, next.z));
+
+            addSegment(pt, next, lengths);
+            r_tmp.push_back( next );
+            pt = next;
+        }
+
+        if ( !reachedTx ) {
+            std::cerr << "Error: gradient descent did not reach Tx from Rx ("
+            << Rx.x << ", " << Rx.y << ", " << Rx.z << ").\n";
+            return 1;
+        }
+
+        // traveltime is the integral of slowness along the raypath
+        // std::map keys are sorted, as required to build matrix L
+        if ( l_data != nullptr ) l_data->resize( 0 );
+        for ( auto it=lengths.begin(); it!=lengths.end(); ++it ) {
+            traveltime += it->second * slowness[it->first];
+            if ( l_data != nullptr ) {
+                siv<double> cell;
+                cell.i = it->first;
+                cell.v = it->second;
+                l_data->push_back( cell );
+            }
+        }
+
+        // the order should be from Tx to Rx
+        if ( r_data != nullptr ) {
+            r_data->resize( r_tmp.size() );
+            for ( size_t nn=0; nn<r_tmp.size(); ++nn ) {
+                (*r_data)[nn].x = r_tmp[ r_tmp.size()-1-nn ].x;
+                (*r_data)[nn].y = r_tmp[ r_tmp.size()-1-nn ].y;
+                (*r_data)[nn].z = r_tmp[ r_tmp.size()-1-nn ].z;
+            }
+        }
+        return 0;
+    }
+
+
+    template<typename T1, typename T2>
+    int Grid3Drcfs<T1,T2>::raytrace(const std::vector<sxyz<T1>>& Tx,
+                                    const std::vector<T1>& t0,
+                                    const std::vector<sxyz<T1>>& Rx,
+                                    std::vector<T1>& traveltimes,
+                                    std::vector<std::vector<sxyz<double>>>* r_data,
+                                    std::vector<std::vector<siv<double>>>* l_data) const {
+
+        if ( checkPts(Tx) == 1 ) return 1;
+        if ( checkPts(Rx) == 1 ) return 1;
+
+        // traveltimes at nodes are local to the call, threads do not share them
+        std::vector<T1> tt;
+        solve(Tx, t0, tt);
+
+        traveltimes.resize( Rx.size() );
+        if ( r_data != nullptr ) r_data->resize( Rx.size() );
+        if ( l_data != nullptr ) l_data->resize( Rx.size() );
+        for (size_t n=0; n<Rx.size(); ++n) {
+            if ( getRaypath(Tx, t0, Rx[n], tt, traveltimes[n],
+                            r_data != nullptr ? &(*r_data)[n] : nullptr,
+                            l_data != nullptr ? &(*l_data)[n] : nullptr) == 1 ) return 1;
+        }
+        return 0;
+    }
+
+}
+
+#endif
@@ -0,0 +1,326 @@
+//
+//  Grid3Dttcr.cpp
+//  ttcr
+//
+//  Copyright © 2017 Bernard Giroux. All rights reserved.
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+#include <algorithm>
+#include <functional>
+#include <map>
+#include <stdexcept>
+#include <thread>
+#include <tuple>
+
+#include "Grid3Dttcr.h"
+
+using namespace std;
+
+
+namespace ttcr {
+
+    Grid3Dttcr::Grid3Dttcr(uint32_t nx, uint32_t ny, uint32_t nz,
+                           double dx, double dy, double dz,
+                           double xmin, double ymin, double zmin,
+                           uint32_t nsnx, uint32_t nsny, uint32_t nsnz,
+                           size_t nthreads) {
+        grid_instance = new grid3d(nx, ny, nz, dx, dy, dz, xmin, ymin, zmin,
+                                   nsnx, nsny, nsnz, nthreads);
+    }
+
+    void Grid3Dttcr::setSlowness(const std::vector<double>& slowness) {
+        if ( grid_instance->setSlowness(slowness) == 1 ) {
+            throw out_of_range("Slowness values must be defined for each grid cell.");
+        }
+    }
+
+    int Grid3Dttcr::raytrace(const std::vector<sxyz<double>>& Tx,
+                             const std::vector<double>& tTx,
+                             const std::vector<sxyz<double>>& Rx,
+                             double* traveltimes,
+                             PyObject* rays,
+                             PyObject* L) const {
+
+        bool doRays = rays != Py_None;
+        bool doL = L != Py_None;
+
+        /*
+         Looking for redundants Tx pts
+         */
+
+        size_t nTx = Tx.size();
+        vector<vector<sxyz<double>>> vTx;
+        vector<vector<double>> t0;
+        vector<vector<size_t>> iTx;    // indices of Rx corresponding to each Tx
+        map<tuple<double,double,double>, size_t> txNo;
+        for ( size_t ntx=0; ntx<nTx; ++ntx ) {
+            auto key = make_tuple(Tx[ntx].x, Tx[ntx].y, Tx[ntx].z);
+            auto it = txNo.find(key);
+            if ( it == txNo.end() ) {
+                txNo[key] = vTx.size();
+                vTx.push_back( vector<sxyz<double>>(1, Tx[ntx]) );
+                t0.push_back( vector<double>(1, tTx[ntx]) );
+                iTx.push_back( vector<size_t>(1, ntx) );
+            } else {
+                iTx[it->second].push_back( ntx );
+            }
+        }
+
+        vector<vector<sxyz<double>>> vRx( vTx.size() );
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                vRx[nv].push_back( Rx[ iTx[nv][ni] ] );
+            }
+        }
+
+        /*
+         Looping over all non redundant Tx, unique Tx are split in blocks
+         processed by separate threads
+         */
+
+        vector<vector<double>> tt( vTx.size() );
+        vector<vector<vector<sxyz<double>>>> r_data( vTx.size() );
+        vector<vector<vector<siv<double>>>> l_data( vTx.size() );
+
+        size_t num_threads = grid_instance->getNthreads() < vTx.size() ? grid_instance->getNthreads() : vTx.size();
+        if ( num_threads < 1 ) num_threads = 1;
+        size_t blk_size = vTx.size()/num_threads;
+        if ( blk_size == 0 ) blk_size++;
+
+        vector<int> status(num_threads, 0);
+        auto work = [&](size_t i, size_t blk_start, size_t blk_end) {
+            for ( size_t nv=blk_start; nv<blk_end; ++nv ) {
+                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx[nv], tt[nv],
+                                             doRays ? &r_data[nv] : nullptr,
+                                             doL ? &l_data[nv] : nullptr) == 1 ) {
+                    status[i] = 1;
+                    return;
+                }
+            }
+        };
+
+        vector<thread> threads(num_threads-1);
+        size_t blk_start = 0;
+        for ( size_t i=0; i<num_threads-1; ++i ) {
+            size_t blk_end = blk_start + blk_size;
+            threads[i] = thread(work, i, blk_start, blk_end);
+            blk_start = blk_end;
+        }
+        work(num_threads-1, blk_start, vTx.size());
+
+        std::for_each(threads.begin(),threads.end(),
+                      std::mem_fn(&std::thread::join));
+
+        for ( size_t i=0; i<num_threads; ++i ) {
+            if ( status[i] == 1 ) {
+                throw runtime_error("Problem while raytracing.");
+            }
+        }
+
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                traveltimes[ iTx[nv][ni] ] = tt[nv][ni];
+            }
+        }
+
+        import_array();  // to use PyArray_SimpleNewFromData
+
+        if ( doRays ) {
+            // rays must be a pointer to a tuple object of size 2
+            // first element contains the coordinates of all ray points, size is npts x 3 (float32)
+            // second element contains offsets of the rays, size is nRx+1 (int64)
+            size_t nRx = Rx.size();
+            npy_intp dims[] = {static_cast<npy_intp>(nRx+1), 3};
+            int64_t* offsets_p = (int64_t*)malloc( (nRx+1)*sizeof(int64_t) );
+            PyObject* offsets = PyArray_SimpleNewFromData(1, dims, NPY_INT64, offsets_p);
+            PyArray_ENABLEFLAGS((PyArrayObject*)offsets, NPY_ARRAY_OWNDATA);
+
+            offsets_p[0] = 0;
+            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                    offsets_p[ iTx[nv][ni]+1 ] = r_data[nv][ni].size();
+                }
+            }
+            for ( size_t n=0; n<nRx; ++n ) {
+                offsets_p[n+1] += offsets_p[n];
+            }
+
+            dims[0] = static_cast<npy_intp>(offsets_p[nRx]);
+            float* coords_p = (float*)malloc( (offsets_p[nRx]>0 ? 3*offsets_p[nRx] : 1)*sizeof(float) );
+            PyObject* coords = PyArray_SimpleNewFromData(2, dims, NPY_FLOAT32, coords_p);
+            PyArray_ENABLEFLAGS((PyArrayObject*)coords, NPY_ARRAY_OWNDATA);
+
+            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                    float* ray_p = coords_p + 3*offsets_p[ iTx[nv][ni] ];
+                    for ( size_t np=0; np<r_data[nv][ni].size(); ++np ) {
+                        ray_p[3*np] = static_cast<float>(r_data[nv][ni][np].x);
+                        ray_p[3*np+1] = static_cast<float>(r_data[nv][ni][np].y);
+                        ray_p[3*np+2] = static_cast<float>(r_data[nv][ni][np].z);
+                    }
+                }
+            }
+
+            PyTuple_SetItem(rays, 0, coords);
+            PyTuple_SetItem(rays, 1, offsets);
+        }
+
+        if ( doL ) {
+            vector<vector<siv<double>>> L_data(nTx);
+            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                    L_data[ iTx[nv][ni] ] = std::move( l_data[nv][ni] );
+                }
+            }
+            buildL(L_data, L);
+        }
+
+        return 0;
+    }
+
+    void Grid3Dttcr::buildL(const std::vector<std::vector<siv<double>>>& L_data,
+                            PyObject* L) {
+
+        // L must be a pointer to a tuple object of size 3
+        // first element of tuple contains data, size is nnz
+        // second element contains column indices for rows of the matrix, size is nnz
+        // third element contains pointers for indices, size is nrow+1 (nTx+1)
+        //
+        // rows of L_data must be sorted by cell index
+        //
+        // import_array() must have been called by the caller
+
+        size_t nTx = L_data.size();
+        size_t nnz = 0;
+        for ( size_t n=0; n<nTx; ++n ) {
+            nnz += L_data[n].size();
+        }
+
+        npy_intp dims[] = {static_cast<npy_intp>(nnz)};
+        double* data_p = (double*)malloc( (nnz>0 ? nnz : 1)*sizeof(double) );
+        PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
+        PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
+
+        int64_t* indices_p = (int64_t*)malloc( (nnz>0 ? nnz : 1)*sizeof(int64_t) );
+        PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
+        PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
+
+        dims[0] = nTx+1;
+        int64_t* indptr_p = (int64_t*)malloc( (nTx+1)*sizeof(int64_t) );
+        PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
+        PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
+
+        size_t k = 0;
+        for ( size_t i=0; i<nTx; ++i ) {
+            indptr_p[i] = k;
+            for ( size_t n=0; n<L_data[i].size(); ++n ) {
+                indices_p[k] = L_data[i][n].i;
+                data_p[k] = L_data[i][n].v;
+                k++;
+            }
+        }
+        indptr_p[nTx] = k;
+
+        PyTuple_SetItem(L, 0, data);
+        PyTuple_SetItem(L, 1, indices);
+        PyTuple_SetItem(L, 2, indptr);
+    }
+
+    int Grid3Dttcr::Lsr3d(const double* Tx,
+                          const double* Rx,
+                          const size_t nTx,
+                          const double* grx,
+                          const size_t n_grx,
+                          const double* gry,
+                          const size_t n_gry,
+                          const double* grz,
+                          const size_t n_grz,
+                          PyObject* L,
+                          size_t nthreads) {
+
+        // straight rays, segments between Tx and Rx are split at the
+        // intersections with the cell faces
+        const double* gr[] = {grx, gry, grz};
+        const size_t n_gr[] = {n_grx, n_gry, n_grz};
+
+        vector<vector<siv<double>>> L_data(nTx);
+
+        if ( nthreads > nTx ) nthreads = nTx;
+        if ( nthreads < 1 ) nthreads = 1;
+        size_t blk_size = nTx/nthreads;
+        if ( blk_size*nthreads < nTx ) blk_size++;
+
+        auto work = [&](const size_t n1, const size_t n2) {
+            vector<double> t;
+            for ( size_t n=n1; n<n2; ++n ) {
+                const double* p0 = Tx + 3*n;
+                const double* p1 = Rx + 3*n;
+                double len = sqrt( (p1[0]-p0[0])*(p1[0]-p0[0]) +
+                                  (p1[1]-p0[1])*(p1[1]-p0[1]) +
+                                  (p1[2]-p0[2])*(p1[2]-p0[2]) );
+                if ( len == 0.0 ) continue;
+
+                t.assign({0.0, 1.0});
+                for ( size_t m=0; m<3; ++m ) {
+                    if ( p1[m] == p0[m] ) continue;
+                    double lo = p0[m]<p1[m] ? p0[m] : p1[m];
+                    double hi = p0[m]<p1[m] ? p1[m] : p0[m];
+                    for ( const double* g=upper_bound(gr[m], gr[m]+n_gr[m], lo); g<gr[m]+n_gr[m] && *g<hi; ++g ) {
+                        t.push_back( (*g-p0[m])/(p1[m]-p0[m]) );
+                    }
+                }
+                sort(t.begin(), t.end());
+
+                map<size_t, double> lengths;
+                for ( size_t nt=1; nt<t.size(); ++nt ) {
+                    if ( t[nt] <= t[nt-1] ) continue;
+                    double tm = 0.5*(t[nt-1]+t[nt]);
+                    size_t ind[3];
+                    for ( size_t m=0; m<3; ++m ) {
+                        double x = p0[m] + tm*(p1[m]-p0[m]);
+                        size_t i = upper_bound(gr[m], gr[m]+n_gr[m], x) - gr[m];
+                        ind[m] = i == 0 ? 0 : (i >= n_gr[m] ? n_gr[m]-2 : i-1);
+                    }
+                    size_t iCell = (ind[0]*(n_gry-1) + ind[1])*(n_grz-1) + ind[2];
+                    lengths[iCell] += (t[nt]-t[nt-1])*len;
+                }
+                for ( auto it=lengths.begin(); it!=lengths.end(); ++it ) {
+                    siv<double> cell;
+                    cell.i = it->first;
+                    cell.v = it->second;
+                    L_data[n].push_back( cell );
+                }
+            }
+        };
+
+        vector<thread> threads(nthreads-1);
+        for ( size_t nt=0; nt<threads.size(); ++nt ) {
+            size_t n1 = (nt+1)*blk_size;
+            threads[nt] = thread(work, n1 < nTx ? n1 : nTx, n1+blk_size < nTx ? n1+blk_size : nTx);
+        }
+        work(0, blk_size < nTx ? blk_size : nTx);
+        std::for_each(threads.begin(),threads.end(),
+                      std::mem_fn(&std::thread::join));
+
+        import_array();  // to use PyArray_SimpleNewFromData
+        buildL(L_data, L);
+        return 0;
+    }
+
+}
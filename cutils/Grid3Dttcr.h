@@ -0,0 +1,84 @@
+//
+//  Grid3Dttcr.h
+//  ttcr
+//
+//  Copyright © 2017 Bernard Giroux. All rights reserved.
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+#ifndef Grid3Dttcr_h
+#define Grid3Dttcr_h
+
+
+
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include "Python.h"
+#include "numpy/ndarrayobject.h"
+
+#include <string>
+#include <vector>
+
+#include "Grid3Drcfs.h"
+
+
+namespace ttcr {
+
+    typedef Grid3Drcfs<double,uint32_t> grid3d;
+
+    class Grid3Dttcr {
+    public:
+        Grid3Dttcr(uint32_t, uint32_t, uint32_t, double, double, double,
+                   double, double, double, uint32_t, uint32_t, uint32_t, size_t);
+        ~Grid3Dttcr() {
+            delete grid_instance;
+        }
+
+        void setSlowness(const std::vector<double>& slowness);
+
+        // raypaths and/or L are not computed if rays and/or L is None
+        int raytrace(const std::vector<sxyz<double>>& Tx,
+                     const std::vector<double>& tTx,
+                     const std::vector<sxyz<double>>& Rx,
+                     double* traveltimes,
+                     PyObject* rays,
+                     PyObject* L) const;
+
+        static int Lsr3d(const double* Tx,
+                         const double* Rx,
+                         const size_t nTx,
+                         const double* grx,
+                         const size_t n_grx,
+                         const double* gry,
+                         const size_t n_gry,
+                         const double* grz,
+                         const size_t n_grz,
+                         PyObject* L,
+                         size_t nthreads=1);
+
+    private:
+        grid3d *grid_instance;
+
+        Grid3Dttcr() {}
+
+        static void buildL(const std::vector<std::vector<siv<double>>>& L_data,
+                           PyObject* L);
+    };
+
+}
+
+#endif /* Grid3Dttcr_h */
@@ -22,14 +22,13 @@
 from libcpp.string cimport string
 from libcpp.vector cimport vector
 from libc.stdint cimport uint32_t
+from libc.string cimport memcpy
 
 import numpy as np
 cimport numpy as np
 
 from scipy.sparse import csr_matrix
 
-from utils import nargout
-
 cdef extern from "ttcr_t.h" namespace "ttcr":
     cdef cppclass sxz[T]:
         sxz(T, T) except +
@@ -37,26 +36,52 @@ cdef extern from "ttcr_t.h" namespace "ttcr":
 
 cdef extern from "Grid2Dttcr.h" namespace "ttcr":
     cdef cppclass Grid2Dttcr:
-        Grid2Dttcr(string&, uint32_t, uint32_t, double, double, double, double, uint32_t, uint32_t, size_t) except +
+        Grid2Dttcr(string&, uint32_t, uint32_t, double, double, double, double, uint32_t, uint32_t, size_t, string&) except +
         string getType()
         void setSlowness(const vector[double]&) except +
         void setXi(const vector[double]&) except +
         void setTheta(const vector[double]&) except +
-        int raytrace(vector[sxz[double]]&,vector[double]&,vector[sxz[double]]&,double*,object,object)
-        int raytrace(vector[sxz[double]]&,vector[double]&,vector[sxz[double]]&,double*,object)
+        int raytrace(vector[sxz[double]]&,vector[double]&,vector[sxz[double]]&,double*,object,object) except +
+        int raytrace(vector[sxz[double]]&,vector[double]&,vector[sxz[double]]&,double*,object) except +
+        int raytrace(vector[sxz[double]]&,vector[double]&,vector[sxz[double]]&,double*) except +
         @staticmethod
-        int Lsr2d(double*,double*,size_t,double*,size_t,double*,size_t,object)
+        int Lsr2d(double*,double*,size_t,double*,size_t,double*,size_t,object,size_t)
         @staticmethod
-        int Lsr2da(double*,double*,size_t,double*,size_t,double*,size_t,object)
+        int Lsr2da(double*,double*,size_t,double*,size_t,double*,size_t,object,size_t)
+
+
+
+def check_want(want):
+    """
+    Validate the outputs requested from raytrace, returns them as a tuple
+    """
+    if isinstance(want, str):
+        want = (want,)
+    want = tuple(want)
+    if len(want) == 0:
+        raise ValueError('At least one output should be requested')
+    for w in want:
+        if w not in ('tt', 'L', 'rays'):
+            raise ValueError('Unknown raytrace output: ' + repr(w))
+    return want
 
 
+cdef inline void _copy_to_vector(double[::1] src, vector[double]& dst):
+    dst.resize(src.shape[0])
+    if src.shape[0] > 0:
+        memcpy(dst.data(), &src[0], src.shape[0] * sizeof(double))
+
 
 cdef class Grid2Dcpp:
     cdef Grid2Dttcr* grid
     def __cinit__(self, gridType, uint32_t nx, uint32_t nz, double dx, double dz,
                   double xmin, double zmin,uint32_t nsnx, uint32_t nsnz,
-                  size_t nthreads):
-        self.grid = new Grid2Dttcr(gridType, nx, nz, dx, dz, xmin, zmin, nsnx, nsnz, nthreads)
+                  size_t nthreads, method=b'spm'):
+        """
+        method is b'spm' (shortest path) or b'fsm' (fast sweeping, isotropic
+        media only)
+        """
+        self.grid = new Grid2Dttcr(gridType, nx, nz, dx, dz, xmin, zmin, nsnx, nsnz, nthreads, method)
 
     def __dealloc__(self):
         del self.grid
@@ -64,9 +89,16 @@ cdef class Grid2Dcpp:
     def getType(self):
         return self.grid.getType()
 
-    def raytrace(self, slowness, xi, theta, Tx, Rx, t0):
+    def raytrace(self, slowness, xi, theta, Tx, Rx, t0, want=('tt', 'L', 'rays')):
+        """
+        Outputs listed in want ('tt', 'L' and/or 'rays') are returned in the
+        same order, a single requested output is returned alone
+
+        rays is a tuple (coords, offsets): coords holds the points of all rays
+        (npts x 2, float32) and points of ray n are coords[offsets[n]:offsets[n+1]]
+        """
+        want = check_want(want)
 
-        nout = nargout()
         # check if types are consistent with input data
         if len(xi) != 0:
             if len(theta) != 0:
@@ -79,101 +111,119 @@ cdef class Grid2Dcpp:
             if self.grid.getType() != b'iso':
                 raise TypeError('Grid should handle raytracing in isotropic media')
 
-        # assing model data
-        cdef vector[double] slown# = slowness.tolist()
-        for tmp in slowness:
-            slown.push_back(tmp)
+        # assign model data
+        # input arrays are accessed through typed memoryviews and copied in
+        # the C++ containers without any python-level loop
+        cdef double[::1] s_v = np.ascontiguousarray(slowness, dtype=np.double)
+        cdef double[::1] xi_v
+        cdef double[::1] theta_v
+        cdef double[:, ::1] Tx_v = np.ascontiguousarray(Tx, dtype=np.double)
+        cdef double[:, ::1] Rx_v = np.ascontiguousarray(Rx, dtype=np.double)
+        cdef double[::1] t0_v = np.ascontiguousarray(t0, dtype=np.double)
+        cdef size_t n
+        cdef size_t nTx = Tx_v.shape[0]
+
+        cdef vector[double] slown
+        _copy_to_vector(s_v, slown)
         self.grid.setSlowness(slown)
         cdef vector[double] x
         if len(xi) != 0:
-            for tmp in xi:
-                x.push_back(tmp)
+            xi_v = np.ascontiguousarray(xi, dtype=np.double)
+            _copy_to_vector(xi_v, x)
             self.grid.setXi(x)
         cdef vector[double] t
         if len(theta) != 0:
-            for tmp in theta:
-                t.push_back(tmp)
+            theta_v = np.ascontiguousarray(theta, dtype=np.double)
+            _copy_to_vector(theta_v, t)
             self.grid.setTheta(t)
 
         # create C++ input variables
         cdef vector[sxz[double]] cTx
-        for t in Tx:
-            cTx.push_back(sxz[double](t[0], t[2]))
-
         cdef vector[sxz[double]] cRx
-        for r in Rx:
-            cRx.push_back(sxz[double](r[0], r[2]))
+        cTx.reserve(nTx)
+        cRx.reserve(nTx)
+        for n in range(nTx):
+            cTx.push_back(sxz[double](Tx_v[n, 0], Tx_v[n, 2]))
+            cRx.push_back(sxz[double](Rx_v[n, 0], Rx_v[n, 2]))
 
-        cdef vector[double] ct0# = t0.tolist()
-        for tmp in t0:
-            ct0.push_back(tmp)
+        cdef vector[double] ct0
+        _copy_to_vector(t0_v, ct0)
 
         # instantiate output variables
         cdef np.ndarray tt = np.empty([Rx.shape[0],], dtype=np.double)  # tt should be the right size
 
-        if nout==2:
-            Ldata = ([0.0], [0.0], [0.0])
-
-            if self.grid.raytrace(cTx, ct0, cRx, <double*> np.PyArray_DATA(tt), Ldata) != 0:
-                raise RuntimeError()
-
-            M = Rx.shape[0]
-            N = len(slowness)
-            if self.grid.getType() != b'iso':
-                N = 2*N
-
-            L = csr_matrix(Ldata, shape=(M,N))
-
-            return tt,L
-            
-        elif nout==3:
-            rays = tuple([ [0.0] for i in range(Rx.shape[0]) ])
+        out = {'tt': tt}
+        if 'rays' in want:
+            rays = ([0.0], [0.0])
             Ldata = ([0.0], [0.0], [0.0])
 
             if self.grid.raytrace(cTx, ct0, cRx, <double*> np.PyArray_DATA(tt), rays, Ldata) != 0:
-                raise RuntimeError()
+                raise RuntimeError('Problem while raytracing.')
 
-            M = Rx.shape[0]
-            N = len(slowness)
-            if self.grid.getType() != b'iso':
-                N = 2*N
+            out['L'] = self._buildL(Ldata, Rx.shape[0], len(slowness))
+            out['rays'] = rays
 
-            L = csr_matrix(Ldata, shape=(M,N))
+        elif 'L' in want:
+            Ldata = ([0.0], [0.0], [0.0])
 
-            return tt,L,rays
+            if self.grid.raytrace(cTx, ct0, cRx, <double*> np.PyArray_DATA(tt), Ldata) != 0:
+                raise RuntimeError('Problem while raytracing.')
 
+            out['L'] = self._buildL(Ldata, Rx.shape[0], len(slowness))
 
-    @staticmethod
-    def Lsr2d(Tx, Rx, grx, grz):
+        else:
+            if self.grid.raytrace(cTx, ct0, cRx, <double*> np.PyArray_DATA(tt)) != 0:
+                raise RuntimeError('Problem while raytracing.')
 
-        cdef size_t nTx = Tx.shape[0]
-        cdef size_t n_grx = grx.shape[0]
-        cdef size_t n_grz = grz.shape[0]
+        if len(want) == 1:
+            return out[want[0]]
+        return tuple([out[w] for w in want])
 
-        Ldata = ([0.0], [0.0], [0.0])
+    def _buildL(self, Ldata, M, N):
+        if self.grid.getType() != b'iso':
+            N = 2*N
+        return csr_matrix(Ldata, shape=(M,N))
 
-        Grid2Dttcr.Lsr2d(<double*> np.PyArray_DATA(Tx), <double*> np.PyArray_DATA(Rx), nTx, <double*> np.PyArray_DATA(grx), n_grx, <double*> np.PyArray_DATA(grz), n_grz, Ldata)
 
-        M = nTx
-        N = (n_grx-1)*(n_grz-1)
-        L = csr_matrix(Ldata, shape=(M,N))
+    @staticmethod
+    def Lsr2d(Tx, Rx, grx, grz, size_t nthreads=1):
+        """
+        Ray projection matrix for straight rays, Tx and Rx are nTx x 2 (X, Z)
 
-        return L
+        Rays are distributed over nthreads threads, CSR arrays are filled
+        directly in C++
+        """
+        return Grid2Dcpp._Lsr(Tx, Rx, grx, grz, nthreads, False)
 
+    @staticmethod
+    def Lsr2da(Tx, Rx, grx, grz, size_t nthreads=1):
+        """
+        Ray projection matrix for straight rays in anisotropic media: columns
+        hold the lengths of the segments projected along X, then along Z
+        """
+        return Grid2Dcpp._Lsr(Tx, Rx, grx, grz, nthreads, True)
 
     @staticmethod
-    def Lsr2da(Tx, Rx, grx, grz):
+    def _Lsr(Tx, Rx, grx, grz, size_t nthreads, aniso):
 
-        cdef size_t nTx = Tx.shape[0]
-        cdef size_t n_grx = grx.shape[0]
-        cdef size_t n_grz = grz.shape[0]
+        cdef double[:, ::1] Tx_v = np.ascontiguousarray(Tx, dtype=np.double)
+        cdef double[:, ::1] Rx_v = np.ascontiguousarray(Rx, dtype=np.double)
+        cdef double[::1] grx_v = np.ascontiguousarray(grx, dtype=np.double)
+        cdef double[::1] grz_v = np.ascontiguousarray(grz, dtype=np.double)
 
-        Ldata = ([0.0], [0.0], [0.0])
+        cdef size_t nTx = Tx_v.shape[0]
+        cdef size_t n_grx = grx_v.shape[0]
+        cdef size_t n_grz = grz_v.shape[0]
+        cdef double* Tx_p = &Tx_v[0, 0] if nTx > 0 else NULL
+        cdef double* Rx_p = &Rx_v[0, 0] if nTx > 0 else NULL
 
-        Grid2Dttcr.Lsr2da(<double*> np.PyArray_DATA(Tx), <double*> np.PyArray_DATA(Rx), nTx, <double*> np.PyArray_DATA(grx), n_grx, <double*> np.PyArray_DATA(grz), n_grz, Ldata)
+        Ldata = ([0.0], [0.0], [0.0])
 
-        M = nTx
-        N = 2*(n_grx-1)*(n_grz-1)
-        L = csr_matrix(Ldata, shape=(M,N))
+        N = (n_grx-1)*(n_grz-1)
+        if aniso:
+            Grid2Dttcr.Lsr2da(Tx_p, Rx_p, nTx, &grx_v[0], n_grx, &grz_v[0], n_grz, Ldata, nthreads)
+            N *= 2
+        else:
+            Grid2Dttcr.Lsr2d(Tx_p, Rx_p, nTx, &grx_v[0], n_grx, &grz_v[0], n_grz, Ldata, nthreads)
 
-        return L
+        return csr_matrix(Ldata, shape=(nTx, N))
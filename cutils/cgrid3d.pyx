@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Copyright 2017 Bernard Giroux
+    email: bernard.giroux@ete.inrs.ca
+    
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from libcpp.vector cimport vector
+from libc.stdint cimport uint32_t
+from libc.string cimport memcpy
+
+import numpy as np
+cimport numpy as np
+
+from scipy.sparse import csr_matrix
+
+from .cgrid2d import check_want
+
+cdef extern from "ttcr_t.h" namespace "ttcr":
+    cdef cppclass sxyz[T]:
+        sxyz(T, T, T) except +
+
+
+cdef extern from "Grid3Dttcr.h" namespace "ttcr":
+    cdef cppclass Grid3Dttcr:
+        Grid3Dttcr(uint32_t, uint32_t, uint32_t, double, double, double, double, double, double,
+                   uint32_t, uint32_t, uint32_t, size_t) except +
+        void setSlowness(const vector[double]&) except +
+        int raytrace(vector[sxyz[double]]&,vector[double]&,vector[sxyz[double]]&,double*,object,object) except +
+        @staticmethod
+        int Lsr3d(double*,double*,size_t,double*,size_t,double*,size_t,double*,size_t,object,size_t)
+
+
+cdef inline void _copy_to_vector(double[::1] src, vector[double]& dst):
+    dst.resize(src.shape[0])
+    if src.shape[0] > 0:
+        memcpy(dst.data(), &src[0], src.shape[0] * sizeof(double))
+
+
+cdef class Grid3Dcpp:
+    cdef Grid3Dttcr* grid
+    cdef size_t ncell
+    def __cinit__(self, uint32_t nx, uint32_t ny, uint32_t nz, double dx, double dy, double dz,
+                  double xmin, double ymin, double zmin, uint32_t nsnx, uint32_t nsny, uint32_t nsnz,
+                  size_t nthreads):
+        self.grid = new Grid3Dttcr(nx, ny, nz, dx, dy, dz, xmin, ymin, zmin, nsnx, nsny, nsnz, nthreads)
+        self.ncell = nx * ny * nz
+
+    def __dealloc__(self):
+        del self.grid
+
+    def raytrace(self, slowness, xi, theta, Tx, Rx, t0, want=('tt', 'L', 'rays')):
+        """
+        Outputs listed in want ('tt', 'L' and/or 'rays') are returned in the
+        same order, a single requested output is returned alone
+
+        rays is a tuple (coords, offsets): coords holds the points of all rays
+        (npts x 3, float32) and points of ray n are coords[offsets[n]:offsets[n+1]]
+        """
+        want = check_want(want)
+
+        if len(xi) != 0 or len(theta) != 0:
+            raise TypeError('Grid3D only handles raytracing in isotropic media')
+
+        cdef double[::1] s_v = np.ascontiguousarray(slowness, dtype=np.double)
+        cdef double[:, ::1] Tx_v = np.ascontiguousarray(Tx, dtype=np.double)
+        cdef double[:, ::1] Rx_v = np.ascontiguousarray(Rx, dtype=np.double)
+        cdef double[::1] t0_v = np.ascontiguousarray(t0, dtype=np.double)
+        cdef size_t n
+        cdef size_t nTx = Tx_v.shape[0]
+
+        cdef vector[double] slown
+        _copy_to_vector(s_v, slown)
+        self.grid.setSlowness(slown)
+
+        cdef vector[sxyz[double]] cTx
+        cdef vector[sxyz[double]] cRx
+        cTx.reserve(nTx)
+        cRx.reserve(nTx)
+        for n in range(nTx):
+            cTx.push_back(sxyz[double](Tx_v[n, 0], Tx_v[n, 1], Tx_v[n, 2]))
+            cRx.push_back(sxyz[double](Rx_v[n, 0], Rx_v[n, 1], Rx_v[n, 2]))
+
+        cdef vector[double] ct0
+        _copy_to_vector(t0_v, ct0)
+
+        cdef np.ndarray tt = np.empty([nTx,], dtype=np.double)
+        rays = ([0.0], [0.0]) if 'rays' in want else None
+        Ldata = ([0.0], [0.0], [0.0]) if 'L' in want else None
+
+        if self.grid.raytrace(cTx, ct0, cRx, <double*> np.PyArray_DATA(tt), rays, Ldata) != 0:
+            raise RuntimeError()
+
+        out = {'tt': tt, 'rays': rays}
+        if Ldata is not None:
+            out['L'] = csr_matrix(Ldata, shape=(nTx, self.ncell))
+
+        if len(want) == 1:
+            return out[want[0]]
+        return tuple([out[w] for w in want])
+
+    @staticmethod
+    def Lsr3d(Tx, Rx, grx, gry, grz, size_t nthreads=1):
+        """
+        Ray projection matrix for straight rays, rays are distributed over
+        nthreads threads
+        """
+
+        Tx = np.ascontiguousarray(Tx, dtype=np.double)
+        Rx = np.ascontiguousarray(Rx, dtype=np.double)
+        grx = np.ascontiguousarray(grx, dtype=np.double)
+        gry = np.ascontiguousarray(gry, dtype=np.double)
+        grz = np.ascontiguousarray(grz, dtype=np.double)
+
+        cdef size_t nTx = Tx.shape[0]
+        cdef size_t n_grx = grx.shape[0]
+        cdef size_t n_gry = gry.shape[0]
+        cdef size_t n_grz = grz.shape[0]
+
+        Ldata = ([0.0], [0.0], [0.0])
+
+        Grid3Dttcr.Lsr3d(<double*> np.PyArray_DATA(Tx), <double*> np.PyArray_DATA(Rx), nTx,
+                         <double*> np.PyArray_DATA(grx), n_grx, <double*> np.PyArray_DATA(gry), n_gry,
+                         <double*> np.PyArray_DATA(grz), n_grz, Ldata, nthreads)
+
+        M = nTx
+        N = (n_grx-1)*(n_gry-1)*(n_grz-1)
+        return csr_matrix(Ldata, shape=(M,N))
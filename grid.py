@@ -23,17 +23,305 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import hashlib
 import math
+import os
+
 import numpy as np
 from scipy.sparse import csr_matrix
+import scipy.sparse as sp
 import h5py
 
 from cutils import cgrid2d
+from cutils import cgrid3d
 
-from utils import nargout
+from computeutils import LRUCache, sharedPool, worker
 import covar
 
 
+# Building a C++ grid (primary & secondary nodes, neighbours) is costly.  The
+# instances are kept in a small LRU cache shared by all grids with the same
+# geometry, whatever the type of anisotropy needed by the current call.
+# The number of grids kept is cgrid_cache.maxsize.
+cgrid_cache = LRUCache(8)
+
+
+def getCgrid2D(grx, grz, nsnx, nsnz, typeG, nthreads, method='spm'):
+    """
+    Return a cgrid2d.Grid2Dcpp instance for the given geometry, creating it
+    only if not found in the cache
+
+    Input:
+        grx, grz: coordinates of grid nodes along X and Z
+        nsnx, nsnz: number of secondary nodes along X and Z
+        typeG: b'iso', b'elliptical' or b'tilted'
+        nthreads: number of threads used by the C++ grid
+        method: 'spm' (shortest path) or 'fsm' (fast sweeping)
+    """
+    grx = np.ascontiguousarray(grx, dtype=np.double)
+    grz = np.ascontiguousarray(grz, dtype=np.double)
+    key = (grx.tobytes(), grz.tobytes(), int(nsnx), int(nsnz), typeG, int(nthreads), method)
+    if key in cgrid_cache:
+        return cgrid_cache[key]
+
+    nx = len(grx) - 1
+    nz = len(grz) - 1
+    dx = grx[1] - grx[0]
+    dz = grz[1] - grz[0]
+    cgrid = cgrid2d.Grid2Dcpp(typeG, nx, nz, dx, dz, grx[0], grz[0], nsnx, nsnz, nthreads,
+                              method.encode())
+
+    cgrid_cache[key] = cgrid
+    return cgrid
+
+
+def getCgrid3D(grx, gry, grz, nsnx, nsny, nsnz, nthreads):
+    """
+    Return a cgrid3d.Grid3Dcpp instance for the given geometry, creating it
+    only if not found in the cache
+
+    Input:
+        grx, gry, grz: coordinates of grid nodes along X, Y and Z
+        nsnx, nsny, nsnz: number of subdivisions of the cells along X, Y and Z
+        nthreads: number of threads used by the C++ grid
+    """
+    grx = np.ascontiguousarray(grx, dtype=np.double)
+    gry = np.ascontiguousarray(gry, dtype=np.double)
+    grz = np.ascontiguousarray(grz, dtype=np.double)
+    key = ('3D', grx.tobytes(), gry.tobytes(), grz.tobytes(), int(nsnx), int(nsny),
+           int(nsnz), int(nthreads))
+    if key in cgrid_cache:
+        return cgrid_cache[key]
+
+    cgrid = cgrid3d.Grid3Dcpp(len(grx) - 1, len(gry) - 1, len(grz) - 1,
+                              grx[1] - grx[0], gry[1] - gry[0], grz[1] - grz[0],
+                              grx[0], gry[0], grz[0], nsnx, nsny, nsnz, nthreads)
+
+    cgrid_cache[key] = cgrid
+    return cgrid
+
+
+def clearCgridCache():
+    """
+    Free all C++ grids kept in cache
+    """
+    cgrid_cache.clear()
+
+
+# Straight ray matrices are requested repeatedly with the same inputs (e.g.
+# covariance and inversion panels), the last ones built are kept in an LRU
+# cache keyed on a hash of the content of the input arrays
+lsr_cache = LRUCache(8)
+
+
+def cachedLsr(Lsr, Tx, Rx, gr, nthreads=1):
+    """
+    Return the straight ray matrix computed by Lsr(Tx, Rx, *gr), from the
+    cache if these inputs were already seen
+
+    Input:
+        Lsr: Grid2Dcpp.Lsr2d, Grid2Dcpp.Lsr2da or Grid3Dcpp.Lsr3d
+        Tx, Rx: coordinates of the end points of the rays
+        gr: tuple of the coordinates of grid nodes
+        nthreads: number of threads used to build the matrix
+
+    Output:
+        L: ray projection matrix, a copy of the cached instance
+    """
+    h = hashlib.sha1(Lsr.__name__.encode())
+    for a in (Tx, Rx) + tuple(gr):
+        a = np.ascontiguousarray(a, dtype=np.double)
+        h.update(repr(a.shape).encode())
+        h.update(a.data)
+    key = h.digest()
+    if key in lsr_cache:
+        return lsr_cache[key].copy()
+
+    L = Lsr(Tx, Rx, *gr, nthreads=nthreads)
+
+    lsr_cache[key] = L
+    return L.copy()
+
+
+def clearLsrCache():
+    """
+    Free all straight ray matrices kept in cache
+    """
+    lsr_cache.clear()
+
+
+# Spectral matrices of FFT-MA simulations, keyed on the grid and the
+# covariance structures (see Grid2D.preFFTMA)
+fftma_cache = LRUCache(4)
+
+
+def _fftmaKey(grid, cm):
+    h = hashlib.sha1()
+    for a in (grid.grx, grid.grz):
+        a = np.ascontiguousarray(a, dtype=np.double)
+        h.update(repr(a.shape).encode())
+        h.update(a.data)
+    for c in cm:
+        h.update(repr(c.type).encode())
+        for a in (c.range, c.angle, c.sill):
+            a = np.ascontiguousarray(a, dtype=np.double)
+            h.update(repr(a.shape).encode())
+            h.update(a.data)
+    return h.hexdigest()
+
+
+def clearFFTMACache():
+    """
+    Free all FFT-MA spectral matrices kept in cache
+    """
+    fftma_cache.clear()
+
+
+# Worker processes of Grid.raytrace and Grid2D.FFTMA when nprocs > 1 (see
+# computeutils.sharedPool).  Model vectors are held in shared memory, they are
+# not copied for each task.
+
+def _initRaytraceWorker(getCgrid, args):
+    # each process runs a single thread, parallelism is over processes
+    worker['cgrid'] = getCgrid(*args)
+
+
+def _raytraceWorker(args):
+    # a raytracing failure raises RuntimeError (non-zero status of the C++
+    # grid), which pool.map returns to the parent process
+    Tx, Rx, t0, want = args
+    out = worker['cgrid'].raytrace(worker['slowness'], worker['xi'],
+                                   worker['theta'], Tx, Rx, t0, want)
+    if len(want) == 1:
+        out = (out,)
+    return out
+
+
+def _fftma(G, n, seed):
+    # G holds half of the spectrum along the last axis, which has even length
+    N = (G.shape[0], 2 * (G.shape[1] - 1))
+    U = np.random.default_rng(seed).standard_normal(N)
+    Z = np.fft.irfft2(G * np.fft.rfft2(U), s=N)
+    i = [int(round((N[k] + 2) / 2)) for k in range(2)]
+    return Z[i[0]:i[0] + n[0], i[1]:i[1] + n[1]]
+
+
+def _FFTMAWorker(args):
+    n, seeds = args
+    Z = np.empty(n + (len(seeds),))
+    for k, seed in enumerate(seeds):
+        Z[:, :, k] = _fftma(worker['G'], n, seed)
+    return Z
+
+
+class Rays(object):
+    """
+    Raypaths stored in two packed arrays
+
+    coords: coordinates of the points of all rays, X and Z for 2D grids
+        (npts x 2, float32), X, Y and Z for 3D grids (npts x 3, float32)
+    offsets: points of ray n are coords[offsets[n]:offsets[n+1]] (nrays+1, int64),
+        offsets[0] is 0
+
+    Indexing with an integer returns a view on the points of one ray, indexing
+    with a slice, a boolean mask or an array of indices returns a new Rays
+    instance
+    """
+
+    def __init__(self, coords=None, offsets=None):
+        if coords is None:
+            coords = np.empty((0, 2), dtype=np.float32)
+        if offsets is None:
+            offsets = np.zeros((1,), dtype=np.int64)
+        self.coords = np.asarray(coords, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @staticmethod
+    def fromList(rays):
+        """
+        Build instance from a sequence of npts x 2 arrays (format of rays
+        saved with previous versions)
+        """
+        if isinstance(rays, Rays):
+            return rays
+        rays = [np.asarray(r).reshape(-1, 2) for r in rays]
+        offsets = np.zeros((len(rays) + 1,), dtype=np.int64)
+        offsets[1:] = np.cumsum([r.shape[0] for r in rays])
+        if len(rays) == 0:
+            return Rays()
+        return Rays(np.concatenate(rays), offsets)
+
+    @staticmethod
+    def concatenate(rays):
+        """
+        Join a sequence of Rays instances
+        """
+        rays = list(rays)
+        if len(rays) == 0:
+            return Rays()
+        coords = np.concatenate([r.coords for r in rays])
+        offsets = [np.zeros((1,), dtype=np.int64)]
+        n = 0
+        for r in rays:
+            offsets.append(r.offsets[1:] + n)
+            n += r.offsets[-1]
+        return Rays(coords, np.concatenate(offsets))
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def __getitem__(self, n):
+        if isinstance(n, (int, np.integer)):
+            if n < 0:
+                n += len(self)
+            if n < 0 or n >= len(self):
+                raise IndexError('Ray index out of range')
+            return self.coords[self.offsets[n]:self.offsets[n + 1], :]
+        return self.take(np.arange(len(self))[n])
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.coords[self.offsets[n]:self.offsets[n + 1], :]
+
+    def nPoints(self):
+        """
+        Returns the number of points of each ray
+        """
+        return np.diff(self.offsets)
+
+    def take(self, ind):
+        """
+        Returns a new instance holding rays with indices ind
+        """
+        ind = np.asarray(ind, dtype=np.int64).ravel()
+        npts = self.nPoints()[ind]
+        offsets = np.zeros((ind.size + 1,), dtype=np.int64)
+        np.cumsum(npts, out=offsets[1:])
+        ipts = np.arange(offsets[-1], dtype=np.int64)
+        ipts += np.repeat(self.offsets[ind] - offsets[:-1], npts)
+        return Rays(self.coords[ipts, :], offsets)
+
+    def reversed(self):
+        """
+        Returns a new instance with the order of the points of each ray reversed
+        """
+        npts = self.nPoints()
+        ipts = np.repeat(self.offsets[:-1] + self.offsets[1:] - 1, npts)
+        ipts -= np.arange(self.offsets[-1], dtype=np.int64)
+        return Rays(self.coords[ipts, :], self.offsets.copy())
+
+    def toLineCollection(self, **kwargs):
+        """
+        Returns a matplotlib LineCollection of the rays (Line3DCollection for
+        3D rays), kwargs are passed to the collection constructor
+        """
+        if self.coords.shape[1] == 3:
+            from mpl_toolkits.mplot3d.art3d import Line3DCollection
+            return Line3DCollection(np.split(self.coords, self.offsets[1:-1]), **kwargs)
+        from matplotlib.collections import LineCollection
+        return LineCollection(np.split(self.coords, self.offsets[1:-1]), **kwargs)
+
+
 class Grid(object):
     """
     Superclass for 2D and 3D grids
@@ -56,6 +344,7 @@ class Grid(object):
         self.Tx_Z_water = np.nan
         self.Rx_Z_water = np.nan
         self.in_vect = np.array([])
+        self._raytraceState = None  # results kept for incremental raytracing, not pickled
 
     def getNumberOfCells(self):
         """
@@ -75,6 +364,15 @@ class Grid(object):
         else:
             return (self.grx.size - 1, self.grz.size - 1)
 
+    def getCellSize(self):
+        """
+        Returns a tuple with the size of the cells in each dimension
+        """
+        if self.gry.size > 1:
+            return (self.dx, self.dy, self.dz)
+        else:
+            return (self.dx, self.dz)
+
     @property
     def dx(self):
         return self.grx[1] - self.grx[0]
@@ -260,6 +558,138 @@ class Grid(object):
         return m_data
 
 
+    def _getCgridFactory(self, typeG, nthreads):
+        """
+        Returns the function creating the C++ grid used for raytracing, and
+        its arguments (to be defined in subclasses)
+        """
+        raise NotImplementedError
+
+    def _raytrace(self, slowness, Tx, Rx, t0, xi, theta, want, typeG, nprocs, reciprocity):
+        """
+        Raytrace with checked input data, outputs are returned in a list
+        ordered as in want
+        """
+        # the C++ code only processes each unique Tx once
+        _, iTx = np.unique(Tx[:, self._txCols], axis=0, return_inverse=True)
+        iTx = iTx.ravel()
+        swapped = False
+        if reciprocity and not np.any(t0):
+            _, iRx = np.unique(Rx[:, self._txCols], axis=0, return_inverse=True)
+            iRx = iRx.ravel()
+            if iRx.max() < iTx.max():
+                # traveltimes and L are the same with Tx & Rx swapped
+                Tx, Rx = Rx, Tx
+                iTx = iRx
+                swapped = True
+
+        if nprocs > 1 and iTx.max() > 0:
+            out = self._raytraceDistributed(slowness, Tx, Rx, t0, xi, theta,
+                                            want, typeG, iTx, nprocs)
+        else:
+            getCgrid, args = self._getCgridFactory(typeG, self.nthreads)
+            out = getCgrid(*args).raytrace(slowness, xi, theta, Tx, Rx, t0, want)
+            out = list(out) if len(want) > 1 else [out]
+            if 'rays' in want:
+                i = want.index('rays')
+                out[i] = Rays(*out[i])
+
+        if swapped and 'rays' in want:
+            i = want.index('rays')
+            out[i] = out[i].reversed()
+
+        return out
+
+    def _raytraceIncremental(self, slowness, Tx, Rx, t0, want, nprocs, reciprocity, tol):
+        """
+        Retrace only the Tx-Rx pairs whose raypaths cross cells where the
+        slowness changed by more than tol (relative) since the pair was last
+        traced, traveltimes of the other pairs are computed along the
+        previous raypaths
+
+        Isotropic media only, outputs are returned in a list ordered as in want
+        """
+        slowness = np.array(slowness, dtype=np.double)
+        wantInc = ('tt', 'L', 'rays') if 'rays' in want else ('tt', 'L')
+        key = (Tx.tobytes(), Rx.tobytes(), np.asarray(t0, dtype=np.double).tobytes()) + \
+            tuple([a.tobytes() if isinstance(a, np.ndarray) else a
+                   for a in self._getCgridFactory(b'iso', 1)[1]])
+
+        state = self._raytraceState
+        if state is None or state['key'] != key or ('rays' in want and state['rays'] is None):
+            out = self._raytrace(slowness, Tx, Rx, t0, (), (), wantInc, b'iso', nprocs, reciprocity)
+            state = {'key': key, 'slowness': {0: slowness}, 'gen': np.zeros((Tx.shape[0],), dtype=np.int64)}
+        else:
+            # each pair is compared to the model used when it was last traced
+            L = state['L']
+            retrace = np.zeros((Tx.shape[0],), dtype=bool)
+            for g, s in state['slowness'].items():
+                rows = np.nonzero(state['gen'] == g)[0]
+                changed = np.abs(slowness - s) > tol * np.abs(s)
+                retrace[rows] = np.diff(L[rows, :][:, changed].indptr) > 0
+            keep = np.nonzero(~retrace)[0]
+            redo = np.nonzero(retrace)[0]
+            if redo.size > 0:
+                sub = self._raytrace(slowness, Tx[redo, :], Rx[redo, :], t0[redo], (), (),
+                                     wantInc, b'iso', nprocs, reciprocity)
+            else:
+                sub = [np.empty((0,)), csr_matrix((0, L.shape[1])),
+                       Rays(np.empty((0, len(self._txCols))))]
+
+            order = np.concatenate((keep, redo))
+            inv = np.empty_like(order)
+            inv[order] = np.arange(order.size)
+            out = [np.concatenate((L[keep, :].dot(slowness), sub[0]))[inv],
+                   sp.vstack((L[keep, :], sub[1]), format='csr')[inv, :]]
+            if 'rays' in wantInc:
+                out.append(Rays.concatenate((state['rays'].take(keep), sub[2])).take(inv))
+
+            g = max(state['slowness'].keys()) + 1
+            state['gen'][redo] = g
+            state['slowness'][g] = slowness
+            state['slowness'] = {k: v for k, v in state['slowness'].items()
+                                 if np.any(state['gen'] == k)}
+
+        state['L'] = out[1]
+        state['rays'] = out[2] if 'rays' in wantInc else None
+        self._raytraceState = state
+        return [out[wantInc.index(w)] for w in want]
+
+    def _raytraceDistributed(self, slowness, Tx, Rx, t0, xi, theta, want, typeG, iTx, nprocs):
+        """
+        Raytrace with unique Tx split in groups processed by a pool of processes
+
+        iTx holds the index of the unique Tx of each row of Tx, outputs are
+        returned in a list ordered as in want
+        """
+        nTx = iTx.max() + 1
+        nprocs = min(nprocs, nTx)
+        # rows sorted by Tx, then split in groups with same number of unique Tx
+        order = np.argsort(iTx, kind='stable')
+        bounds = np.searchsorted(iTx[order], [int(round(n * nTx / nprocs)) for n in range(nprocs + 1)])
+        tasks = []
+        for n in range(nprocs):
+            ind = order[bounds[n]:bounds[n + 1]]
+            tasks.append((Tx[ind, :], Rx[ind, :], t0[ind], want))
+
+        arrays = {'slowness': slowness, 'xi': xi, 'theta': theta}
+        with sharedPool(nprocs, arrays, _initRaytraceWorker, self._getCgridFactory(typeG, 1)) as pool:
+            results = pool.map(_raytraceWorker, tasks)
+
+        # put the rows back in the order of the input data
+        inv = np.empty_like(order)
+        inv[order] = np.arange(order.size)
+        out = []
+        for i, w in enumerate(want):
+            if w == 'tt':
+                out.append(np.concatenate([r[i] for r in results])[inv])
+            elif w == 'L':
+                out.append(sp.vstack([r[i] for r in results], format='csr')[inv, :])
+            else:
+                out.append(Rays.concatenate([Rays(*r[i]) for r in results]).take(inv))
+        return out
+
+
 class Grid2D(Grid):
     """
     Class for 2D grids
@@ -273,6 +703,8 @@ class Grid2D(Grid):
 
     """
 
+    _txCols = [0, 2]  # coordinates of Tx & Rx used by the C++ grid
+
     def __init__(self, grx=None, grz=None, nthreads=1):
         Grid.__init__(self)
         if grx is not None:
@@ -282,7 +714,8 @@ class Grid2D(Grid):
         self.nthreads = nthreads
         self.nsnx = 10
         self.nsnz = 10
-        self.cgrid = None
+        self.method = 'spm'   # 'spm': shortest path, 'fsm': fast sweeping (isotropic media)
+        self.nsn_fsm = 2      # secondary nodes per cell edge for the fast sweeping method
         self.border = np.array([1, 1, 1, 1])
         self.flip = 0
         self.borehole_x0 = 1
@@ -290,18 +723,20 @@ class Grid2D(Grid):
         self.type = None
 
     def __reduce__(self):
-        # cgrid excluded volontarily, it will be set to None after unpickling
-        # (cgrid is instantiated when needed in method raytrace)
+        # the C++ grid is not part of the instance, it is fetched from the
+        # module cache when needed in method raytrace (see getCgrid2D)
         # this is done to avoid writing code to pickle cython class Grid2Dcpp
         return (Grid2D.rebuild, (self.grx, self.grz, self.cont, self.Tx, self.Rx,
                                  self.TxCosDir, self.RxCosDir, self.border,
                                  self.Tx_Z_water, self.Rx_Z_water, self.in_vect,
                                  self.nthreads, self.nsnx, self.nsnz, self.flip,
-                                 self.borehole_x0, self.x0, self.type))
+                                 self.borehole_x0, self.x0, self.type, self.method,
+                                 self.nsn_fsm))
 
     @staticmethod
     def rebuild(grx, grz, cont, Tx, Rx, TxCosDir, RxCosDir, border, Tx_Z_water,
-                Rx_Z_water, in_vect, nthreads, nsnx, nsnz, flip, borehole_x0, x0, _type):
+                Rx_Z_water, in_vect, nthreads, nsnx, nsnz, flip, borehole_x0, x0, _type,
+                method='spm', nsn_fsm=2):
 
         g = Grid2D(grx, grz, nthreads)
 
@@ -320,16 +755,23 @@ class Grid2D(Grid):
         g.borehole_x0 = borehole_x0
         g.x0 = x0
         g.type = _type
+        g.method = method
+        g.nsn_fsm = nsn_fsm
 
         return g
 
-    def raytrace(self, slowness, Tx, Rx, t0=(), xi=(), theta=()):
+    def raytrace(self, slowness, Tx, Rx, t0=(), xi=(), theta=(), want=('tt', 'L', 'rays'),
+                 nprocs=1, reciprocity=False, incremental=None):
         """
         Compute traveltimes, raypaths and build ray projection matrix
 
+        The shortest path method is used by default; the fast sweeping method
+        is used for isotropic media if attribute method is 'fsm'.
+
         Usages:
             tt,L,rays = grid.raytrace(slowness,Tx,Rx,t0,xi,theta)
-            tt,L = grid.raytrace(slowness,Tx,Rx,t0,xi,theta)  {Note: rays can be omitted from output}
+            tt,L = grid.raytrace(slowness,Tx,Rx,t0,xi,theta,want=('tt','L'))
+            tt = grid.raytrace(slowness,Tx,Rx,t0,xi,theta,want='tt')
 
         Input:
             slowness: vector of slowness values at grid cells (ncell x 1)
@@ -340,14 +782,31 @@ class Grid2D(Grid):
                 values are ratio of slowness in Z over slowness in X
             theta (optional): angle of rotation of the ellipse of anisotropy ( ncell x 1 ),
                 counter-clockwise from horizontal, units in radian
+            want (optional): outputs to compute, any of 'tt', 'L' and 'rays'.
+                Outputs are returned in the same order; a single output is
+                returned alone.  Only traveltimes are computed if want is 'tt',
+                which is much faster than building L and the raypaths.
+            nprocs (optional): number of processes.  If larger than 1, the
+                unique Tx are distributed over a pool of processes, each
+                running a single thread.
+            reciprocity (optional): if true and t0 is zero, rays are traced
+                from Rx when there are fewer unique Rx than unique Tx (one
+                wavefront propagation is needed per unique source point).
+                Raypaths are returned from Tx to Rx in all cases.
+            incremental (optional): relative tolerance on slowness changes.  If
+                given, L and the raypaths of the previous call with the same
+                Tx and Rx are kept, and only pairs whose raypath crosses a cell
+                where slowness changed by more than this tolerance are retraced.
+                Traveltimes of the other pairs are computed along their previous
+                raypaths.  Used for isotropic media only.
         Output:
             tt: vector of traveltimes, ndata by 1
             L: ray projection matrix, ndata by ncell (ndata x 2*ncell for anisotropic media)
-            rays: tuple containing the matrices of coordinates of the ray
-                  paths, ndata by 1.  Each matrix is nPts by 2
+            rays: Rays instance holding the coordinates of the ray paths,
+                  rays[n] is an nPts by 2 array for datum n
         """
 
-        nout = nargout()
+        want = cgrid2d.check_want(want)
         # check input data consistency
 
         if Tx.ndim != 2 or Rx.ndim != 2:
@@ -373,27 +832,32 @@ class Grid2D(Grid):
         elif len(t0) != Tx.shape[0]:
             raise ValueError('Length of t0 should equal number of Tx')
 
-        if self.cgrid is None:
-            nx = len(self.grx) - 1
-            nz = len(self.grz) - 1
-            dx = self.grx[1] - self.grx[0]
-            dz = self.grz[1] - self.grz[0]
+        typeG = b'iso'
+        if len(xi) != 0:
+            if len(theta) != 0:
+                typeG = b'tilted'
+            else:
+                typeG = b'elliptical'
 
-            typeG = b'iso'
-            if len(xi) != 0:
-                if len(theta) != 0:
-                    typeG = b'tilted'
-                else:
-                    typeG = b'elliptical'
-            self.cgrid = cgrid2d.Grid2Dcpp(typeG, nx, nz, dx, dz, self.grx[0], self.grz[0],
-                                           self.nsnx, self.nsnz, self.nthreads)
-
-        if nout == 2:
-            tt, L = self.cgrid.raytrace(slowness, xi, theta, Tx, Rx, t0)
-            return tt, L
-        elif nout == 3:
-            tt, L, rays = self.cgrid.raytrace(slowness, xi, theta, Tx, Rx, t0)
-            return tt, L, rays
+        if incremental is not None and typeG == b'iso':
+            out = self._raytraceIncremental(slowness, Tx, Rx, t0, want, nprocs,
+                                            reciprocity, incremental)
+        else:
+            out = self._raytrace(slowness, Tx, Rx, t0, xi, theta, want, typeG,
+                                 nprocs, reciprocity)
+
+        if len(want) == 1:
+            return out[0]
+        return tuple(out)
+
+    def _getCgridFactory(self, typeG, nthreads):
+        """
+        Returns the function creating the C++ grid used for raytracing, and
+        its arguments
+        """
+        if self.method == 'fsm':
+            return getCgrid2D, (self.grx, self.grz, self.nsn_fsm, self.nsn_fsm, typeG, nthreads, 'fsm')
+        return getCgrid2D, (self.grx, self.grz, self.nsnx, self.nsnz, typeG, nthreads, 'spm')
 
     def getForwardStraightRays(self, ind=None, dx=None, dy=None, dz=None, aniso=False):
         """
@@ -422,10 +886,9 @@ class Grid2D(Grid):
         else:
             grz = np.arange(self.grz[0], self.grz[-1] + small, dz)
 
-        if not aniso:
-            return cgrid2d.Grid2Dcpp.Lsr2d(self.Tx[np.ix_(ind, [0, 2])], self.Rx[np.ix_(ind, [0, 2])], grx, grz)
-        else:
-            return cgrid2d.Grid2Dcpp.Lsr2da(self.Tx[np.ix_(ind, [0, 2])], self.Rx[np.ix_(ind, [0, 2])], grx, grz)
+        Lsr = cgrid2d.Grid2Dcpp.Lsr2da if aniso else cgrid2d.Grid2Dcpp.Lsr2d
+        return cachedLsr(Lsr, self.Tx[np.ix_(ind, [0, 2])], self.Rx[np.ix_(ind, [0, 2])],
+                         (grx, grz), self.nthreads)
 
     def getCellCenter(self, dx=None, dz=None):
         """
@@ -493,8 +956,8 @@ class Grid2D(Grid):
         dx = 1
         dz = 1
         if normalize:
-            dx = self.dx()
-            dz = self.dz()
+            dx = self.dx
+            dz = self.dz
 
         nx = len(self.grx) - 1
         nz = len(self.grz) - 1
@@ -508,8 +971,8 @@ class Grid2D(Grid):
             idx = 1 / dx
             idz = 1 / dz
 
-            i = np.kron(np.arange(nx * nz), np.ones((2, )))
-            j = np.zeros((nz * nx * 2, ))
+            i = np.kron(np.arange(nx * nz), np.ones((2, ), dtype=np.int64))
+            j = np.zeros((nz * nx * 2, ), dtype=np.int64)
             v = np.zeros((nz * nx * 2, ))
 
             jj = np.vstack((np.arange(nz), nz + np.arange(nz))).T
@@ -551,8 +1014,8 @@ class Grid2D(Grid):
             idx2 = 1 / (dx * dx)
             idz2 = 1 / (dz * dz)
 
-            i = np.kron(np.arange(nx * nz), np.ones((3, )))
-            j = np.zeros((nz * nx * 3, ))
+            i = np.kron(np.arange(nx * nz), np.ones((3, ), dtype=np.int64))
+            j = np.zeros((nz * nx * 3, ), dtype=np.int64)
             v = np.zeros((nz * nx * 3, ))
 
             jj = np.vstack((np.arange(nz), nz + np.arange(nz), 2 * nz + np.arange(nz))).T
@@ -587,79 +1050,103 @@ class Grid2D(Grid):
 
         return Dx, Dy, Dz
 
-    def preFFTMA(self, cm):
+    def preFFTMA(self, cm, cachedir=None):
         """
         Compute matrix G for FFT-MA simulations
 
+        G is kept in an LRU cache keyed on the grid and the covariance
+        structures (type, range, angle and sill).
+
         INPUT
             cm: list of covariance models
+            cachedir: if given, G is also saved in this directory and read
+                      back from there when available
 
         OUTPUT
             G: covariance matrix in spectral domain
         """
-        small = 1.0e-6
-        Nx = 2 * self.grx.size
-        Nz = 2 * self.grz.size
-
-        Nx2 = Nx / 2
-        Nz2 = Nz / 2
-
-        x = self.dx * np.hstack((np.arange(Nx2), np.arange(-Nx2 + 1, 1)))
-        z = self.dz * np.hstack((np.arange(Nz2), np.arange(-Nz2 + 1, 1)))
-
-        x = np.kron(x, np.ones((Nz, )))
-        z = np.kron(z, np.ones((1, Nx)).T).flatten()
+        key = _fftmaKey(self, cm)
+        if key in fftma_cache:
+            return fftma_cache[key]
+
+        filename = None
+        if cachedir is not None:
+            filename = os.path.join(cachedir, 'fftma_' + key + '.npy')
+        if filename is not None and os.path.isfile(filename):
+            G = np.load(filename)
+        else:
+            G = self._computeFFTMA(cm)
+            if filename is not None:
+                np.save(filename, G)
 
-        d = 0
-        for c in cm:
-            d = d + c.compute(np.vstack((x, z)).T, np.zeros((1, 2)))
-        K = d.reshape(Nx, Nz)
+        G.flags.writeable = False
+        fftma_cache[key] = G
+        return G
 
-        mk = True
-        while mk:
-            mk = False
-            if np.min(K[0, :]) > small:
-                # Enlarge grid to make sure that covariance falls to zero
-                Nz = 2 * Nz
-                mk = True
+    def _computeFFTMA(self, cm):
+        small = 1.0e-6
 
-            if np.min(K[:, 0]) > small:
-                Nx = 2 * Nx
-                mk = True
+        def lags(N, d):
+            return d * np.hstack((np.arange(N // 2), np.arange(-N // 2 + 1, 1)))
 
-            if mk:
-                Nx2 = Nx / 2
-                Nz2 = Nz / 2
+        def covariance(x, z):
+            d = 0
+            for c in cm:
+                d = d + c.compute(np.vstack((x, z)).T, np.zeros((1, 2)))
+            return np.ravel(d)
 
-                x = self.dx * np.hstack((np.arange(Nx2), np.arange(-Nx2 + 1, 1)))
-                z = self.dz * np.hstack((np.arange(Nz2), np.arange(-Nz2 + 1, 1)))
+        # The domain is enlarged until the covariance falls to zero along
+        # each axis, only the lags along the axes are needed to find its size
+        Nx = 2 * self.grx.size
+        x = lags(Nx, self.dx)
+        while np.min(covariance(x, np.zeros(x.shape))) > small:
+            Nx = 2 * Nx
+            x = lags(Nx, self.dx)
 
-                x = np.kron(x, np.ones((Nz,)))
-                z = np.kron(z, np.ones((1, Nx)).T).flatten()
+        Nz = 2 * self.grz.size
+        z = lags(Nz, self.dz)
+        while np.min(covariance(np.zeros(z.shape), z)) > small:
+            Nz = 2 * Nz
+            z = lags(Nz, self.dz)
 
-                d = 0
-                for c in cm:
-                    d = d + c.compute(np.vstack((x, z)).T, np.zeros((1, 2)))
-                K = d.reshape(Nx, Nz)
+        K = covariance(np.repeat(x, Nz), np.tile(z, Nx)).reshape(Nx, Nz)
 
-        return np.sqrt(np.fft.fft2(K))
+        # K is real and even, its spectrum is real: only the half spectrum
+        # of rfft2 is kept, small negative values due to truncation are zeroed
+        return np.sqrt(np.maximum(np.fft.rfft2(K).real, 0.0))
 
-    def FFTMA(self, G):
+    def FFTMA(self, G, nsim=None, nprocs=1, seed=None):
         """
         Perform FFT-MA simulation using pre-computed spectral matrix
 
         INPUT
             G: covariance matrix in spectral domain as return by preFFTMA
+            nsim: number of realizations (None for a single one)
+            nprocs: number of processes used to generate the realizations
+            seed: seed of the random generator (int or SeedSequence).  Each realization has its own
+                  stream spawned from it, results do not depend on nprocs
 
         OUTPUT
-            Z: simulated field of size nx x nz
+            Z: simulated field of size nx x nz, or nx x nz x nsim
         """
-        Nx, Nz = G.shape
-        U = np.fft.fft2(np.random.randn(G.shape[0], G.shape[1]))
-        Z = np.real(np.fft.ifft2(G * U))
-
-        return Z[int(round((Nx + 2) / 2)):(int(round((Nx + 2) / 2)) + self.grx.size - 1),
-                 int(round((Nz + 2) / 2)):(int(round((Nz + 2) / 2)) + self.grz.size - 1)]
+        n = (self.grx.size - 1, self.grz.size - 1)
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        seeds = seed.spawn(1 if nsim is None else nsim)
+        if nsim is None:
+            return _fftma(G, n, seeds[0])
+
+        nprocs = min(nprocs, nsim)
+        if nprocs > 1:
+            bounds = [int(round(k * nsim / nprocs)) for k in range(nprocs + 1)]
+            tasks = [(n, seeds[bounds[k]:bounds[k + 1]]) for k in range(nprocs)]
+            with sharedPool(nprocs, {'G': G}) as pool:
+                return np.concatenate(pool.map(_FFTMAWorker, tasks), axis=2)
+
+        Z = np.empty(n + (nsim,))
+        for k in range(nsim):
+            Z[:, :, k] = _fftma(G, n, seeds[k])
+        return Z
 
     def toXdmf(self, field, fieldname, filename):
         """
@@ -709,8 +1196,17 @@ class Grid2D(Grid):
 
 class Grid3D(Grid):
     """
-    Class for 3D grids -> TO COMPLETE!!!
+    Class for 3D grids
+
+    Important: cells are ordered with Z as the "fast" axis, then Y, then X,
+            i.e. cell (i, j, k) is at index (i*ny + j)*nz + k.  The slowness
+            vector can be reshaped as slowness.reshape(nx,ny,nz)
+
+    Raytracing is done with the fast sweeping method, in isotropic media only.
     """
+
+    _txCols = [0, 1, 2]  # coordinates of Tx & Rx used by the C++ grid
+
     def __init__(self, grx=None, gry=None, grz=None, nthreads=1):
         Grid.__init__(self)
         if grx is not None:
@@ -720,16 +1216,215 @@ class Grid3D(Grid):
         if grz is not None:
             self.grz = grz
         self.nthreads = nthreads
-        self.nsnx = 10
-        self.nsny = 10
-        self.nsnz = 10
-        self.cgrid = None
+        self.nsnx = 2   # subdivisions of cells along X for the fast sweeping method
+        self.nsny = 2
+        self.nsnz = 2
         self.border = np.array([1, 1, 1, 1])
         self.flip = 0
         self.borehole_x0 = 1
         self.x0 = np.array([])
         self.type = None
 
+    def __getstate__(self):
+        # the C++ grid is fetched from the module cache (see getCgrid3D)
+        state = self.__dict__.copy()
+        state['_raytraceState'] = None
+        return state
+
+    def __setstate__(self, state):
+        # grids saved before raytracing was implemented hold the C++ grid
+        # placeholder and subdivisions that were never used
+        if '_raytraceState' not in state:
+            state = dict(state)
+            state.pop('cgrid', None)
+            for k in ('nsnx', 'nsny', 'nsnz'):
+                state.pop(k, None)
+        self.__init__()
+        self.__dict__.update(state)
+
+    def raytrace(self, slowness, Tx, Rx, t0=(), xi=(), theta=(), want=('tt', 'L', 'rays'),
+                 nprocs=1, reciprocity=False, incremental=None):
+        """
+        Compute traveltimes, raypaths and build ray projection matrix
+
+        Usages:
+            tt,L,rays = grid.raytrace(slowness,Tx,Rx,t0)
+            tt,L = grid.raytrace(slowness,Tx,Rx,t0,want=('tt','L'))
+            tt = grid.raytrace(slowness,Tx,Rx,t0,want='tt')
+
+        Input:
+            slowness: vector of slowness values at grid cells (ncell x 1)
+            Tx: coordinates of sources points (ndata x 3)
+            Rx: coordinates of receivers      (ndata x 3)
+            t0 (optional): initial time at sources points (ndata x 1)
+            xi, theta: not used, anisotropy is not handled in 3D
+            want, nprocs, reciprocity, incremental (optional): see Grid2D.raytrace
+        Output:
+            tt: vector of traveltimes, ndata by 1
+            L: ray projection matrix, ndata by ncell
+            rays: Rays instance holding the coordinates of the ray paths,
+                  rays[n] is an nPts by 3 array for datum n
+        """
+
+        want = cgrid2d.check_want(want)
+        # check input data consistency
+
+        if Tx.ndim != 2 or Rx.ndim != 2:
+            raise ValueError('Tx and Rx should be 2D arrays')
+
+        if Tx.shape[1] != 3 or Rx.shape[1] != 3:
+            raise ValueError('Tx and Rx should be ndata x 3')
+
+        if Tx.shape != Rx.shape:
+            raise ValueError('Tx and Rx should be of equal size')
+
+        if len(slowness) != self.getNumberOfCells():
+            raise ValueError('Length of slowness vector should equal number of cells')
+
+        if len(xi) != 0 or len(theta) != 0:
+            raise ValueError('Raytracing in anisotropic media is not implemented for 3D grids')
+
+        if len(t0) == 0:
+            t0 = np.zeros([Tx.shape[0], ])
+        elif len(t0) != Tx.shape[0]:
+            raise ValueError('Length of t0 should equal number of Tx')
+
+        if incremental is not None:
+            out = self._raytraceIncremental(slowness, Tx, Rx, t0, want, nprocs,
+                                            reciprocity, incremental)
+        else:
+            out = self._raytrace(slowness, Tx, Rx, t0, (), (), want, b'iso',
+                                 nprocs, reciprocity)
+
+        if len(want) == 1:
+            return out[0]
+        return tuple(out)
+
+    def _getCgridFactory(self, typeG, nthreads):
+        """
+        Returns the function creating the C++ grid used for raytracing, and
+        its arguments
+        """
+        return getCgrid3D, (self.grx, self.gry, self.grz, self.nsnx, self.nsny, self.nsnz, nthreads)
+
+    def getForwardStraightRays(self, ind=None, dx=None, dy=None, dz=None, aniso=False):
+        """
+        Build ray projection matrix for straight rays
+
+        Input:
+            ind: indices of Tx-Rx pairs for which matrix is built
+            dx: grid cell size along X (default is size of grid instance)
+            dy: grid cell size along Y (default is size of grid instance)
+            dz: grid cell size along Z (default is size of grid instance)
+            aniso: not used, anisotropy is not handled in 3D
+
+        Output:
+            L: ray projection matrix, ndata by ncell
+        """
+        if aniso:
+            raise ValueError('Anisotropic straight rays are not implemented for 3D grids')
+
+        if ind is None:
+            ind = np.ones((self.Tx.shape[0],), dtype=bool)
+
+        small = 0.00001
+        if dx is None or dx == 0:
+            grx = self.grx
+        else:
+            grx = np.arange(self.grx[0], self.grx[-1] + small, dx)
+
+        if dy is None or dy == 0:
+            gry = self.gry
+        else:
+            gry = np.arange(self.gry[0], self.gry[-1] + small, dy)
+
+        if dz is None or dz == 0:
+            grz = self.grz
+        else:
+            grz = np.arange(self.grz[0], self.grz[-1] + small, dz)
+
+        return cachedLsr(cgrid3d.Grid3Dcpp.Lsr3d, self.Tx[ind, :], self.Rx[ind, :],
+                         (grx, gry, grz), self.nthreads)
+
+    def getCellCenter(self, dx=None, dy=None, dz=None):
+        """
+        Returns a nCell x 3 array containing the coordinates of the center of the cells
+        """
+        if dx is None:
+            dx = self.grx[1] - self.grx[0]
+        if dy is None:
+            dy = self.gry[1] - self.gry[0]
+        if dz is None:
+            dz = self.grz[1] - self.grz[0]
+
+        xmin = self.grx[0] + dx / 2.0
+        ymin = self.gry[0] + dy / 2.0
+        zmin = self.grz[0] + dz / 2.0
+        xmax = self.grx[-1] - dx / 3.0  # divide by 3 to avoid truncation error
+        ymax = self.gry[-1] - dy / 3.0
+        zmax = self.grz[-1] - dz / 3.0
+        nx = np.int64(np.ceil((xmax - xmin) / dx) + 0.001)
+        ny = np.int64(np.ceil((ymax - ymin) / dy) + 0.001)
+        nz = np.int64(np.ceil((zmax - zmin) / dz) + 0.001)
+
+        c = np.vstack([xmin + np.kron(np.arange(nx), np.ones((ny * nz, )) * dx),
+                       ymin + np.kron(np.ones((nx, )), np.kron(np.arange(ny), np.ones((nz, ))) * dy),
+                       zmin + np.kron(np.ones((nx * ny, )), np.arange(nz) * dz)]).T
+        return c
+
+    @staticmethod
+    def _derivative1D(n, d, order):
+        """
+        1D derivative operator for n cells of size d, stencils are those of
+        Grid2D.derivative
+        """
+        if order == 1:
+            i = np.kron(np.arange(n), np.ones((2, ), dtype=np.int64))
+            j = np.vstack((np.hstack((0, np.arange(n - 2), n - 2)),
+                           np.hstack((1, np.arange(2, n), n - 1)))).T.flatten()
+            v = np.hstack((np.array([-1, 1]),
+                           np.tile(np.array([-0.5, 0.5]), (n - 2,)), np.array([-1, 1]))) / d
+        else:
+            i = np.kron(np.arange(n), np.ones((3, ), dtype=np.int64))
+            j = np.vstack((np.hstack((0, np.arange(n - 2), n - 3)),
+                           np.hstack((1, np.arange(1, n - 1), n - 2)),
+                           np.hstack((2, np.arange(2, n), n - 1)))).T.flatten()
+            v = np.tile(np.array([1.0, -2.0, 1.0]), (n, )) / (d * d)
+        return csr_matrix((v, (i, j)), shape=(n, n))
+
+    def derivative(self, order, normalize=False):
+        """
+        Compute spatial derivative operators for grid _cells_
+
+        For 1st order:
+            forward operator is (u_{i+1} - u_i)/dx
+            centered operator is (u_{i+1} - u_{i-1})/(2dx)
+            backward operator is (u_i - u_{i-1})/dx
+
+        For 2nd order:
+            forward operator is (u_i - 2u_{i+1} + u_{i+2})/dx^2
+            centered operator is (u_{i-1} - 2u_i + u_{i+1})/dx^2
+            backward operator is (u_{i-2} - 2u_{i-1} + u_i)/dx^2
+        """
+        dx = 1
+        dy = 1
+        dz = 1
+        if normalize:
+            dx = self.dx
+            dy = self.dy
+            dz = self.dz
+
+        nx = len(self.grx) - 1
+        ny = len(self.gry) - 1
+        nz = len(self.grz) - 1
+
+        Dx = sp.kron(self._derivative1D(nx, dx, order), sp.identity(ny * nz), format='csr')
+        Dy = sp.kron(sp.identity(nx), sp.kron(self._derivative1D(ny, dy, order), sp.identity(nz)),
+                     format='csr')
+        Dz = sp.kron(sp.identity(nx * ny), self._derivative1D(nz, dz, order), format='csr')
+
+        return Dx, Dy, Dz
+
 
 if __name__ == '__main__':
 
@@ -742,6 +1437,8 @@ if __name__ == '__main__':
     testDeriv = False
     testFFTMA = True
     testPickle = False
+    benchmarkRaytrace = False
+    testRaytrace3D = False
 
     if testRaytrace:
         grx = np.linspace(0, 10, num=21)
@@ -769,13 +1466,15 @@ if __name__ == '__main__':
         t0 = np.zeros([6, ])
 
         tt1, L1, rays1 = grid.raytrace(slowness, Tx, Rx, t0)
-        tt1b, L1b = grid.raytrace(slowness, Tx, Rx, t0)
+        tt1b, L1b = grid.raytrace(slowness, Tx, Rx, t0, want=('tt', 'L'))
+        tt1c = grid.raytrace(slowness, Tx, Rx, t0, want='tt')
         tt2, L2, rays2 = grid.raytrace(slowness, Tx, Rx)
 
         d = np.sqrt(np.sum((Tx - Rx)**2, axis=1))
 
         print(d - tt1)
         print(d - tt1b)
+        print(d - tt1c)
 
         print(d - tt2)
         tt2b = L2 * slowness
@@ -1072,3 +1771,66 @@ if __name__ == '__main__':
         print(ttsr2)
         print(tt1)
         print(tt2)
+
+    if benchmarkRaytrace:
+        # compare shortest path and fast sweeping methods, the model has a
+        # velocity increasing linearly with depth
+        import time
+
+        grx = np.linspace(0, 10, num=51)
+        grz = np.linspace(0, 20, num=101)
+
+        grid = Grid2D(grx, grz)
+
+        xc = grid.getCellCenter()
+        s = 1.0 / (0.08 + 0.004 * xc[:, 1])
+
+        zt, zr = np.meshgrid(np.arange(1, 19, 1.0), np.arange(1, 19, 0.5), indexing='ij')
+        Tx = np.vstack((0.5 + np.zeros(zt.size), np.zeros(zt.size), zt.flatten())).T
+        Rx = np.vstack((9.5 + np.zeros(zr.size), np.zeros(zr.size), zr.flatten())).T
+
+        # reference solution: shortest path with many secondary nodes
+        grid.nsnx = grid.nsnz = 20
+        tt_ref = grid.raytrace(s, Tx, Rx, want='tt', reciprocity=False)
+
+        for method, nsn in (('spm', 5), ('spm', 10), ('fsm', 1), ('fsm', 2), ('fsm', 4)):
+            grid.method = method
+            grid.nsnx = grid.nsnz = grid.nsn_fsm = nsn
+            t = time.time()
+            tt, L, rays = grid.raytrace(s, Tx, Rx, reciprocity=False)
+            t = time.time() - t
+            err = np.abs(tt - tt_ref) / tt_ref
+            print('{0:s}, {1:2d} secondary nodes: {2:7.3f} s, relative error: mean {3:.2e}, max {4:.2e}'.format(
+                method, nsn, t, err.mean(), err.max()))
+
+    if testRaytrace3D:
+        grx = np.linspace(0, 10, num=21)
+        gry = np.linspace(0, 8, num=17)
+        grz = np.linspace(0, 12, num=25)
+
+        grid = Grid3D(grx, gry, grz, nthreads=2)
+
+        slowness = np.ones((grid.getNumberOfCells(),))
+
+        Tx = np.vstack((0.3 + np.zeros(12), 1.1 + np.zeros(12), np.repeat([1.0, 4.0, 7.0], 4))).T
+        Rx = np.vstack((9.6 + np.zeros(12), 6.7 + np.zeros(12), np.tile([2.0, 5.0, 8.0, 11.0], 3))).T
+
+        tt, L, rays = grid.raytrace(slowness, Tx, Rx)
+
+        d = np.sqrt(np.sum((Tx - Rx)**2, axis=1))
+        print(d - tt)
+        print(L * slowness - tt)
+
+        grid.Tx = Tx
+        grid.Rx = Rx
+
+        Lsr = grid.getForwardStraightRays()
+        print(d - Lsr * slowness)
+
+        fig = plt.figure()
+        ax = fig.add_subplot(111, projection='3d')
+        ax.add_collection(rays.toLineCollection())
+        ax.set_xlim(grx[0], grx[-1])
+        ax.set_ylim(gry[0], gry[-1])
+        ax.set_zlim(grz[0], grz[-1])
+        plt.show()
@@ -19,9 +19,15 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
+import time
+
+import h5py
 import numpy as np
-import scipy as spy
-from scipy.sparse import linalg
+from scipy.linalg import cho_factor, cho_solve
+from scipy.sparse import csr_matrix, linalg
+
+import covar
 
 
 class InvLSQRParams(object):
@@ -40,6 +46,94 @@ class InvLSQRParams(object):
         self.order          = 1
         self.nbreiter       = 0
         self.dv_max         = 0
+        self.nprocs         = 1   # number of processes used for raytracing
+        self.incrementalTol = None  # relative slowness change triggering retracing (None: retrace all)
+        self.reciprocity    = 0   # trace rays from Rx when there are fewer unique Rx than Tx
+        self.invDataFile    = None  # HDF5 file where iteration history is written (None: kept in memory)
+        self.solver         = 'lsqr'  # 'lsqr' or 'lsmr'
+        self.precond        = 0   # scale columns of the system to unit norm
+        self.warmStart      = 0   # start the solver from the model of the previous iteration
+        self.geostatSolver  = 'cholesky'  # data covariance system of invGeostat: 'cholesky' or 'cg'
+        self.covarFFT       = 1   # apply the model covariance with FFTs (see covar.CovarianceOperator)
+        self.doSim          = 0   # conditional simulations after the last iteration of invGeostat
+        self.nbreSim        = 128  # number of realizations
+        self.simSeed        = None  # seed of the random generator of the simulations
+        self.simCacheDir    = None  # directory where FFT-MA spectral matrices are saved (None: kept in memory)
+
+    def __setstate__(self, state):
+        # parameters saved before new attributes were added get their defaults
+        self.__init__()
+        self.__dict__.update(state)
+
+def dataCovariance(cm, xc, L, nb=1000):
+    """
+    Compute the covariance of the data L*Cm*L.T without forming Cm
+
+    Input:
+        cm: CovarianceModel instance
+        xc: coordinates of the cells (ncell x d)
+        L: ray projection matrix (sparse)
+        nb: number of rows of Cm computed at once
+
+    Output:
+        Cd: m x m array
+    """
+    L = L.tocsc()
+    Cd = np.zeros((L.shape[0], L.shape[0]))
+    for r, CmLt in cm.dotBlocks(xc, L.T.tocsr(), nb):
+        Cd += L[:, r].dot(CmLt)
+    return Cd
+
+
+def simulateGeostat(grid, cm, L, nugget, Cd, applyCm, nsim, nprocs=1, seed=None, cachedir=None):
+    """
+    Conditional simulation by kriging of residuals
+
+    Unconditional realizations Z are generated by FFT-MA, the data they would
+    produce are kriged with the same system as the inversion and removed:
+
+        Zc = Z - Cm*L.T*inv(Cd)*(L*Z + e)
+
+    where e is a realization of the data noise.  Adding the kriged model to
+    the columns of Zc gives realizations honoring the data.
+
+    Input:
+        grid: instance of Grid2D
+        cm: CovarianceModel instance
+        L: ray projection matrix (sparse)
+        nugget: variance of the data noise (m,)
+        Cd: Cholesky factor of the data covariance, as returned by cho_factor
+        applyCm: function returning Cm*M
+        nsim: number of realizations
+        nprocs: number of processes used by FFT-MA
+        seed: seed of the random generator
+        cachedir: directory where the FFT-MA spectral matrices are saved
+
+    Output:
+        Zc: zero mean conditioned realizations (n x nsim)
+    """
+    if not hasattr(grid, 'preFFTMA'):
+        raise NotImplementedError('Simulations are implemented for 2D grids only')
+
+    blocks = [(cm.covar, cm.nugget_model)]
+    if cm.use_xi:
+        blocks.append((cm.covar_xi, cm.nugget_xi))
+        if cm.use_tilt:
+            blocks.append((cm.covar_tilt, cm.nugget_tilt))
+
+    # one stream for the noise, one per block of parameters
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks) + 1)
+    Z = []
+    for (c, n), ss in zip(blocks, seeds[1:]):
+        if n != 0:
+            c = c + [covar.CovarianceNugget(n)]
+        G = grid.preFFTMA(c, cachedir)
+        Z.append(grid.FFTMA(G, nsim, nprocs, ss).reshape(-1, nsim))
+    Z = np.vstack(Z)
+
+    e = np.sqrt(nugget)[:, None] * np.random.default_rng(seeds[0]).standard_normal((L.shape[0], nsim))
+    return Z - applyCm(L.T.dot(cho_solve(Cd, L.dot(Z) + e)))
+
 
 def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
     """
@@ -91,6 +185,7 @@ def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
 
      # First we call a Tomo class instance. It will hold the data we will process along the way.
     tomo = Tomo()
+    tomo.invData = invData(params.numItCurved + params.numItStraight + 1, params.invDataFile)
 
     if data.shape[1] >= 9:
         tomo.no_trace = data[:, 8]
@@ -109,79 +204,102 @@ def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
 
     cont = np.array([])
 
+    # Cm is never formed: it is applied with FFTs, or by blocks of rows (see
+    # CovarianceModel.dotBlocks), memory scales with the number of data
     xc = grid.getCellCenter()
-    Cm = cm.compute(xc,xc)
+    nc = L.shape[1]
+    if params.covarFFT:
+        Cop = covar.CovarianceOperator(cm, grid.getNcell(), grid.getCellSize())
+        applyCm = Cop.dot
+        projectCm = Cop.project
+    else:
+        applyCm = lambda M: cm.dot(xc, M)
+        projectCm = lambda L: dataCovariance(cm, xc, L)
 
     # TODO : Test, indices may not work
     if cont.size > 0 and params.useCont == 1:
         indc = grid.getContIndices(cont,xc)
-        Cm0 = Cm[indc,:]
-        Cmc = Cm[indc,indc]
-        Cmc = Cmc+np.diag(cont[:,-1])
+        E = csr_matrix((np.ones(indc.size), (indc, np.arange(indc.size))), shape=(nc, indc.size))
+        Cm0 = applyCm(E).T
+        Cmc = Cm0[:,indc]+np.diag(cont[:,-1])
 
     c0=np.array([]);
     if np.size(data[0,:])>7 and cm.use_c0==1:
         if (data[:,7] != 0).all():
             c0=data[:,7]**2
-    
+
+    gamma = None
     for noIter in range(params.numItCurved + params.numItStraight + 1):
-        if noIter == 1:
-            l_moy = np.mean(data[:,6]/np.sum(L.A,axis = 1))
+        lsum = np.asarray(L.sum(axis=1)).ravel()
+        if noIter == 0:
+            l_moy = np.mean(data[:,6]/lsum)
         else:
             l_moy = np.mean(tomo.s)
-        mta = np.sum(L.A*l_moy,axis =1) 
+        mta = lsum*l_moy
         dt = data[:,6] - mta
 
-        #TODO: Add Simulation param
-        doSim = 0
-        #if params.doSim==1 and noIter==(params.numItStraight+params.numItCurved):
-        #    doSim = 1
+        doSim = params.doSim == 1 and noIter == (params.numItStraight + params.numItCurved)
 
         if np.size(c0) == 0:
-            Cd = L*Cm*L.T + cm.nugget_data*np.eye(np.size(L.A[:,0]))
+            nugget = cm.nugget_data*np.ones((L.shape[0],))
+        else:
+            nugget = cm.nugget_data*c0
+
+        Cdf = None
+        # TODO : Fix and test this part
+        if np.size(cont) > 0 and params.useCont == 1:
+            scont = cont[:,-2]-l_moy
+            Cdmc = L.dot(Cm0.T)
+            C = np.vstack((np.hstack((Cmc, Cdmc.T)),
+                           np.hstack((Cdmc, projectCm(L) + np.diag(nugget)))))
+            C = C+np.eye(C.shape[0])*1e-6
+            # dual cokriging (see Gloaguen et al 2005)
+            Gamma = cho_solve(cho_factor(C), np.concatenate((scont,dt)))
+            v = E.dot(Gamma[:indc.size]) + L.T.dot(Gamma[indc.size:])
+        elif params.geostatSolver == 'cg':
+            # Cd is applied as an operator, previous weights are the initial guess
+            Cd = linalg.LinearOperator((L.shape[0], L.shape[0]), dtype=np.float64,
+                                       matvec=lambda u: L.dot(applyCm(L.T.dot(np.ravel(u)))) + nugget*np.ravel(u))
+            gamma, info = linalg.cg(Cd, dt, x0=gamma)
+            if info > 0:
+                print('Geostatistic Inversion - CG did not converge in {} iterations'.format(info))
+            v = L.T.dot(gamma)
         else:
-            Cd = L*Cm*L.T + cm.nugget_data*np.diag(c0)
-        
-        Cdm = L*Cm
-
-        if doSim == 0:
-
-            # TODO : Fix and test this part
-            if np.size(cont) > 0 and params.useCont == 1:
-                scont = cont[:,-2]-l_moy
-                C = np.concatenate((np.concatenate(Cmc, Cdm[:,indc].T),np.concatenate(Cdm[:,indc],Cd)))
-                C = C+np.eye(np.size(C))*1e-6
-                # dual cokriging (see Gloaguen et al 2005)
-                Gamma = np.linalg(C,np.concatenate((scont,dt))).reshape(-1, 1).T
-                m = Gamma.dot(np.concatenate((Cm0,Cdm))).T
-            else:
-                Gamma = np.linalg.solve(Cd,dt).reshape(-1, 1).T
-                m = Gamma.dot(Cdm).T
-            
-            if params.tomoAtt == 1:
-                #neative attenuation set to zero
-                m[m<-l_moy] = -l_moy
-
-            tomo.s = m+l_moy
-        # TODO : Implement simulation
-        #else:
-            #
+            Cdf = cho_factor(projectCm(L) + np.diag(nugget))
+            v = L.T.dot(cho_solve(Cdf, dt))
+
+        m = applyCm(v)
+
+        if params.tomoAtt == 1:
+            #neative attenuation set to zero
+            m[m<-l_moy] = -l_moy
+
+        tomo.s = m+l_moy
+
+        if doSim:
+            # kriging of residuals reuses the factor of the data covariance
+            if Cdf is None:
+                Cdf = cho_factor(projectCm(L) + np.diag(nugget))
+            tomo.simu = simulateGeostat(grid, cm, L, nugget, Cdf, applyCm, params.nbreSim,
+                                        params.nprocs, params.simSeed, params.simCacheDir) + tomo.s[:, None]
 
         if params.tomoAtt ==0 and noIter>=params.numItStraight and params.numItCurved > 0:
             if np.any(tomo.s<0):
                 print("Negative Slownesses: Change Inversion Parameters")
                 #tomo = np.array([])
-            _,L,tomo.rays = grid.raytrace(tomo.s,data[:,0:3],data[:,3:6])
+            _,L,tomo.rays = grid.raytrace(tomo.s,data[:,0:3],data[:,3:6],nprocs=params.nprocs,
+                                          incremental=params.incrementalTol,
+                                          reciprocity=params.reciprocity == 1)
 
         if params.saveInvData == 1:
             tt = L.dot(tomo.s)
-            tomo.invData.res = data[:,6]-tt
-            tomo.invData.s = tomo.s
+            tomo.invData.append(data[:,6]-tt, tomo.s)
 
         if ui is not None:
             ui.InvIterationDone.emit(noIter + 1,tomo.s, "Geostatistic")
 
     tomo.L = L
+    tomo.invData.close()
 
     if ui is not None:
         ui.InvDone.emit(noIter, "Geostatistic")
@@ -191,6 +309,72 @@ def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
     return tomo
   
 
+def solveLSQR(L, D, b, solver='lsqr', precond=False, x0=None, tol=0, maxit=None):
+    """
+    Least-squares solution of the regularized system
+
+        [     L      ]       [ b ]
+        [ alpha1*D1  ] x  =  [ 0 ]
+        [    ...     ]       [...]
+
+    The system is applied through a LinearOperator, the stacked matrix is
+    not built.
+
+    Input:
+        L: ray projection matrix (m x n)
+        D: list of (alpha, D) tuples, D are the regularization matrices
+        b: traveltime residuals (m,)
+        solver: 'lsqr' or 'lsmr'
+        precond: if true, columns of the system are scaled to unit norm
+                 (Jacobi preconditioning of the normal equations)
+        x0: initial solution (warm start), None to start from zero
+        tol: stopping tolerance of the solver (atol and btol)
+        maxit: maximum number of iterations of the solver, None for default
+
+    Output:
+        x: solution (n,)
+        istop: reason the solver stopped (see scipy.sparse.linalg.lsqr)
+        itn: number of iterations done
+        normr: norm of the residual vector
+    """
+    D = [(alpha, Dm) for alpha, Dm in D if alpha != 0 and Dm.nnz > 0]
+    m, n = L.shape
+    rows = np.cumsum([m] + [Dm.shape[0] for _, Dm in D])
+
+    scale = np.ones((n,))
+    if precond:
+        colnorm = np.asarray(L.power(2).sum(axis=0)).ravel()
+        for alpha, Dm in D:
+            colnorm += alpha**2 * np.asarray(Dm.power(2).sum(axis=0)).ravel()
+        colnorm = np.sqrt(colnorm)
+        scale[colnorm > 0] = 1.0 / colnorm[colnorm > 0]
+
+    def matvec(x):
+        x = scale * np.ravel(x)
+        return np.concatenate([L.dot(x)] + [alpha * Dm.dot(x) for alpha, Dm in D])
+
+    def rmatvec(y):
+        y = np.ravel(y)
+        x = L.T.dot(y[:m])
+        for k, (alpha, Dm) in enumerate(D):
+            x += alpha * Dm.T.dot(y[rows[k]:rows[k + 1]])
+        return scale * x
+
+    A = linalg.LinearOperator((rows[-1], n), matvec=matvec, rmatvec=rmatvec, dtype=np.float64)
+    rhs = np.concatenate((b, np.zeros((rows[-1] - m,))))
+    if x0 is not None:
+        x0 = x0 / scale
+
+    if solver == 'lsmr':
+        ans = linalg.lsmr(A, rhs, atol=tol, btol=tol, maxiter=maxit, x0=x0)
+    elif solver == 'lsqr':
+        ans = linalg.lsqr(A, rhs, atol=tol, btol=tol, iter_lim=maxit, x0=x0)
+    else:
+        raise ValueError('Unknown solver: ' + repr(solver))
+
+    return scale * ans[0], ans[1], ans[2], ans[3]
+
+
 def invLSQR(params, data, idata, grid, L, app=None, ui=None):
     """
     Input:
@@ -240,6 +424,12 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
     # First we call a Tomo class instance. It will hold the data we will process along the way.
     tomo = Tomo()
 
+    nIterations = params.numItCurved + params.numItStraight + 1
+    tomo.res = np.zeros((nIterations,))
+    tomo.itn = np.zeros((nIterations,), dtype=int)
+    tomo.solverTime = np.zeros((nIterations,))
+    tomo.invData = invData(nIterations, params.invDataFile)
+
     if data.shape[1] >= 9:
         tomo.no_trace = data[:, 8]
 
@@ -262,7 +452,7 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
     # These will smoothen the subsequent slowness/velocity model
     Dx, Dy, Dz = grid.derivative(params.order)
 
-    for noIter in range(params.numItCurved + params.numItStraight + 1):
+    for noIter in range(nIterations):
         if ui is not None and app is not None:
             ui.gv.noIter = noIter
             app.processEvents()
@@ -288,22 +478,20 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
         if noIter == 0:
             s_o = mean_s * np.ones(L.shape[1]).T
 
-        A = spy.sparse.vstack([L, Dx * params.alphax, Dz * params.alphaz])
-
-        b = np.concatenate((dt, np.zeros(Dx.shape[0]), np.zeros(Dz.shape[0])))
-
         if not np.all(cont == 0) and params.useCont == 1:
             # TODO: faire les modifications aux matrices A et b avec les contraintes
             pass
 
-        ans = linalg.lsqr(A, b, atol=params.tol, btol=params.tol, iter_lim=params.nbreiter)
-        # See http://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.sparse.linalg.lsqr.html for documentation
-        x = ans[0]
+        # previous model, expressed as a perturbation from the current mean
+        x0 = tomo.s - mean_s if params.warmStart and noIter > 0 else None
+        maxit = int(params.nbreiter) if params.nbreiter > 0 else None
 
-        if noIter == 0:
-            tomo.res[0] = ans[3]
-        else:
-            np.append(tomo.res, ans[3])
+        t = time.perf_counter()
+        x, _, itn, normr = solveLSQR(L, [(params.alphax, Dx), (params.alphay, Dy), (params.alphaz, Dz)],
+                                     dt, params.solver, params.precond, x0, params.tol, maxit)
+        tomo.solverTime[noIter] = time.perf_counter() - t
+        tomo.itn[noIter] = itn
+        tomo.res[noIter] = normr
 
         if max(abs(s_o / (x + mean_s) - 1)) > params.dv_max:
             fac = min(abs((s_o / (params.dv_max + 1) - mean_s) / x))
@@ -313,22 +501,19 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
         tomo.s = x + mean_s
 
         # Applying the resulting model to Tx and Rx to get new tt and L and the trajectory of curved rays
-        tt, L, tomo.rays = grid.raytrace(tomo.s, data[:, 0:3], data[:, 3:6])
+        tt, L, tomo.rays = grid.raytrace(tomo.s, data[:, 0:3], data[:, 3:6], nprocs=params.nprocs,
+                                         incremental=params.incrementalTol,
+                                         reciprocity=params.reciprocity == 1)
 
         if ui is not None:
             ui.InvIterationDone.emit(noIter,tomo.s, "LSQR")
         else:
-            print('LSQR Inversion - Ray Tracing, Iteration {}'.format(noIter + 1))
+            print('LSQR Inversion - Ray Tracing, Iteration {}: {} solver iterations in {:.3f} s'.format(
+                noIter + 1, itn, tomo.solverTime[noIter]))
 
         if params.saveInvData == 1:
             tt = L * tomo.s
-            if noIter == 0:
-                tomo.invData.res = np.array([data[:, 6] - tt]).T
-                tomo.invData.s = np.array([tomo.s]).T
-
-            else:
-                tomo.invData.res = np.concatenate((tomo.invData.res, np.array([data[:, 6] - tt]).T), axis=1)
-                tomo.invData.s = np.concatenate((tomo.invData.s, np.array([tomo.s]).T), axis=1)
+            tomo.invData.append(data[:, 6] - tt, tomo.s)
 
         tomo.L = L
 
@@ -338,10 +523,12 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
 #                                       - values: residuals from comparison between original tt (i.e. data[:, 6])
 #                                                 and tt calculated from the slowness model and the L sparse matrix
 #
-#                       tomo.invData.res:
+#                       tomo.invData.s:
 #                                       - shape: (n, noIter+1)
 #                                       - values: slowness models from ech iterations
 
+    tomo.invData.close()
+
     if ui is not None:
         ui.InvDone.emit(noIter, "LSQR")
     else:
@@ -361,10 +548,136 @@ class Tomo(object):
         self.z = np.array([])
         self.s = 0
         self.res = np.array([0])
+        self.itn = np.array([])         # number of solver iterations at each inversion iteration
+        self.solverTime = np.array([])  # time taken by the solver at each inversion iteration
         self.var_res = np.array([])
+        self.simu = np.array([])        # conditional simulations of invGeostat (n x nbreSim)
 
 
 class invData(object):
-    def __init__(self):
-        self.res = np.array([0])
-        self.s = np.array([0])
+    """
+    Iteration history of an inversion
+
+    res: residuals of the iterations (m x nIt)
+    s: slowness models of the iterations (n x nIt)
+
+    Storage for niter iterations is allocated when the first one is added, no
+    data are copied afterwards.  If filename is given, iterations are written
+    as they are added in datasets 'res' and 's' of this HDF5 file, and res
+    and s are HDF5Dataset instances whose values are read only when sliced.
+    """
+    def __init__(self, niter=1, filename=None):
+        self.niter = niter
+        self.filename = filename
+        self.nIt = 0
+        self._res = np.array([0])
+        self._s = np.array([0])
+        self._h5f = None
+
+    def append(self, res, s):
+        """
+        Add residuals and slowness model of an iteration
+        """
+        res = np.asarray(res).ravel()
+        s = np.asarray(s).ravel()
+        if self.filename is not None:
+            if self.nIt == 0:
+                self._h5f = h5py.File(self.filename, 'w')
+                for name, v in (('res', res), ('s', s)):
+                    self._h5f.create_dataset(name, shape=(v.size, 0), maxshape=(v.size, None),
+                                             chunks=(v.size, 1), dtype=np.float64)
+            for name, v in (('res', res), ('s', s)):
+                ds = self._h5f[name]
+                ds.resize(self.nIt + 1, axis=1)
+                ds[:, self.nIt] = v
+            self._h5f.flush()
+        else:
+            if self.nIt == 0:
+                self._res = np.empty((res.size, max(self.niter, 1)))
+                self._s = np.empty((s.size, max(self.niter, 1)))
+            elif self.nIt == self._res.shape[1]:
+                # more iterations than planned, capacity is doubled
+                self._res = np.hstack((self._res, np.empty(self._res.shape)))
+                self._s = np.hstack((self._s, np.empty(self._s.shape)))
+            self._res[:, self.nIt] = res
+            self._s[:, self.nIt] = s
+        self.nIt += 1
+
+    def close(self):
+        """
+        Close HDF5 file once all iterations are written
+        """
+        if self._h5f is not None:
+            self._h5f.close()
+            self._h5f = None
+
+    @property
+    def res(self):
+        if self.nIt == 0:
+            return self._res
+        if self.filename is not None:
+            return HDF5Dataset(self, 'res')
+        return self._res[:, :self.nIt]
+
+    @property
+    def s(self):
+        if self.nIt == 0:
+            return self._s
+        if self.filename is not None:
+            return HDF5Dataset(self, 's')
+        return self._s[:, :self.nIt]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_h5f'] = None
+        if self.filename is not None:
+            # data stay in the HDF5 file
+            state['_res'] = np.array([0])
+            state['_s'] = np.array([0])
+        elif self.nIt > 0:
+            state['_res'] = self.res
+            state['_s'] = self.s
+        return state
+
+    def __setstate__(self, state):
+        if 'res' in state:
+            # instance saved before history was preallocated
+            state['_res'] = state.pop('res')
+            state['_s'] = state.pop('s')
+            state['nIt'] = state['_res'].shape[1] if state['_res'].ndim == 2 else 0
+        self.__init__()
+        self.__dict__.update(state)
+
+
+class HDF5Dataset(object):
+    """
+    Dataset of the HDF5 file of an invData instance, read when sliced
+
+    The file is opened for each access and closed right after, unless it is
+    still open for writing.
+    """
+    def __init__(self, data, name):
+        self.data = data
+        self.name = name
+
+    def _access(self, fct):
+        if self.data._h5f is not None:
+            return fct(self.data._h5f[self.name])
+        if not os.path.isfile(self.data.filename):
+            raise IOError("Iteration history is stored in file '" + str(self.data.filename) +
+                          "', which cannot be found")
+        with h5py.File(self.data.filename, 'r') as f:
+            return fct(f[self.name])
+
+    @property
+    def shape(self):
+        return self._access(lambda ds: ds.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self._access(lambda ds: ds[key])
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self._access(lambda ds: ds[()]), dtype=dtype)
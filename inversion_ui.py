@@ -19,6 +19,7 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
 import sys
 from PyQt5 import QtGui, QtWidgets, QtCore
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
@@ -33,6 +34,7 @@ from inversion import invLSQR, InvLSQRParams, invGeostat
 from utils import set_tick_arrangement, ComputeThread
 import utils_ui
 from mog import Mog, AirShots
+from grid import Rays
 
 import database
 
@@ -186,6 +188,13 @@ class InversionUI(QtWidgets.QFrame):
             self.lsqrParams.dv_max = 0.01 * float(self.veloc_var_edit.text())
 
         if self.algo_combo.currentText() == 'Geostatistical':
+            self.lsqrParams.doSim = int(self.simulations_checkbox.isChecked())
+            self.lsqrParams.nbreSim = int(self.num_simulation_edit.text())
+            if self.sim_cache_checkbox.isChecked():
+                # spectral matrices of the simulations are saved next to the database
+                self.lsqrParams.simCacheDir = os.path.dirname(os.path.abspath(database.long_url(database)))
+            else:
+                self.lsqrParams.simCacheDir = None
             covar_ = self.current_covar()
             ind = self.geostat_struct_combo.currentIndex()
 
@@ -323,6 +332,15 @@ class InversionUI(QtWidgets.QFrame):
         self.tomoFig.plot_tomo()
         self.tomo_manager.show()
 
+    def plot_simulations(self):
+        if self.tomo is None or np.size(self.tomo.simu) == 0:
+            QtWidgets.QMessageBox.warning(self, 'Warning', "Geostatistical inversion with simulations needed",
+                                          buttons=QtWidgets.QMessageBox.Ok)
+            return
+
+        self.simulationsFig.plot_simulations()
+        self.simulations_manager.show()
+
     def load_prev(self):
         n = self.prev_inversion_combo.currentIndex()
         results = self.model.inv_res[n]
@@ -433,6 +451,10 @@ class InversionUI(QtWidgets.QFrame):
         self.include_checkbox                = QtWidgets.QCheckBox("Include Experimental Variance")
         self.tilted_ellip_veloc_checkbox     = QtWidgets.QCheckBox("Tilted Elliptical Velocity Anisotropy")
         self.ellip_veloc_checkbox            = QtWidgets.QCheckBox("Elliptical Velocity Anisotropy")
+        self.sim_cache_checkbox              = QtWidgets.QCheckBox("Save Simulation Matrices with Database")
+
+        self.simulations_checkbox.stateChanged.connect(self.update_params)
+        self.sim_cache_checkbox.stateChanged.connect(self.update_params)
 
         # --- ComboBoxes --- #
         self.geostat_struct_combo       = QtWidgets.QComboBox()
@@ -502,6 +524,7 @@ class InversionUI(QtWidgets.QFrame):
         Geostat_grid.addWidget(self.geostat_struct_combo, 2, 1, 1, 2)
         Geostat_grid.addWidget(Param_groupbox, 3, 0, 1, 3)
         Geostat_grid.addWidget(Nug_groupbox, 4, 0, 1, 3)
+        Geostat_grid.addWidget(self.sim_cache_checkbox, 5, 0, 1, 3)
         Geostat_grid.setRowStretch(3, 100)
         Geostat_groupbox.setLayout(Geostat_grid)
 
@@ -713,6 +736,15 @@ class InversionUI(QtWidgets.QFrame):
         tomo_grid.addWidget(self.tomoFig, 1, 0)
         self.tomo_manager.setLayout(tomo_grid)
 
+        # -------Manager for SimulationsFig ------ #
+        self.simulationsFig = SimulationsFig(self)
+        self.simulationstool = NavigationToolbar2QT(self.simulationsFig, self)
+        self.simulations_manager = QtWidgets.QWidget()
+        simulations_grid = QtWidgets.QGridLayout()
+        simulations_grid.addWidget(self.simulationstool, 0, 0)
+        simulations_grid.addWidget(self.simulationsFig, 1, 0)
+        self.simulations_manager.setLayout(simulations_grid)
+
         # -------Manager for TomoFig ------ #
         self.previnvFig = PrevInvFig(self)
         self.previnvtool = NavigationToolbar2QT(self.previnvFig, self)
@@ -832,6 +864,7 @@ class InversionUI(QtWidgets.QFrame):
         tomoAction.triggered.connect(self.plot_tomo)
 
         simulAction = QtWidgets.QAction('Simulations', self)
+        simulAction.triggered.connect(self.plot_simulations)
 
         raysAction = QtWidgets.QAction('Rays', self)
         raysAction.triggered.connect(self.plot_rays)
@@ -1159,17 +1192,15 @@ class RaysFig(FigureCanvasQTAgg):
 
         c = interpolate.interp1d(np.arange(-100, 101, 100).T, c.T)(np.arange(-100, 101, 2).T)
         m = 200 / (rmax - rmin)
+        rays = Rays.fromList(self.ui.tomo.rays)  # projects saved with older versions hold a tuple
         if not self.ui.entire_coverage_check.isChecked():
-            for n in ind2:
-                p = m * res[n]
-                color = interpolate.interp1d(np.arange(-100, 101, 2), c)(p)
-                self.ax.plot(self.ui.tomo.rays[n][:, 0], self.ui.tomo.rays[n][:, -1], c=color)
+            ind = ind2
+        else:
+            ind = np.arange(len(rays))
 
-        elif self.ui.entire_coverage_check.isChecked():
-            for n in range(len(self.ui.tomo.rays)):
-                p = m * res[n]
-                color = interpolate.interp1d(np.arange(-100, 101, 2), c)(p)
-                self.ax.plot(self.ui.tomo.rays[n][:, 0], self.ui.tomo.rays[n][:, -1], c=color)
+        colors = interpolate.interp1d(np.arange(-100, 101, 2), c)(m * res[ind]).T
+        self.ax.add_collection(rays.take(ind).toLineCollection(colors=colors))
+        self.ax.autoscale_view()
 
         for tick in self.ax.xaxis.get_major_ticks():
             tick.label.set_fontsize(8)
@@ -1421,20 +1452,45 @@ class SimulationsFig(FigureCanvasQTAgg):
     def __init__(self, ui):
         fig_width, fig_height = 6, 10
         fig = mpl.figure.Figure(figsize=(fig_width, fig_height), dpi=80, facecolor='white')
-        super(PrevInvFig, self).__init__(fig)
+        super(SimulationsFig, self).__init__(fig)
         self.ui = ui
         self.initFig()
 
     def initFig(self):
-        self.ax = self.figure.add_axes([0.07, 0.07, 0.3, 0.9])
-        self.ax2 = self.figure.add_axes([0.07, 0.07, 0.6, 0.9])
+        self.ax = self.figure.add_axes([0.07, 0.07, 0.35, 0.88])
+        self.ax2 = self.figure.add_axes([0.57, 0.07, 0.35, 0.88])
         divider = make_axes_locatable(self.ax)
-        divider.append_axes('right', size=0.5, pad=0.1)
+        divider.append_axes('right', size=0.3, pad=0.1)
         divider = make_axes_locatable(self.ax2)
-        divider.append_axes('right', size=0.5, pad=0.1)
+        divider.append_axes('right', size=0.3, pad=0.1)
         self.ax3 = self.figure.axes[2]
         self.ax4 = self.figure.axes[3]
 
+    def plot_simulations(self):
+        # mean and standard deviation of the velocity of the realizations
+        grid = self.ui.models[self.ui.model_ind].grid
+        nc = (grid.grx.size - 1) * (grid.grz.size - 1)
+        v = 1 / self.ui.tomo.simu[:nc, :]
+
+        extent = [grid.grx[0], grid.grx[-1], grid.grz[0], grid.grz[-1]]
+        self.ax.cla()
+        self.ax2.cla()
+        h = self.ax.imshow(v.mean(axis=1).reshape((grid.grx.size - 1, grid.grz.size - 1)).T,
+                           interpolation='none', cmap='inferno', extent=extent)
+        mpl.colorbar.Colorbar(self.ax3, h)
+        h = self.ax2.imshow(v.std(axis=1).reshape((grid.grx.size - 1, grid.grz.size - 1)).T,
+                            interpolation='none', cmap='viridis', extent=extent)
+        mpl.colorbar.Colorbar(self.ax4, h)
+
+        self.ax.set_title('Mean of {} realizations'.format(v.shape[1]), fontsize=10)
+        self.ax2.set_title('Standard deviation', fontsize=10)
+        for ax in (self.ax, self.ax2):
+            ax.set_xlabel('Distance [m]')
+            ax.invert_yaxis()
+        self.ax.set_ylabel('Elevation [m]')
+
+        self.draw()
+
 
 class Gridviewer(QtWidgets.QWidget):
     def __init__(self, grid, ui):
@@ -34,6 +34,11 @@ extensions = [
               include_dirs=['./cutils/', np.get_include()],
               language='c++',             # generate C++ code
               extra_compile_args=['-std=c++11'],),
+    Extension('cutils.cgrid3d',
+              sources=['./cutils/cgrid3d.pyx', './cutils/Grid3Dttcr.cpp'],  # additional source file(s)
+              include_dirs=['./cutils/', np.get_include()],
+              language='c++',             # generate C++ code
+              extra_compile_args=['-std=c++11'],),
     Extension('cutils.segy',
               sources=['./cutils/segy.pyx', './cutils/csegy.c'],  # additional source file(s)
               include_dirs=['./cutils/', np.get_include()],
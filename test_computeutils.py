@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of module computeutils
+"""
+
+import numpy as np
+
+from computeutils import LRUCache, sharedPool, worker
+
+
+def test_LRUCache():
+    c = LRUCache(2)
+    c['a'] = 1
+    c['b'] = 2
+    assert c['a'] == 1   # 'b' is now the least recently used
+    c['c'] = 3
+    assert 'b' not in c and 'a' in c and 'c' in c
+    assert c.get('b') is None and c.get('c') == 3
+
+    c.maxsize = 1
+    c['d'] = 4
+    assert len(c) == 1 and c['d'] == 4
+    c.clear()
+    assert len(c) == 0
+
+    c.maxsize = 0   # nothing is kept
+    c['e'] = 5
+    assert 'e' not in c
+
+
+def _initTest(offset):
+    worker['offset'] = offset
+
+
+def _testWorker(k):
+    return worker['a'][k].sum() + worker['offset'], len(worker['b'])
+
+
+def test_sharedPool():
+    a = np.arange(12.0).reshape(4, 3)
+    with sharedPool(2, {'a': a, 'b': ()}, _initTest, (0.5,)) as pool:
+        out = pool.map(_testWorker, range(4))
+    assert out == [(a[k].sum() + 0.5, 0) for k in range(4)]
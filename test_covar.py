@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of module covar
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+import covar
+import grid
+from covar_ui import CovarUI
+
+
+def test_compute_empty():
+    cm = covar.CovarianceSpherical(np.array([10.0, 3.0]), np.array([30.0]), 0.6)
+    x = np.array([[0.0, 0.0], [0.0, 1.0]])
+    x0 = np.zeros((0, 2))
+    assert cm.compute(x, x0).shape == (2, 0)
+    assert cm.compute(x0, x).shape == (0, 2)
+    assert cm.compute(x0, x0).shape == (0, 0)
+    assert cm.compute_h(x, x0).shape == (2, 0)
+
+
+def test_compute_blocks():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 20, (50, 2))
+    x0 = rng.uniform(0, 20, (30, 2))
+    cm = covar.CovarianceExponential(np.array([6.0, 2.0]), np.array([20.0]), 1.5)
+    t1, t2 = cm.trans(x), cm.trans(x0)
+    h = np.sqrt(((t1[:, None, :] - t2[None, :, :])**2).sum(axis=2))
+
+    block_size = covar.block_size
+    try:
+        covar.block_size = 7   # several blocks of rows
+        assert np.allclose(cm.compute_h(x, x0), h)
+        assert np.allclose(cm.compute(x, x0), 1.5 * np.exp(-h))
+        assert np.allclose(cm.compute(x, x), cm.compute(x, x.copy()))
+    finally:
+        covar.block_size = block_size
+
+
+def test_fit_bounds():
+    rng = np.random.default_rng(0)
+    G = sp.random(40, 64, density=0.2, random_state=1, format='csr')
+    dt = 1e-3 * rng.standard_normal(40)
+    fit = covar.CovarianceFit(G, dt, (8, 8), (1.0, 1.0), 10)
+
+    cm = covar.CovarianceModel('2D')
+    cm.covar[0].range = np.array([3.0, 2.0])
+    cm.covar[0].sill = 0.5   # the unbounded simplex takes it below 0
+    cm.nugget_data = 1.0
+    free = [('covar', 0, 'range', 0), ('covar', 0, 'range', 1), ('covar', 0, 'angle', 0),
+            ('covar', 0, 'sill'), ('nugget_data',)]
+    x = fit.fit(cm, free, maxiter=60)
+
+    assert np.all(x[[0, 1, 3, 4]] >= [1.e-3, 1.e-3, 0, 0])
+    assert cm.covar[0].sill >= 0 and cm.nugget_data >= 0 and np.all(cm.covar[0].range > 0)
+    assert cm.covar[0].sill == x[3]
+
+
+def test_stream_curves():
+    rng = np.random.default_rng(0)
+    G = sp.random(60, 64, density=0.2, random_state=1, format='csr')
+    dt = rng.standard_normal(60)
+    cm = covar.CovarianceModel('2D')
+    cm.covar[0].range = np.array([3.0, 2.0])
+    cm.nugget_data = 0.1
+
+    g, gt = covar.CovarianceFit(G, dt, (8, 8), (1.0, 1.0), 30).curves(cm)
+    fs = covar.CovarianceFit(G, dt, (8, 8), (1.0, 1.0), 30, maxpairs=100)
+    assert fs.stream and not hasattr(fs, 'G')   # dense blocks are not built
+    gs, gts = fs.curves(cm)
+
+    # bins are quantiles of the same covariances
+    assert abs(len(gts) - len(gt)) <= 0.05 * len(gt)
+    assert np.isclose(np.mean(gts), np.mean(gt), rtol=0.05)
+    assert np.isclose(gts[0], gt[0], rtol=0.05)
+
+
+def test_jacobians():
+    rng = np.random.default_rng(0)
+    n = 30
+    L = sp.random(20, 2 * n, density=0.1, random_state=2, format='csr')
+    s = np.full(n, 0.7)
+    xi = 1.2 + 0.1 * rng.random(n)
+    theta = 0.0044 + 0.3 * rng.random(n)
+
+    # dense expressions of the derivatives of t = sum(s*sqrt(lx'**2 + xi**2*lz'**2))
+    Lx = L[:, :n].toarray()
+    Lz = L[:, n:].toarray()
+
+    def dense(lx, lz, dtheta):
+        Js = np.sqrt(lx**2 + xi**2 * lz**2)
+        iJs = np.divide(1.0, Js, out=np.zeros_like(Js), where=Js != 0)
+        return np.hstack([Js, s * xi * lz**2 * iJs] + ([dtheta * iJs] if dtheta is not None else []))
+
+    J = covar.computeJ(L, np.concatenate([s, xi]).reshape(-1, 1))
+    assert sp.issparse(J) and J.format == 'csr' and J.shape == (20, 2 * n)
+    assert np.allclose(J.toarray(), dense(Lx, Lz, None))
+
+    co, si = np.cos(theta), np.sin(theta)
+    dtheta = s * (xi**2 - 1) * ((Lx**2 - Lz**2) * np.sin(2 * theta) - 2 * Lx * Lz * np.cos(2 * theta))
+    J = covar.computeJ2(L, np.concatenate([s, xi, theta]))
+    assert sp.issparse(J) and J.format == 'csr' and J.shape == (20, 3 * n)
+    assert np.allclose(J.toarray(), dense(Lx * co + Lz * si, Lx * si - Lz * co, dtheta))
+
+    with pytest.raises(ValueError):
+        covar.computeJ2(L, np.concatenate([s, xi]))
+
+
+class _Checkbox(object):
+    def __init__(self, checked):
+        self.checked = checked
+
+    def isChecked(self):
+        return self.checked
+
+
+def test_computeCd():
+    L = sp.random(40, 30, density=0.2, random_state=3, format='csr')
+    L = L[np.diff(L.indptr) > 0, :]
+    tt = L.dot(np.full(30, 0.7)) + 0.01 * np.random.default_rng(0).standard_normal(L.shape[0])
+
+    ui = SimpleNamespace(L=L, data=np.column_stack([tt, np.ones_like(tt)]),
+                         ellip_veloc_checkbox=_Checkbox(False))
+    CovarUI.computeCd(ui)
+    lsum = L.toarray().sum(axis=1)
+    assert np.allclose(ui.dt, tt - np.mean(tt / lsum) * lsum)
+    assert ui.covar_fit is None
+
+    # elliptical anisotropy: L holds the lengths along X, then along Z
+    ui.L = sp.hstack([0.6 * L, 0.8 * L], format='csr')
+    ui.ellip_veloc_checkbox = _Checkbox(True)
+    CovarUI.computeCd(ui)
+    assert np.allclose(ui.dt, tt - np.mean(tt / lsum) * lsum)
+
+    # the fit of the anisotropic model is built from the sparse Jacobians
+    ui.temp_grid = grid.Grid2D(np.arange(0, 5.1), np.arange(0, 6.1))
+    ui.bin_edit = SimpleNamespace(text=lambda: '10')
+    ui.bin_frac_edit = SimpleNamespace(text=lambda: '0.25')
+    cm = covar.CovarianceModel('2D')
+    cm.use_xi = 1
+    for use_tilt in (0, 1):
+        cm.use_tilt = use_tilt
+        fit = CovarUI.covarianceFit(ui, cm)
+        assert CovarUI.covarianceFit(ui, cm) is fit
+
+
+def _kriging(x, x0, cm, itype, avg, nk, rad, ntok):
+    # dense cokriging of one variable, neighbours in increasing distance as
+    # in the original translation of cokri
+    def cov(a, b):
+        return sum(c.compute(a, b) for c in cm)
+
+    sv = cov(np.zeros((1, 2)), np.zeros((1, 2)))[0, 0]
+    est = np.empty(len(x0))
+    var = np.empty(len(x0))
+    for i in range(0, len(x0), ntok):
+        t0 = x0[i:i + ntok]
+        dist = np.sqrt(np.sum((x[:, :2] - t0.mean(axis=0))**2, axis=1))
+        j = np.argsort(dist, kind='stable')[:nk]
+        j = j[(dist[j] < rad) | (np.arange(j.size) == 0)]
+        K = cov(x[j, :2], x[j, :2])
+        K0 = cov(x[j, :2], t0)
+        if itype > 1:
+            # the translation leaves 1 in the corner of K for itype 2
+            K = np.block([[K, np.ones((j.size, 1))], [np.ones((1, j.size)), np.full((1, 1), itype == 2)]])
+            K0 = np.vstack((K0, np.ones((1, len(t0)))))
+        l = np.linalg.solve(K, K0)
+        z = x[j, 2] - avg if itype < 3 else x[j, 2]
+        est[i:i + ntok] = l[:j.size].T.dot(z) + (avg if itype < 3 else 0)
+        var[i:i + ntok] = sv - np.sum(l * K0, axis=0)
+    return est, var, j, l, K, K0
+
+
+def test_cokri(monkeypatch):
+    rng = np.random.default_rng(0)
+    x = np.column_stack([10 * rng.random((40, 2)), rng.standard_normal(40)])
+    gx, gz = np.meshgrid(np.linspace(0.5, 9.5, 5), np.linspace(0.5, 9.5, 4))
+    x0 = np.column_stack([gx.ravel(), gz.ravel()])
+    cm = [covar.CovarianceSpherical(np.array([4.0, 3.0]), np.array([30.0]), 1.2),
+          covar.CovarianceNugget(0.1)]
+
+    for itype in (1, 2, 3):
+        for ntok in (1, 5):
+            for nk, rad in ((8, 3.0), (50, 1e9)):
+                args = (x, x0, cm, itype, 0.1, np.ones(2), np.ones(2, dtype=int), 0, nk, rad, ntok)
+                x0s, s, sv, idout, l, K, K0 = covar.cokri(*args)
+                est, var, j, lr, Kr, K0r = _kriging(x, x0, cm, itype, 0.1, nk, rad, ntok)
+                assert np.array_equal(x0s[:, :2], x0) and np.array_equal(s[:, :2], x0)
+                assert np.allclose(x0s[:, 2], est)
+                assert np.allclose(s[:, 2], var)
+                assert np.isclose(sv, 1.3)
+
+                # last system: samples are in index order (key of the
+                # factorization cache), weights and matrices follow them
+                assert np.array_equal(idout[:, 0], np.sort(j))
+                assert np.all(idout[:, 1] == 0)
+                q = np.concatenate((np.argsort(j), np.arange(j.size, Kr.shape[0])))
+                assert np.allclose(K, Kr[q][:, q])
+                assert np.allclose(K0, K0r[q])
+                assert np.allclose(l, lr[q])
+
+                # the same with a pool of processes
+                out = covar.cokri(*args, nprocs=3)
+                for a, b in zip(out, (x0s, s, sv, idout, l, K, K0)):
+                    assert np.array_equal(a, b)
+
+    # the factorization cache does not change the estimates
+    monkeypatch.setattr(covar, 'lu_cache_size', 0)
+    x0s0, s0 = covar.cokri(*args)[:2]
+    assert np.allclose(x0s0, x0s) and np.allclose(s0, s)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the raytracing of grid.Grid2D
+
+Run with pytest from the directory of the modules, once cutils is built.
+"""
+
+import numpy as np
+import pytest
+
+import covar
+import grid
+
+
+def survey():
+    g = grid.Grid2D(np.arange(0, 5.1, 0.5), np.arange(0, 8.1, 0.5), nthreads=1)
+    s = 1 / (1.5 + 0.2 * np.random.default_rng(0).random(g.getNumberOfCells()))
+    zt, zr = np.meshgrid(np.arange(1.1, 7, 0.5), np.arange(1.3, 7, 2.0))
+    Tx = np.column_stack([np.full(zt.size, 0.2), np.zeros(zt.size), zt.ravel()])
+    Rx = np.column_stack([np.full(zr.size, 4.8), np.zeros(zr.size), zr.ravel()])
+    return g, s, Tx, Rx
+
+
+def test_reciprocity():
+    g, s, Tx, Rx = survey()
+
+    # rays are traced from Tx unless asked for
+    tt, L, rays = g.raytrace(s, Tx, Rx)
+    tt0, L0, rays0 = g.raytrace(s, Tx, Rx, reciprocity=False)
+    assert np.array_equal(tt, tt0)
+    assert (L != L0).nnz == 0
+
+    # fewer unique Rx: rays are traced from Rx, and returned from Tx to Rx
+    tt1, L1, rays1 = g.raytrace(s, Tx, Rx, reciprocity=True)
+    assert np.allclose(tt1, tt0, rtol=1e-2)
+    for n in range(len(tt)):
+        assert np.allclose(rays1[n][0], Tx[n, [0, 2]])
+        assert np.allclose(rays1[n][-1], Rx[n, [0, 2]])
+
+
+def test_rays():
+    g, s, Tx, Rx = survey()
+    tt, L, rays = g.raytrace(s, Tx, Rx)
+
+    # packed raypaths go from Tx to Rx, and their length is the sum of L
+    assert len(rays) == len(tt)
+    for n in range(len(tt)):
+        r = rays[n]
+        assert r.shape[1] == 2
+        assert np.allclose(r[0], Tx[n, [0, 2]])
+        assert np.allclose(r[-1], Rx[n, [0, 2]])
+        length = np.sum(np.sqrt(np.sum(np.diff(r, axis=0)**2, axis=1)))
+        assert np.isclose(length, L[n].sum(), rtol=1e-4)
+
+
+def test_grid3d_old_pickle():
+    g = grid.Grid3D(np.arange(0, 4.1), np.arange(0, 3.1), np.arange(0, 5.1))
+
+    # state of grids pickled before Grid3D could raytrace
+    state = dict(g.__dict__)
+    del state['_raytraceState']
+    state.update(cgrid=None, nsnx=10, nsny=10, nsnz=10)
+    g2 = grid.Grid3D.__new__(grid.Grid3D)
+    g2.__setstate__(state)
+
+    s = np.ones(g.getNumberOfCells())
+    Tx = np.array([[0.5, 0.5, 0.5]])
+    Rx = np.array([[3.5, 2.5, 4.5]])
+    assert np.allclose(g2.raytrace(s, Tx, Rx, want='tt'), g.raytrace(s, Tx, Rx, want='tt'))
+
+
+def test_straight_rays():
+    g, _, Tx, Rx = survey()
+    g.Tx = Tx
+    g.Rx = Rx
+    s = np.ones(g.getNumberOfCells())
+    dist = np.sqrt(np.sum((Rx - Tx)**2, axis=1))
+
+    Lsr = g.getForwardStraightRays()
+    assert np.allclose(np.asarray(Lsr.sum(axis=1)).ravel(), dist)
+
+    # in a homogeneous medium, raypaths are straight lines
+    tt, L = g.raytrace(s, Tx, Rx, want=('tt', 'L'))
+    assert np.allclose(tt, dist, rtol=5e-3)
+    assert np.allclose(L.dot(s), tt)
+    # both give the same integrals of a smooth field
+    x = g.getCellCenter()
+    f = 1 + 0.1 * x[:, 0] + 0.05 * x[:, -1]
+    assert np.allclose(L.dot(f), Lsr.dot(f), rtol=1e-2)
+
+    # anisotropic media: L holds the lengths along X, then along Z
+    L = g.raytrace(s, Tx, Rx, xi=np.ones(s.size), want='L')
+    assert L.shape == (len(tt), 2 * s.size)
+    lx = L[:, :s.size].toarray()
+    lz = L[:, s.size:].toarray()
+    assert np.allclose(np.sqrt(lx**2 + lz**2).sum(axis=1), dist, rtol=5e-3)
+
+
+def test_want():
+    g, s, Tx, Rx = survey()
+    xi = np.full(s.size, 1.1)
+    theta = np.full(s.size, 0.2)
+    for args in ((), (xi,), (xi, theta)):
+        tt, L, rays = g.raytrace(s, Tx, Rx, (), *args)
+
+        # outputs do not depend on what else is computed, nor on threads
+        L2, tt2 = g.raytrace(s, Tx, Rx, (), *args, want=('L', 'tt'))
+        assert np.array_equal(tt, tt2)
+        assert (L != L2).nnz == 0
+        assert np.array_equal(tt, g.raytrace(s, Tx, Rx, (), *args, want='tt'))
+
+        g.nthreads = 3
+        tt3, L3 = g.raytrace(s, Tx, Rx, (), *args, want=('tt', 'L'))
+        g.nthreads = 1
+        assert np.array_equal(tt, tt3)
+        assert (L != L3).nnz == 0
+
+
+def test_raytrace_error():
+    g, s, Tx, Rx = survey()
+    Tx[3] = (9, 0, 50)  # outside the grid
+
+    # errors of the threads are raised, they do not abort the interpreter
+    for method in ('spm', 'fsm'):
+        g.method = method
+        for nthreads in (1, 3):
+            g.nthreads = nthreads
+            for want in ('tt', ('tt', 'L'), ('tt', 'L', 'rays')):
+                with pytest.raises(RuntimeError):
+                    g.raytrace(s, Tx, Rx, want=want)
+
+
+def test_raytrace_distributed():
+    g, s, Tx, Rx = survey()
+    tt, L, rays = g.raytrace(s, Tx, Rx)
+    tt2, L2, rays2 = g.raytrace(s, Tx, Rx, nprocs=2)
+    assert np.array_equal(tt, tt2)
+    assert (L != L2).nnz == 0
+    assert np.array_equal(rays.offsets, rays2.offsets)
+    assert np.array_equal(rays.coords, rays2.coords)
+
+    # failures in worker processes are raised in the parent
+    Tx[3] = (9, 0, 50)
+    with pytest.raises(RuntimeError):
+        g.raytrace(s, Tx, Rx, want='tt', nprocs=2)
+
+
+def test_incremental(monkeypatch):
+    g, s, Tx, Rx = survey()
+    tt, L, rays = g.raytrace(s, Tx, Rx, incremental=1e-6)
+
+    traced = []
+    _raytrace = grid.Grid._raytrace
+
+    def spy(self, slowness, Tx, Rx, *args):
+        traced.append(Tx)
+        return _raytrace(self, slowness, Tx, Rx, *args)
+    monkeypatch.setattr(grid.Grid, '_raytrace', spy)
+
+    # only pairs crossing the modified cells are retraced
+    s2 = s.copy()
+    s2.reshape(10, 16)[4:6, 7:9] *= 1.2
+    changed = s2 != s
+    tt2, L2, rays2 = g.raytrace(s2, Tx, Rx, incremental=1e-6)
+    redo = np.diff(L[:, changed].indptr) > 0
+    assert 0 < redo.sum() < len(tt)
+    assert len(traced) == 1
+    assert np.array_equal(traced[0], Tx[redo])
+
+    # results are those of a full retrace
+    ttf, Lf, raysf = g.raytrace(s2, Tx, Rx)
+    assert np.allclose(tt2, ttf, rtol=1e-12)
+    assert abs(L2 - Lf).max() == 0
+    assert np.array_equal(rays2.offsets, raysf.offsets)
+    assert np.array_equal(rays2.coords, raysf.coords)
+
+    # pairs are compared to the model used when they were last traced
+    traced.clear()
+    g.raytrace(s2, Tx, Rx, incremental=1e-6)
+    assert len(traced) == 0
+
+
+def test_fsm():
+    g, _, Tx, Rx = survey()
+    s = np.ones(g.getNumberOfCells())
+    dist = np.sqrt(np.sum((Rx - Tx)**2, axis=1))
+    g.method = 'fsm'
+
+    # in a homogeneous medium, traveltimes converge to straight-ray times
+    err = []
+    for nsn in (1, 2, 4):
+        g.nsn_fsm = nsn
+        tt, L = g.raytrace(s, Tx, Rx, want=('tt', 'L'))
+        err.append(np.max(np.abs(tt - dist) / dist))
+        assert np.allclose(L.dot(s), tt)
+    assert err[0] < 1e-2
+    assert err[2] < err[1] < err[0]
+
+    with pytest.raises(ValueError, match='isotropic media only'):
+        g.raytrace(s, Tx, Rx, xi=np.ones(s.size))
+
+
+def test_FFTMA(tmp_path, monkeypatch):
+    g = grid.Grid2D(np.arange(0, 30.1), np.arange(0, 40.1))
+    cm = [covar.CovarianceSpherical(np.array([4.0, 3.0]), np.array([0.0]), 2.0)]
+
+    # G is saved in the cache directory, then read back from it
+    G = g.preFFTMA(cm, str(tmp_path))
+    assert len(list(tmp_path.glob('fftma_*.npy'))) == 1
+    grid.clearFFTMACache()
+
+    def fail(self, cm):
+        raise AssertionError('G should be read from the cache directory')
+    monkeypatch.setattr(grid.Grid2D, '_computeFFTMA', fail)
+    assert np.array_equal(g.preFFTMA(cm, str(tmp_path)), G)
+    monkeypatch.undo()
+
+    # realizations have the variance of the model
+    Z = g.FFTMA(G, 40, seed=1)
+    assert Z.shape == (30, 40, 40)
+    assert abs(np.mean(Z)) < 0.1
+    assert np.isclose(np.var(Z), 2.0, rtol=0.1)
+
+    # each realization has its own stream, results do not depend on nprocs
+    assert np.array_equal(g.FFTMA(G, 40, nprocs=3, seed=1), Z)
+    assert np.array_equal(g.FFTMA(G, seed=1), Z[:, :, 0])
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of module inversion
+
+Run with pytest from the directory of the modules, once cutils is built.
+"""
+
+import pickle
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+import covar
+import inversion
+from grid import Grid2D
+
+
+def test_params_defaults():
+    # options changing the solution are opt-in
+    p = inversion.InvLSQRParams()
+    assert p.precond == 0 and p.warmStart == 0 and p.reciprocity == 0
+
+    # parameters pickled before an attribute existed get its default
+    q = inversion.InvLSQRParams.__new__(inversion.InvLSQRParams)
+    q.__setstate__({'tol': 1e-6})
+    assert q.tol == 1e-6 and q.precond == 0 and q.simCacheDir is None
+
+
+def test_solveLSQR():
+    rng = np.random.default_rng(0)
+    L = sp.random(60, 40, density=0.2, random_state=1, format='csr')
+    D = sp.diags([-np.ones(40), np.ones(39)], [0, 1], shape=(39, 40), format='csr')
+    b = rng.standard_normal(60)
+
+    A = sp.vstack([L, 0.5 * D]).toarray()
+    ref = np.linalg.lstsq(A, np.concatenate([b, np.zeros(39)]), rcond=None)[0]
+
+    for solver in ('lsqr', 'lsmr'):
+        for precond in (False, True):
+            x = inversion.solveLSQR(L, [(0.5, D), (0, D)], b, solver, precond, tol=1e-12)[0]
+            assert np.allclose(x, ref, atol=1e-6)
+        x = inversion.solveLSQR(L, [(0.5, D)], b, solver, x0=ref, tol=1e-12)[0]
+        assert np.allclose(x, ref, atol=1e-6)
+
+
+def test_invData(tmp_path):
+    rng = np.random.default_rng(0)
+    it = [(rng.standard_normal(7), rng.standard_normal(5)) for _ in range(4)]
+
+    mem = inversion.invData(2)
+    h5 = inversion.invData(2, str(tmp_path / 'hist.h5'))
+    for res, s in it:
+        mem.append(res, s)
+        h5.append(res, s)
+    h5.close()
+
+    assert h5.res.shape == mem.res.shape == (7, 4)
+    assert np.array_equal(h5.res[:, -1], mem.res[:, -1])
+    assert np.array_equal(np.asarray(h5.s), mem.s)
+    assert h5._h5f is None  # reading does not leave the file open
+
+    h5b = pickle.loads(pickle.dumps(h5))
+    assert np.array_equal(h5b.s[:, 1], mem.s[:, 1])
+    mem2 = pickle.loads(pickle.dumps(mem))
+    assert np.array_equal(mem2.res, mem.res)
+
+    (tmp_path / 'hist.h5').rename(tmp_path / 'moved.h5')
+    with pytest.raises(IOError, match='hist.h5'):
+        h5b.res[:, 0]
+
+
+def survey():
+    g = Grid2D(np.linspace(0, 10, 11), np.linspace(0, 15, 16))
+    z = np.linspace(0.5, 14.5, 8)
+    zt, zr = np.meshgrid(z, z)
+    Tx = np.column_stack([np.full(zt.size, 0.2), np.zeros(zt.size), zt.ravel()])
+    Rx = np.column_stack([np.full(zt.size, 9.8), np.zeros(zt.size), zr.ravel()])
+    g.Tx = Tx
+    g.Rx = Rx
+    s = np.ones(g.getNumberOfCells())
+    s.reshape(10, 15)[4:6, 5:10] = 1.3
+    L = g.getForwardStraightRays()
+    tt = L.dot(s)
+    data = np.column_stack([Tx, Rx, tt])
+
+    cm = covar.CovarianceModel('2D')
+    cm.covar[0].range = np.array([4.0, 3.0])
+    cm.covar[0].sill = 0.01
+    cm.nugget_data = 0.01
+    cm.nugget_model = 0.001
+    return g, L, data, cm
+
+
+def test_invGeostat():
+    g, L, data, cm = survey()
+    tt = data[:, 6]
+
+    # dense reference
+    xc = g.getCellCenter()
+    Cm = cm.compute(xc, xc)
+    lsum = np.asarray(L.sum(axis=1)).ravel()
+    l = np.mean(tt / lsum)
+    Cd = L.dot(L.dot(Cm).T) + cm.nugget_data * np.eye(L.shape[0])
+    ref = np.linalg.solve(Cd, tt - lsum * l).dot(L.dot(Cm)) + l
+
+    assert np.allclose(inversion.dataCovariance(cm, xc, L, nb=33), Cd - cm.nugget_data * np.eye(L.shape[0]))
+    v = np.random.default_rng(0).standard_normal((xc.shape[0], 2))
+    assert np.allclose(covar.CovarianceOperator(cm, g.getNcell(), g.getCellSize()).dot(v), Cm.dot(v))
+
+    p = inversion.InvLSQRParams()
+    for solver, fft in (('cholesky', 0), ('cholesky', 1), ('cg', 1)):
+        p.geostatSolver = solver
+        p.covarFFT = fft
+        tomo = inversion.invGeostat(p, data, np.ones(len(tt), bool), g, cm, np.zeros(1))
+        assert np.allclose(tomo.s, ref, rtol=1e-5)
+
+
+def test_simulateGeostat(tmp_path):
+    g, L, data, cm = survey()
+    tt = data[:, 6]
+
+    p = inversion.InvLSQRParams()
+    p.doSim = 1
+    p.nbreSim = 20
+    p.simSeed = 3
+    p.simCacheDir = str(tmp_path)
+    tomo = inversion.invGeostat(p, data, np.ones(len(tt), bool), g, cm, np.zeros(1))
+    assert tomo.simu.shape == (L.shape[1], 20)
+    assert len(list(tmp_path.glob('fftma_*.npy'))) == 1
+
+    # realizations honor the data within the noise, which is much smaller
+    # than the variations of the data of unconditioned realizations
+    r = L.dot(tomo.simu) - tt[:, None]
+    assert np.sqrt(np.mean(r**2)) < 1.5 * np.sqrt(cm.nugget_data)
+    G = g.preFFTMA(cm.covar + [covar.CovarianceNugget(cm.nugget_model)])
+    Z = g.FFTMA(G, 20, seed=3).reshape(-1, 20)
+    assert np.std(L.dot(Z)) > 4 * np.sqrt(cm.nugget_data)
+
+    # results do not depend on the number of processes
+    p.nprocs = 3
+    tomo3 = inversion.invGeostat(p, data, np.ones(len(tt), bool), g, cm, np.zeros(1))
+    assert np.array_equal(tomo3.simu, tomo.simu)